@@ -0,0 +1,287 @@
+"""批量调整用户余额（营销空投、补偿等）。
+
+输入为 (telegram_id, amount, reason) 记录组成的 CSV 文件、标准输入或任意可迭代对象。
+记录先通过 COPY 写入临时暂存表，再按序号分块，每块一个事务、一条 UPDATE ... FROM 语句入账，
+每条记录写一行 balance_ledger。批次号保证幂等：同一批次重复执行不会重复入账，
+中途失败后重新执行会从最后提交的分块继续。
+
+amount 可以为负数（扣减）。某个用户在一个分块内的调整合计会使余额变为负数时，
+该用户在这一分块中的记录全部跳过；不存在的 telegram_id 同样跳过，跳过的记录数在结果中返回。
+
+用法示例：
+    python airdrop.py --batch-id spring-2024 airdrop.csv
+    cat compensation.csv | python airdrop.py --batch-id incident-0612 --header -
+"""
+import io
+import csv
+import sys
+import time
+import logging
+import argparse
+import psycopg2
+from psycopg2 import extensions
+from db_pool import get_db_connection, put_db_connection, close_pool
+from user_cache import user_cache
+
+logger = logging.getLogger(__name__)
+
+# 死锁或序列化失败时，单个分块的重试次数
+CHUNK_RETRIES = 3
+
+CREATE_STAGING_SQL = """
+    CREATE TEMP TABLE IF NOT EXISTS balance_adjustment_staging (
+        seq BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+        telegram_id TEXT NOT NULL,
+        amount INTEGER NOT NULL,
+        reason TEXT
+    )
+"""
+
+# 按用户合并一个分块内的多条记录后一次性更新余额；余额会变为负数的用户不更新，
+# 只为实际入账的用户逐条写入流水，并推进批次进度
+APPLY_CHUNK_SQL = """
+    WITH chunk AS (
+        SELECT s.seq, u.id AS user_id, s.amount, s.reason
+        FROM balance_adjustment_staging s
+        JOIN users u ON u.telegram_id = s.telegram_id
+        WHERE s.seq > %(after)s AND s.seq <= %(until)s
+    ),
+    totals AS (
+        SELECT user_id, SUM(amount) AS amount FROM chunk GROUP BY user_id
+    ),
+    credited AS (
+        UPDATE users u
+        SET balance = u.balance + t.amount,
+            updated_at = CURRENT_TIMESTAMP
+        FROM totals t
+        WHERE u.id = t.user_id AND u.balance + t.amount >= 0
+        RETURNING u.id, u.telegram_id
+    ),
+    ledger AS (
+        INSERT INTO balance_ledger (user_id, amount, kind, ref, reason)
+        SELECT c.user_id, c.amount, 'adjustment', %(batch_id)s, c.reason
+        FROM chunk c
+        JOIN credited ON credited.id = c.user_id
+        ORDER BY c.seq
+        RETURNING 1
+    ),
+    progress AS (
+        UPDATE balance_adjustment_batches
+        SET applied_seq = %(until)s,
+            credited_rows = credited_rows + (SELECT COUNT(*) FROM ledger),
+            skipped_rows = skipped_rows + %(until)s - %(after)s - (SELECT COUNT(*) FROM ledger),
+            status = CASE WHEN %(until)s >= total_rows THEN 'completed' ELSE status END,
+            completed_at = CASE WHEN %(until)s >= total_rows THEN CURRENT_TIMESTAMP END
+        WHERE batch_id = %(batch_id)s
+    )
+    SELECT ARRAY(SELECT telegram_id FROM credited) AS credited_telegram_ids
+"""
+
+
+class RecordStream(io.TextIOBase):
+    """把 (telegram_id, amount, reason) 记录的迭代器包装成 COPY 可读取的 CSV 文件对象，不整体载入内存。"""
+
+    def __init__(self, records):
+        self._records = iter(records)
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer, lineterminator='\n')
+        self._pending = ''
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._pending) < size:
+            record = next(self._records, None)
+            if record is None:
+                break
+            self._writer.writerow(record)
+            if self._buffer.tell() >= 65536:
+                self._pending += self._buffer.getvalue()
+                self._buffer.seek(0)
+                self._buffer.truncate()
+        self._pending += self._buffer.getvalue()
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        if size < 0:
+            data, self._pending = self._pending, ''
+        else:
+            data, self._pending = self._pending[:size], self._pending[size:]
+        return data
+
+
+def _stage(conn, source, header):
+    # 暂存表是会话级临时表，分块事务提交后仍然保留，处理结束后删除
+    with conn.cursor() as cur:
+        cur.execute("DROP TABLE IF EXISTS balance_adjustment_staging")
+        cur.execute(CREATE_STAGING_SQL)
+        cur.copy_expert(
+            "COPY balance_adjustment_staging (telegram_id, amount, reason) FROM STDIN "
+            f"WITH (FORMAT csv{', HEADER' if header else ''})",
+            source,
+        )
+        cur.execute("ANALYZE balance_adjustment_staging")
+        cur.execute("SELECT COUNT(*) AS total_rows, COALESCE(SUM(amount), 0) AS total_amount FROM balance_adjustment_staging")
+        totals = cur.fetchone()
+    conn.commit()
+    return totals['total_rows'], totals['total_amount']
+
+
+def _register_batch(conn, batch_id, total_rows, total_amount):
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO balance_adjustment_batches (batch_id, total_rows, total_amount)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (batch_id) DO NOTHING
+        """, (batch_id, total_rows, total_amount))
+        cur.execute("SELECT * FROM balance_adjustment_batches WHERE batch_id = %s", (batch_id,))
+        batch = cur.fetchone()
+    conn.commit()
+    if (batch['total_rows'], batch['total_amount']) != (total_rows, total_amount):
+        raise ValueError(
+            f"Batch {batch_id} was already used for {batch['total_rows']} rows totalling {batch['total_amount']}, "
+            f"got {total_rows} rows totalling {total_amount}"
+        )
+    return batch
+
+
+def _apply_chunk(conn, batch_id, chunk_size):
+    # 锁住批次行后从已提交的进度继续，同一批次的并发执行互相排队，不会重复入账。
+    # 返回本块处理后的进度，批次已全部入账时返回 None
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT applied_seq, total_rows FROM balance_adjustment_batches WHERE batch_id = %s FOR UPDATE",
+            (batch_id,)
+        )
+        batch = cur.fetchone()
+        after = batch['applied_seq']
+        if after >= batch['total_rows']:
+            conn.rollback()
+            return None
+        until = min(after + chunk_size, batch['total_rows'])
+        cur.execute(APPLY_CHUNK_SQL, {'batch_id': batch_id, 'after': after, 'until': until})
+        result = cur.fetchone()
+    conn.commit()
+    user_cache.invalidate_many(result['credited_telegram_ids'])
+    return until
+
+
+def apply_adjustments(batch_id, source, chunk_size=10000, header=False):
+    """按批次号入账一批余额调整，返回 {'rows', 'credited', 'skipped', 'already_applied'}。
+
+    source 为 CSV 文件对象（列依次为 telegram_id, amount, reason），或 (telegram_id, amount, reason) 记录的可迭代对象。
+    同一批次号只会入账一次；同一批次号对应的记录数或总金额不同时抛出 ValueError。
+    其他进程中的用户缓存不会被通知，最多在 USER_CACHE_TTL 秒后看到新余额。
+    """
+    if not hasattr(source, 'read'):
+        source, header = RecordStream(source), False
+
+    started = time.monotonic()
+    conn = get_db_connection()
+    try:
+        total_rows, total_amount = _stage(conn, source, header)
+        batch = _register_batch(conn, batch_id, total_rows, total_amount)
+        if batch['status'] == 'completed':
+            logger.info(f"Batch {batch_id} was already applied at {batch['completed_at']}, skipping")
+            return {'rows': total_rows, 'credited': batch['credited_rows'], 'skipped': batch['skipped_rows'],
+                    'already_applied': True}
+        if batch['applied_seq']:
+            logger.info(f"Resuming batch {batch_id} after row {batch['applied_seq']}")
+
+        applied = batch['applied_seq']
+        retries = 0
+        while True:
+            try:
+                result = _apply_chunk(conn, batch_id, chunk_size)
+            except extensions.TransactionRollbackError as e:
+                # 与结算、手续费汇总等并发更新发生死锁时整块回滚，重试同一分块
+                conn.rollback()
+                retries += 1
+                if retries > CHUNK_RETRIES:
+                    raise
+                logger.warning(f"Batch {batch_id} chunk after row {applied} rolled back ({e}), retrying")
+                continue
+            except psycopg2.Error as e:
+                conn.rollback()
+                logger.error(f"Error applying batch {batch_id} after row {applied}: {e}")
+                raise
+            if result is None:
+                break
+            applied = result
+            retries = 0
+            logger.info(f"Batch {batch_id}: applied {applied}/{total_rows} rows")
+
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT credited_rows, skipped_rows FROM balance_adjustment_batches WHERE batch_id = %s",
+                (batch_id,)
+            )
+            batch = cur.fetchone()
+    finally:
+        try:
+            conn.rollback()
+            with conn.cursor() as cur:
+                cur.execute("DROP TABLE IF EXISTS balance_adjustment_staging")
+            conn.commit()
+        finally:
+            put_db_connection(conn)
+
+    logger.info(f"Batch {batch_id}: credited {batch['credited_rows']} of {total_rows} rows "
+                f"({batch['skipped_rows']} skipped) in {time.monotonic() - started:.1f}s")
+    return {'rows': total_rows, 'credited': batch['credited_rows'], 'skipped': batch['skipped_rows'],
+            'already_applied': False}
+
+
+def benchmark(rows=100000, chunk_size=10000):
+    """为 rows 个测试用户各入账 1 游戏币并计时。会在当前数据库中写入测试数据。"""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO users (telegram_id, username, balance)
+                SELECT 'bench_airdrop_' || i, 'bench_airdrop_' || i, 0
+                FROM generate_series(1, %s) AS i
+                ON CONFLICT (telegram_id) DO NOTHING
+            """, (rows,))
+        conn.commit()
+    finally:
+        put_db_connection(conn)
+
+    records = ((f'bench_airdrop_{i}', 1, 'benchmark') for i in range(1, rows + 1))
+    started = time.perf_counter()
+    result = apply_adjustments(f'benchmark-{time.time_ns()}', records, chunk_size)
+    elapsed = time.perf_counter() - started
+    print(f"{result['credited']} of {rows} rows in {elapsed:.2f}s ({rows / elapsed:.0f} rows/s)")
+    return elapsed
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', nargs='?', help="CSV 文件（telegram_id,amount,reason），'-' 表示标准输入")
+    parser.add_argument('--batch-id', help='批次号，同一批次只会入账一次')
+    parser.add_argument('--header', action='store_true', help='输入的第一行是表头')
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--benchmark', type=int, metavar='ROWS', help='为指定数量的测试用户入账并计时')
+    args = parser.parse_args()
+
+    try:
+        if args.benchmark:
+            benchmark(args.benchmark, args.chunk_size)
+            return
+        if not args.input or not args.batch_id:
+            parser.error('input and --batch-id are required')
+        if args.input == '-':
+            apply_adjustments(args.batch_id, sys.stdin, args.chunk_size, args.header)
+        else:
+            with open(args.input, newline='', encoding='utf-8') as source:
+                apply_adjustments(args.batch_id, source, args.chunk_size, args.header)
+    except (ValueError, psycopg2.Error) as e:
+        logger.error(str(e))
+        sys.exit(1)
+    finally:
+        close_pool()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,32 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from config import DB_EXECUTOR_WORKERS
+from metrics import instrument_db_call
+
+logger = logging.getLogger(__name__)
+
+# psycopg2 是同步驱动，数据库操作统一放到有上限的线程池中执行，
+# 避免慢查询阻塞事件循环。线程数默认与连接池上限一致，线程不会空等连接。
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix='db')
+        logger.info(f"Database executor started with {DB_EXECUTOR_WORKERS} workers")
+    return _executor
+
+
+async def run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    # 所有数据库辅助函数都经由这里执行，在此统一记录耗时指标
+    return await loop.run_in_executor(get_executor(), instrument_db_call(func, *args, **kwargs))
+
+
+def shutdown_executor(wait=True):
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=wait)
+        _executor = None
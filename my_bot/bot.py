@@ -1,16 +1,48 @@
 import os
+import time
 import logging
 import asyncio
+import datetime
 import psycopg2
-from psycopg2.extras import RealDictCursor
-import random
-import string
 import uuid
 import urllib.parse
 import telegram
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
 from dotenv import load_dotenv
+from db_pool import get_db_connection, put_db_connection, close_pool, get_pool
+from async_db import run_db, shutdown_executor
+from settlement import settle_game, rollup_fee_accruals
+from ledger import snapshot_balances
+from user_cache import user_cache
+from pending_games import pending_store
+from matchmaking import order_book, BET_TIERS
+from migrations import ensure_schema
+import invite_codes
+from startup import bootstrap
+from config import (
+    INVITE_EARNINGS_WINDOW_DAYS,
+    INVITED_USERS_PAGE_SIZE,
+    BOT_MODE,
+    WEBHOOK_URL,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET_TOKEN,
+    WEBHOOK_MAX_CONNECTIONS,
+    CONCURRENT_UPDATES,
+    MAX_PENDING_UPDATES,
+    PENDING_GAME_TTL,
+    EXPIRY_SWEEP_INTERVAL,
+    EXPIRY_SWEEP_BATCH,
+    FEE_ROLLUP_INTERVAL,
+    FEE_ROLLUP_BATCH,
+    BALANCE_SNAPSHOT_INTERVAL,
+    METRICS_SAMPLE_INTERVAL,
+)
+from update_processor import PerUserUpdateProcessor
+from dispatcher import dispatcher, PRIORITY_RESULT, PRIORITY_NORMAL
+import metrics
 
 load_dotenv()
 
@@ -23,144 +55,204 @@ if not BOT_TOKEN:
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def get_db_connection():
-    return psycopg2.connect(DB_URL, sslmode='require', cursor_factory=RealDictCursor)
+# 进程启动时间，用于统计冷启动耗时
+STARTED_AT = time.monotonic()
 
 def create_tables():
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                telegram_id TEXT UNIQUE,
-                username TEXT,
-                invite_code TEXT UNIQUE,
-                balance INTEGER DEFAULT 1000,
-                inviter_id INTEGER REFERENCES users(id),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        # 检查 updated_at 列是否存在，如果不存在则添加
-        cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name='users' AND column_name='updated_at'")
-        if cur.fetchone() is None:
-            cur.execute("ALTER TABLE users ADD COLUMN updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
-        
-        cur.execute('''
-    CREATE TABLE IF NOT EXISTS game_history (
-        id SERIAL PRIMARY KEY,
-        game_id TEXT,
-        player_a_id INTEGER REFERENCES users(id),
-        player_b_id INTEGER REFERENCES users(id),
-        bet_amount INTEGER,
-        player_a_score INTEGER,
-        player_b_score INTEGER,
-        winner_id INTEGER REFERENCES users(id),
-        win_amount INTEGER,
-        status TEXT,
-        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-    )
-''')
-    conn.commit()
-    conn.close()
+    # 表结构与索引由版本化迁移统一管理，版本已是最新时不执行 DDL
+    ensure_schema()
 
 def get_user_by_id(user_id):
+    user, version = user_cache.get_by_id(user_id)
+    if user:
+        return user
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
             cur.execute("SELECT * FROM users WHERE id = %s", (user_id,))
             user = cur.fetchone()
+        user_cache.put(user, version)
         return user
     except psycopg2.Error as e:
         logger.error(f"Error fetching user by ID: {e}")
         return None
     finally:
-        conn.close()
+        put_db_connection(conn)
 
 def get_user_by_telegram_id(telegram_id):
+    user, version = user_cache.get_by_telegram_id(telegram_id)
+    if user:
+        return user
     conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute("SELECT * FROM users WHERE telegram_id = %s", (telegram_id,))
-        user = cur.fetchone()
-    conn.close()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT * FROM users WHERE telegram_id = %s", (telegram_id,))
+            user = cur.fetchone()
+    finally:
+        put_db_connection(conn)
+    user_cache.put(user, version)
     return user
 
 def get_user_by_invite_code(invite_code):
+    # 迁移前发出的旧邀请码优先按 legacy_invite_code 匹配；否则解码为用户 id 后按主键查询，并核对存储的邀请码。
+    # 新邀请码与旧邀请码不会相同（迁移与注册时均已排除），UNION ALL 按顺序执行，命中旧邀请码时不再查主键
+    user_id = invite_codes.decode(invite_code)
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT * FROM users WHERE UPPER(invite_code) = UPPER(%s)", (invite_code,))
+            cur.execute("""
+                (SELECT * FROM users WHERE legacy_invite_code = %(legacy_code)s LIMIT 1)
+                UNION ALL
+                SELECT * FROM users WHERE id = %(user_id)s AND invite_code = %(invite_code)s
+                LIMIT 1
+            """, {
+                'user_id': user_id,
+                'invite_code': invite_codes.encode(user_id) if user_id else None,
+                'legacy_code': invite_code.strip().upper(),
+            })
             user = cur.fetchone()
         return user
     except psycopg2.Error as e:
         logger.error(f"Error fetching user by invite code: {e}")
         return None
     finally:
-        conn.close()
+        put_db_connection(conn)
 
 def create_user(telegram_id, username, inviter_id=None):
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute(
-                """INSERT INTO users (telegram_id, username, inviter_id, balance, created_at, updated_at) 
-                VALUES (%s, %s, %s, 1000, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP) RETURNING *""",
-                (telegram_id, username, inviter_id)
-            )
-            new_user = cur.fetchone()
+            new_user = None
+            while new_user is None:
+                # 先取得新用户的 id，邀请码由 id 计算得出，注册时一并写入。
+                # 邀请码恰好等于某个旧邀请码时不插入，跳过这个 id 重新取号
+                cur.execute("SELECT nextval(pg_get_serial_sequence('users', 'id')) AS id")
+                user_id = cur.fetchone()['id']
+                new_user = _insert_user(cur, user_id, telegram_id, username, inviter_id)
+                if new_user is None:
+                    logger.warning(f"Invite code for user id {user_id} collides with a legacy invite code, skipping id")
         conn.commit()
+        user_cache.put(new_user)
         return new_user
     except psycopg2.Error as e:
         logger.error(f"Error creating user: {e}")
         conn.rollback()
         return None
     finally:
-        conn.close()
+        put_db_connection(conn)
+
+def _insert_user(cur, user_id, telegram_id, username, inviter_id):
+    # 注册与邀约者的邀请人数汇总在同一条语句中完成；邀请码与旧邀请码相同时不插入，返回 None
+    cur.execute(
+        """WITH new_user AS (
+            INSERT INTO users (id, telegram_id, username, invite_code, inviter_id, balance, created_at, updated_at) 
+            SELECT %(id)s, %(telegram_id)s, %(username)s, %(invite_code)s, %(inviter_id)s, 1000, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP
+            WHERE NOT EXISTS (SELECT 1 FROM users WHERE legacy_invite_code = %(invite_code)s)
+            RETURNING *
+        ),
+        stats AS (
+            INSERT INTO invite_stats (inviter_id, invited_count)
+            SELECT inviter_id, 1 FROM new_user WHERE inviter_id IS NOT NULL
+            ON CONFLICT (inviter_id) DO UPDATE
+            SET invited_count = invite_stats.invited_count + 1, updated_at = CURRENT_TIMESTAMP
+        ),
+        ledger AS (
+            INSERT INTO balance_ledger (user_id, amount, kind)
+            SELECT id, balance, 'signup' FROM new_user
+        )
+        SELECT * FROM new_user""",
+        {'id': user_id, 'telegram_id': telegram_id, 'username': username,
+         'invite_code': invite_codes.encode(user_id), 'inviter_id': inviter_id}
+    )
+    return cur.fetchone()
 
 def generate_invite_code(user_id):
-    invite_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+    # 邀请码由用户 id 确定性生成，重复调用结果相同；与旧邀请码相同时不写入，返回 None
+    invite_code = invite_codes.encode(user_id)
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute(
-                "UPDATE users SET invite_code = %s WHERE id = %s",
-                (invite_code, user_id)
-            )
+            cur.execute("""
+                UPDATE users SET invite_code = %(invite_code)s
+                WHERE id = %(id)s
+                  AND NOT EXISTS (SELECT 1 FROM users WHERE legacy_invite_code = %(invite_code)s)
+                RETURNING invite_code
+            """, {'invite_code': invite_code, 'id': user_id})
+            row = cur.fetchone()
         conn.commit()
+        user_cache.invalidate(user_id=user_id)
+        if row is None:
+            logger.warning(f"Invite code for user id {user_id} collides with a legacy invite code")
+            return None
         return invite_code
     except psycopg2.Error as e:
         logger.error(f"Error generating invite code: {e}")
         conn.rollback()
         return None
     finally:
-        conn.close()
+        put_db_connection(conn)
 
-def update_user_balance(telegram_id, amount, is_invite_earning=False):
+def update_user_balance(telegram_id, amount, is_invite_earning=False, kind='adjustment', ref=None):
+    # 变动余额并在同一条语句中写入流水，kind 与 ref 记录变动来源（见 ledger.py）
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            if is_invite_earning:
-                cur.execute("""
-                    UPDATE users 
-                    SET balance = balance + %s, 
-                        invite_earnings = invite_earnings + %s,
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE telegram_id = %s
-                """, (amount, amount, telegram_id))
-            else:
-                cur.execute("""
+            cur.execute("""
+                WITH updated AS (
                     UPDATE users 
-                    SET balance = balance + %s,
+                    SET balance = balance + %(amount)s, 
+                        invite_earnings = invite_earnings + %(invite_amount)s,
                         updated_at = CURRENT_TIMESTAMP
-                    WHERE telegram_id = %s
-                """, (amount, telegram_id))
+                    WHERE telegram_id = %(telegram_id)s
+                    RETURNING id
+                )
+                INSERT INTO balance_ledger (user_id, amount, kind, ref)
+                SELECT id, %(amount)s, %(kind)s, %(ref)s FROM updated
+            """, {
+                'telegram_id': telegram_id,
+                'amount': amount,
+                'invite_amount': amount if is_invite_earning else 0,
+                'kind': kind,
+                'ref': ref,
+            })
         conn.commit()
+        user_cache.invalidate(telegram_id=telegram_id)
     except psycopg2.Error as e:
         logger.error(f"Error updating user balance: {e}")
         conn.rollback()
     finally:
-        conn.close()
+        put_db_connection(conn)
+
+def debit_user_balance(telegram_id, amount, kind='bet', ref=None):
+    # 条件扣款：一条语句内判断余额是否足够并扣除、写入流水，返回扣款后的余额；余额不足时返回 None
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                WITH debited AS (
+                    UPDATE users
+                    SET balance = balance - %(amount)s,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE telegram_id = %(telegram_id)s AND balance >= %(amount)s
+                    RETURNING id, balance
+                ),
+                ledger AS (
+                    INSERT INTO balance_ledger (user_id, amount, kind, ref)
+                    SELECT id, 0 - %(amount)s, %(kind)s, %(ref)s FROM debited
+                )
+                SELECT balance FROM debited
+            """, {'telegram_id': telegram_id, 'amount': amount, 'kind': kind, 'ref': ref})
+            row = cur.fetchone()
+        conn.commit()
+        if row:
+            user_cache.update(telegram_id, balance=row['balance'])
+        return row['balance'] if row else None
+    except psycopg2.Error as e:
+        logger.error(f"Error debiting user balance: {e}")
+        conn.rollback()
+        return None
+    finally:
+        put_db_connection(conn)
 
 def add_game_history(game_id, player_a_id, player_b_id, bet_amount, player_a_score, player_b_score, winner_id, win_amount, status):
     conn = get_db_connection()
@@ -176,72 +268,115 @@ def add_game_history(game_id, player_a_id, player_b_id, bet_amount, player_a_sco
         conn.rollback()
         logger.error(f"Error adding game history: {e}")
     finally:
-        conn.close()
-
-async def cancel_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    query = update.callback_query
-    await query.answer()
-
-    # 清理游戏数据
-    if 'game_id' in context.user_data:
-        game_id = context.user_data['game_id']
-        if game_id in context.bot_data.get('pending_games', {}):
-            del context.bot_data['pending_games'][game_id]
-
-    # 重置用户数据
-    context.user_data.clear()
-    context.user_data['game_state'] = 'idle'
-
-    await query.edit_message_text("游戏已取消。", reply_markup=create_main_menu())
-
-def get_user_game_history(user_id, status='completed', limit=5, offset=0):
-    conn = get_db_connection()
+        put_db_connection(conn)
+
+HISTORY_EPOCH = datetime.datetime(1970, 1, 1)
+
+def encode_history_cursor(game):
+    # 游标由 (created_at, id) 组成，编码为十六进制以控制 callback_data 长度（上限 64 字节）
+    micros = (game['created_at'] - HISTORY_EPOCH) // datetime.timedelta(microseconds=1)
+    return f"{micros:x}.{game['id']:x}"
+
+def decode_history_cursor(cursor):
+    micros, game_id = cursor.split('.')
+    return HISTORY_EPOCH + datetime.timedelta(microseconds=int(micros, 16)), int(game_id, 16)
+
+def get_user_game_history_page(user_id, status='completed', limit=5, cursor=None, direction='next'):
+    """按 (created_at, id) 键集分页查询对战历史，只读查询，优先走只读副本。
+
+    direction 为 'next' 时取游标之后（更早）的记录，'prev' 取游标之前（更新）的记录，
+    'at' 取从游标（含）开始的一页。多取一条用于判断该方向是否还有更多记录，
+    返回 (按时间倒序的记录, 是否还有更多)。
+    """
+    conditions = {
+        'next': "AND (created_at, id) < (%(created_at)s, %(id)s)",
+        'prev': "AND (created_at, id) > (%(created_at)s, %(id)s)",
+        'at': "AND (created_at, id) <= (%(created_at)s, %(id)s)",
+    }
+    condition = conditions[direction] if cursor else ""
+    order = "ASC" if direction == 'prev' and cursor else "DESC"
+    params = {'user_id': user_id, 'status': status, 'fetch': limit + 1, 'created_at': None, 'id': None}
+    if cursor:
+        params['created_at'], params['id'] = decode_history_cursor(cursor)
+
+    # 玩家可能出现在 player_a 或 player_b，两个分支各自走对应的复合索引并只取一页，
+    # 合并后再排序截断，因此每页的代价与翻到第几页无关
+    branch = f"""
+        SELECT * FROM game_history
+        WHERE {{column}} = %(user_id)s AND status = %(status)s {condition}
+        ORDER BY created_at {order}, id {order}
+        LIMIT %(fetch)s
+    """
+    conn = get_db_connection(readonly=True)
     try:
         with conn.cursor() as cur:
-            cur.execute("""
-                SELECT gh.*, 
-                       ua.username as player_a_username, 
+            cur.execute(f"""
+                SELECT gh.*,
+                       ua.username as player_a_username,
                        ub.username as player_b_username
-                FROM game_history gh
+                FROM (
+                    ({branch.format(column='player_a_id')})
+                    UNION ALL
+                    ({branch.format(column='player_b_id')})
+                ) gh
                 LEFT JOIN users ua ON gh.player_a_id = ua.id
                 LEFT JOIN users ub ON gh.player_b_id = ub.id
-                WHERE (gh.player_a_id = %s OR gh.player_b_id = %s)
-                  AND gh.status = %s
-                ORDER BY gh.created_at DESC
-                LIMIT %s OFFSET %s
-            """, (user_id, user_id, status, limit, offset))
-            game_history = cur.fetchall()
-        return game_history
+                ORDER BY gh.created_at {order}, gh.id {order}
+                LIMIT %(fetch)s
+            """, params)
+            games = cur.fetchall()
     except psycopg2.Error as e:
         logger.error(f"Error fetching user game history: {e}")
-        return []
+        return [], False
     finally:
-        conn.close()
+        put_db_connection(conn)
 
-def get_invited_users(user_id):
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute("SELECT * FROM users WHERE inviter_id = %s", (user_id,))
-        invited_users = cur.fetchall()
-    conn.close()
-    return invited_users
+    has_more = len(games) > limit
+    games = games[:limit]
+    if order == "ASC":
+        games.reverse()
+    return games, has_more
+
+def get_invited_users(user_id, after_id=0, limit=INVITED_USERS_PAGE_SIZE):
+    # 按 id 键集分页读取下线，多取一条判断是否还有下一页
+    conn = get_db_connection(readonly=True)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT id, username, created_at FROM users
+                WHERE inviter_id = %s AND id > %s
+                ORDER BY id
+                LIMIT %s
+            """, (user_id, after_id, limit + 1))
+            invited_users = cur.fetchall()
+    finally:
+        put_db_connection(conn)
+    return invited_users[:limit], len(invited_users) > limit
+
+def get_invite_summary(user_id, days=INVITE_EARNINGS_WINDOW_DAYS):
+    # 读取邀约汇总：邀请人数、累计收益、最近 days 天的收益
+    conn = get_db_connection(readonly=True)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT s.invited_count, s.total_earnings,
+                       (SELECT COALESCE(SUM(d.earnings), 0) FROM invite_earnings_daily d
+                        WHERE d.inviter_id = s.inviter_id AND d.day > CURRENT_DATE - %s) AS recent_earnings
+                FROM invite_stats s
+                WHERE s.inviter_id = %s
+            """, (days, user_id))
+            summary = cur.fetchone()
+    finally:
+        put_db_connection(conn)
+    return summary or {'invited_count': 0, 'total_earnings': 0, 'recent_earnings': 0}
 
 def calculate_invite_earnings(user_id):
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute("""
-            SELECT SUM(win_amount) * 0.07 as earnings
-            FROM game_history
-            JOIN users ON game_history.winner_id = users.id
-            WHERE users.inviter_id = %s
-        """, (user_id,))
-        earnings = cur.fetchone()['earnings'] or 0
-    conn.close()
-    return earnings
+    return get_invite_summary(user_id)['total_earnings']
 
 def create_main_menu():
     keyboard = [
         [InlineKeyboardButton("🎮 开始游戏", callback_data='start_game')],
+        [InlineKeyboardButton("⚡ 快速匹配", callback_data='quick_match')],
         [InlineKeyboardButton("📜 对战历史", callback_data='game_history')],
         [InlineKeyboardButton("🔗 邀约收益", callback_data='invite_earnings')],  # 修改这里
         [InlineKeyboardButton("💰 余额", callback_data='balance')],
@@ -258,11 +393,12 @@ def update_user_info(telegram_id, username):
                 (username, telegram_id)
             )
         conn.commit()
+        user_cache.update(telegram_id, username=username)
     except psycopg2.Error as e:
         logger.error(f"Error updating user info: {e}")
         conn.rollback()
     finally:
-        conn.close()
+        put_db_connection(conn)
 
 def create_game_share_button(game_id, bot_username):
     return InlineKeyboardButton(
@@ -270,22 +406,12 @@ def create_game_share_button(game_id, bot_username):
         url=f"https://t.me/share/url?url=https://t.me/{bot_username}?start={game_id}&text=来和我一起玩游戏吧！"
     )
 
-def create_game_history_keyboard(has_more, page=0):
-    keyboard = []
-    if page > 0:
-        keyboard.append(InlineKeyboardButton("上一页", callback_data=f"history_prev_{page}"))
-    if has_more:
-        keyboard.append(InlineKeyboardButton("下一页", callback_data=f"history_next_{page}"))
-    keyboard.append(InlineKeyboardButton("刷新", callback_data=f"history_refresh_{page}"))
-    keyboard.append(InlineKeyboardButton("返回主菜单", callback_data="main_menu"))
-    return InlineKeyboardMarkup([keyboard])
-
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     args = context.args
     telegram_id = str(update.effective_user.id)
     username = update.effective_user.username or "Unknown"
-    update_user_info(telegram_id, username)
-    user = get_user_by_telegram_id(telegram_id)
+    await run_db(update_user_info, telegram_id, username)
+    user = await run_db(get_user_by_telegram_id, telegram_id)
     
     if args and args[0]:
         game_id = args[0]
@@ -307,23 +433,34 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text("请输入邀请码完成注册,注册后可获得1000空投游戏币：", reply_markup=create_main_menu())
         context.user_data['awaiting_invite_code'] = True
 
-async def join_game(update: Update, context: ContextTypes.DEFAULT_TYPE, game_id: str) -> None:
-    user = get_user_by_telegram_id(str(update.effective_user.id))
-    game = context.bot_data.get('pending_games', {}).get(game_id)
+async def join_game(update: Update, context: ContextTypes.DEFAULT_TYPE, game_id: str) -> bool:
+    # 通过分享链接或快速匹配加入挑战，成功时返回 True
+    user = await run_db(get_user_by_telegram_id, str(update.effective_user.id))
+    game = pending_store.get(game_id)
     
     if not game:
-        await update.message.reply_text("对不起，这个游戏已经结束或不存在。", reply_markup=create_main_menu())
-        return
-
-    if user['balance'] < game['bet_amount']:
-        await update.message.reply_text("您的余额不足以加入这个游戏。", reply_markup=create_main_menu())
-        return
-
-    # 立即扣除下注金额
-    update_user_balance(user['telegram_id'], -game['bet_amount'])
-
-    creator = get_user_by_id(game['creator_id'])
-    await update.message.reply_text(
+        await update.effective_message.reply_text("对不起，这个游戏已经结束或不存在。", reply_markup=create_main_menu())
+        return False
+
+    if game['creator_id'] == user['id']:
+        # 创建者打开自己的分享链接：不能与自己对战，也不能重复扣款
+        await update.effective_message.reply_text("您不能加入自己发起的挑战，请把链接分享给好友。", reply_markup=create_main_menu())
+        return False
+
+    # 通过链接加入的挑战不再参与快速匹配；扣款期间先移出，避免同时被快速匹配
+    queued = order_book.remove(game_id)
+
+    # 立即扣除下注金额，余额不足时不会扣款
+    new_balance = await run_db(debit_user_balance, user['telegram_id'], game['bet_amount'], kind='join', ref=game_id)
+    if new_balance is None:
+        if queued and game_id in pending_store:
+            # 扣款失败，挑战放回队首，保持原有的先后顺序
+            order_book.add(game_id, game['bet_amount'], game['creator_id'], front=True)
+        await update.effective_message.reply_text("您的余额不足以加入这个游戏。", reply_markup=create_main_menu())
+        return False
+
+    creator = await run_db(get_user_by_id, game['creator_id'])
+    await update.effective_message.reply_text(
         f"您已成功加入 @{creator['username']} 发起的 {game['bet_amount']} 游戏币的对决，"
         f"他的成绩是 {game['creator_score']}。\n"
         f"请发送三次骰子表情来尝试大过他吧！"
@@ -334,6 +471,9 @@ async def join_game(update: Update, context: ContextTypes.DEFAULT_TYPE, game_id:
     context.user_data['dice_count'] = 0
     context.user_data['total_score'] = 0
     context.user_data['bet_amount'] = game['bet_amount']
+    # 标记为挑战者：挑战在投骰期间过期或被取消时，结算时据此退还下注金额
+    context.user_data['joined'] = True
+    return True
 
 async def handle_invite_code(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if 'awaiting_invite_code' not in context.user_data or not context.user_data['awaiting_invite_code']:
@@ -345,7 +485,7 @@ async def handle_invite_code(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     logger.info(f"Attempting to register user {telegram_id} with invite code {invite_code}")
 
-    inviter = get_user_by_invite_code(invite_code)
+    inviter = await run_db(get_user_by_invite_code, invite_code)
     
     if not inviter:
         logger.error(f"Invalid invite code: {invite_code}")
@@ -353,7 +493,7 @@ async def handle_invite_code(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     try:
-        new_user = create_user(telegram_id, username, inviter['id'])
+        new_user = await run_db(create_user, telegram_id, username, inviter['id'])
         if new_user:
             logger.info(f"User {telegram_id} registered successfully")
             welcome_message = f"注册成功！您已通过 @{inviter['username']} 的邀请获得了1000游戏币。"
@@ -372,32 +512,53 @@ async def handle_invite_code(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def show_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    user = get_user_by_telegram_id(str(query.from_user.id))
+    user = await run_db(get_user_by_telegram_id, str(query.from_user.id))
     
     if user:
         await query.edit_message_text(f"您当前的余额是：{user['balance']} 游戏币。", reply_markup=create_main_menu())
     else:
         await query.edit_message_text("未找到您的账户信息，请先注册。", reply_markup=create_main_menu())
 
+# 不带参数的按钮回调；带游标、页码的回调按前缀归类，避免指标标签数量无限增长
+CALLBACK_ACTIONS = {'start_game', 'quick_match', 'game_history', 'invite_earnings', 'balance', 'help', 'cancel_game', 'main_menu'}
+CALLBACK_PREFIXES = ('history_', 'invite_page_', 'quick_match_')
+
+def callback_action(update: Update) -> str:
+    data = update.callback_query.data or ''
+    for prefix in CALLBACK_PREFIXES:
+        if data.startswith(prefix):
+            return prefix.rstrip('_')
+    return data if data in CALLBACK_ACTIONS else 'unknown'
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
 
     if query.data == 'start_game':
         await start_game(update, context)
+    elif query.data == 'quick_match':
+        await show_quick_match(update, context)
+    elif query.data.startswith('quick_match_'):
+        await quick_match(update, context, int(query.data[len('quick_match_'):]))
     elif query.data == 'game_history':
         await show_game_history(update, context)
     elif query.data.startswith('history_'):
-        _, action, page = query.data.split('_')
-        page = int(page)
-        if action == 'prev':
-            await show_game_history(update, context, page - 1)
+        # 格式：history_<action>_<page>_<cursor>，旧消息中的按钮没有游标，回到第一页
+        parts = query.data.split('_', 3)
+        action, page = parts[1], int(parts[2])
+        cursor = parts[3] if len(parts) > 3 and parts[3] else None
+        if not cursor:
+            await show_game_history(update, context)
+        elif action == 'prev':
+            await show_game_history(update, context, page - 1, cursor, 'prev')
         elif action == 'next':
-            await show_game_history(update, context, page + 1)
+            await show_game_history(update, context, page + 1, cursor, 'next')
         elif action == 'refresh':
-            await show_game_history(update, context, page)
+            await show_game_history(update, context, page, cursor, 'at')
     elif query.data == 'invite_earnings':
         await show_invite_earnings(update, context)
+    elif query.data.startswith('invite_page_'):
+        await show_invite_earnings(update, context, int(query.data[len('invite_page_'):]))
     elif query.data == 'balance':
         await show_balance(update, context)
     elif query.data == 'help':
@@ -412,13 +573,13 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 import html
 import urllib.parse
 
-async def show_game_history(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0) -> None:
+async def show_game_history(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0, cursor=None, direction='next') -> None:
     query = update.callback_query
     if query:
         await query.answer()
     
     user_id = update.effective_user.id
-    user = get_user_by_telegram_id(str(user_id))
+    user = await run_db(get_user_by_telegram_id, str(user_id))
     
     logger.info(f"Showing game history for user: {user_id}, page: {page}")
     
@@ -427,9 +588,16 @@ async def show_game_history(update: Update, context: ContextTypes.DEFAULT_TYPE,
         await update.effective_message.reply_text("请先注册后再查看游戏历史。", reply_markup=create_main_menu())
         return
 
-    pending_games = get_user_pending_games(user['id'])
-    completed_games = get_user_game_history(user['id'], status='completed', limit=5, offset=page*5)
-    has_more = len(get_user_game_history(user['id'], status='completed', limit=1, offset=(page+1)*5)) > 0
+    pending_games, (completed_games, has_more) = await asyncio.gather(
+        run_db(get_user_pending_games, user['id']),
+        run_db(get_user_game_history_page, user['id'], status='completed', limit=5, cursor=cursor, direction=direction),
+    )
+    if direction == 'prev' and cursor:
+        # 向前翻页时多取的一条说明前面还有更新的记录，后面一定还有刚离开的那一页
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = page > 0, has_more
+    page = max(page, 0)
     
     logger.info(f"Retrieved {len(completed_games)} completed games and {len(pending_games)} pending games for user: {user_id}")
     
@@ -439,10 +607,11 @@ async def show_game_history(update: Update, context: ContextTypes.DEFAULT_TYPE,
         return
 
     try:
-        # 待分享的对战消息
+        # 待分享的对战与已完成的对战合并为一条消息发送
+        pending_text = ""
+        pending_buttons = []
         if pending_games:
             pending_text = "🕒 待分享的对战：\n\n"
-            pending_buttons = []
             for game in pending_games:
                 invite_message = create_invite_message(user, game, context)
                 invite_link = f"https://t.me/{context.bot.username}?start={game['game_id']}"
@@ -453,12 +622,6 @@ async def show_game_history(update: Update, context: ContextTypes.DEFAULT_TYPE,
                     "分享这个游戏",
                     url=f"https://t.me/share/url?url={invite_link}&text={escaped_message}"
                 )])
-            
-            await update.effective_message.reply_text(
-                pending_text,
-                reply_markup=InlineKeyboardMarkup(pending_buttons),
-                disable_web_page_preview=True
-            )
 
         # 已完成的对战消息
         completed_text = f"✅ 已完成的对战 (第 {page+1} 页)：\n\n"
@@ -466,27 +629,41 @@ async def show_game_history(update: Update, context: ContextTypes.DEFAULT_TYPE,
             for game in completed_games:
                 player_a_name = html.escape(game['player_a_username'] or "未知玩家")
                 player_b_name = html.escape(game['player_b_username'] or "未知玩家")
-                winner_name = player_a_name if game['winner_id'] == game['player_a_id'] else player_b_name
+                if game['winner_id'] is None:
+                    winner_name = "平局"
+                else:
+                    winner_name = player_a_name if game['winner_id'] == game['player_a_id'] else player_b_name
                 completed_text += f"{player_a_name} vs {player_b_name}\n"
                 completed_text += f"下注金额: {game['bet_amount']} 游戏币, 赢家: {winner_name}\n"
                 completed_text += f"得分: {game['player_a_score']} - {game['player_b_score']}\n\n"
         else:
             completed_text += "暂无已完成的对战\n"
 
-        history_keyboard = create_game_history_keyboard(has_more, page)
-        await update.effective_message.reply_text(completed_text, reply_markup=history_keyboard)
+        history_keyboard = create_game_history_keyboard(
+            page,
+            first_cursor=encode_history_cursor(completed_games[0]) if completed_games else None,
+            last_cursor=encode_history_cursor(completed_games[-1]) if completed_games else None,
+            has_prev=has_prev,
+            has_next=has_next,
+        )
+        dispatcher.send_message(
+            update.effective_chat.id,
+            pending_text + completed_text,
+            reply_markup=InlineKeyboardMarkup(pending_buttons + list(history_keyboard.inline_keyboard)),
+            disable_web_page_preview=True,
+        )
 
     except Exception as e:
         logger.error(f"Error in show_game_history: {e}")
         await update.effective_message.reply_text("获取游戏历史时出错，请稍后再试。", reply_markup=create_main_menu())
 
-def create_game_history_keyboard(has_more, page=0):
+def create_game_history_keyboard(page, first_cursor=None, last_cursor=None, has_prev=False, has_next=False):
     keyboard = []
-    if page > 0:
-        keyboard.append(InlineKeyboardButton("上一页", callback_data=f"history_prev_{page}"))
-    if has_more:
-        keyboard.append(InlineKeyboardButton("下一页", callback_data=f"history_next_{page}"))
-    keyboard.append(InlineKeyboardButton("刷新", callback_data=f"history_refresh_{page}"))
+    if has_prev and first_cursor:
+        keyboard.append(InlineKeyboardButton("上一页", callback_data=f"history_prev_{page}_{first_cursor}"))
+    if has_next and last_cursor:
+        keyboard.append(InlineKeyboardButton("下一页", callback_data=f"history_next_{page}_{last_cursor}"))
+    keyboard.append(InlineKeyboardButton("刷新", callback_data=f"history_refresh_{page}_{first_cursor or ''}"))
     keyboard.append(InlineKeyboardButton("返回主菜单", callback_data="main_menu"))
     return InlineKeyboardMarkup([keyboard])
 
@@ -501,9 +678,9 @@ def create_invite_message(user, game, context):
 async def show_pending_games(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     user_id = query.from_user.id
-    user = get_user_by_telegram_id(str(user_id))
+    user = await run_db(get_user_by_telegram_id, str(user_id))
     
-    pending_games = get_user_pending_games(user['id'])
+    pending_games = await run_db(get_user_pending_games, user['id'])
     
     if not pending_games:
         await query.edit_message_text("您没有等待挑战的游戏。", reply_markup=create_main_menu())
@@ -531,9 +708,9 @@ async def show_pending_games(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def show_completed_games(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     user_id = query.from_user.id
-    user = get_user_by_telegram_id(str(user_id))
+    user = await run_db(get_user_by_telegram_id, str(user_id))
     
-    completed_games = get_user_completed_games(user['id'])
+    completed_games = await run_db(get_user_completed_games, user['id'])
     
     if not completed_games:
         await query.edit_message_text("您没有已完成的游戏记录。", reply_markup=create_main_menu())
@@ -569,7 +746,7 @@ def create_invite_message(user, game, context):
     )
 
 def get_user_pending_games(user_id):
-    conn = get_db_connection()
+    conn = get_db_connection(readonly=True)
     try:
         with conn.cursor() as cur:
             cur.execute("""
@@ -583,10 +760,10 @@ def get_user_pending_games(user_id):
         logger.error(f"Error fetching user pending games: {e}")
         return []
     finally:
-        conn.close()
+        put_db_connection(conn)
 
 def get_user_completed_games(user_id):
-    conn = get_db_connection()
+    conn = get_db_connection(readonly=True)
     try:
         with conn.cursor() as cur:
             cur.execute("""
@@ -607,25 +784,39 @@ def get_user_completed_games(user_id):
         logger.error(f"Error fetching user completed games: {e}")
         return []
     finally:
-        conn.close()
+        put_db_connection(conn)
 
-async def show_invite_earnings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def show_invite_earnings(update: Update, context: ContextTypes.DEFAULT_TYPE, after_id=0) -> None:
     query = update.callback_query
-    user = get_user_by_telegram_id(str(query.from_user.id))
+    user = await run_db(get_user_by_telegram_id, str(query.from_user.id))
     if user:
+        reply_markup = create_main_menu()
         if user['invite_code']:
             invite_code = user['invite_code']
-            invited_users = get_invited_users(user['id'])
+            summary, (invited_users, has_more) = await asyncio.gather(
+                run_db(get_invite_summary, user['id']),
+                run_db(get_invited_users, user['id'], after_id),
+            )
             
             message = f"您的邀请码是: {invite_code}\n"
-            message += f"总邀约收益: {user.get('invite_earnings', 0)} 游戏币\n\n"  # 使用 get 方法，如果 'invite_earnings' 不存在，默认为 0
+            message += f"已邀请人数: {summary['invited_count']}\n"
+            message += f"总邀约收益: {summary['total_earnings']} 游戏币\n"
+            message += f"近{INVITE_EARNINGS_WINDOW_DAYS}天收益: {summary['recent_earnings']} 游戏币\n\n"
             message += "已邀请用户:\n"
             for invited_user in invited_users:
                 message += f"- {invited_user['username']}\n"
+
+            keyboard = []
+            if has_more:
+                keyboard.append([InlineKeyboardButton("下一页", callback_data=f"invite_page_{invited_users[-1]['id']}")])
+            if after_id:
+                keyboard.append([InlineKeyboardButton("返回第一页", callback_data='invite_earnings')])
+            keyboard.append([InlineKeyboardButton("返回主菜单", callback_data='main_menu')])
+            reply_markup = InlineKeyboardMarkup(keyboard)
         else:
             message = "您还没有邀请码。完成注册后即可获得专属邀请码。"
         
-        await query.edit_message_text(message, reply_markup=create_main_menu())
+        await query.edit_message_text(message, reply_markup=reply_markup)
     else:
         await query.edit_message_text("未找到您的账户信息，请先注册。", reply_markup=create_main_menu())
         
@@ -633,9 +824,9 @@ async def process_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 这里需要实现实际的充值逻辑
     deposit_successful = False  # 这应该根据实际充值结果来设置
     if deposit_successful:
-        user = get_user_by_telegram_id(str(update.effective_user.id))
+        user = await run_db(get_user_by_telegram_id, str(update.effective_user.id))
         if not user['invite_code']:
-            invite_code = generate_invite_code(user['id'])
+            invite_code = await run_db(generate_invite_code, user['id'])
             await update.message.reply_text(f"充值成功！您的专属邀请码是: {invite_code}", reply_markup=create_main_menu())
         else:
             await update.message.reply_text("充值成功！", reply_markup=create_main_menu())
@@ -646,9 +837,9 @@ async def process_withdrawal(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # 这里需要实现实际的提现逻辑
     withdrawal_successful = False  # 这应该根据实际提现结果来设置
     if withdrawal_successful:
-        user = get_user_by_telegram_id(str(update.effective_user.id))
+        user = await run_db(get_user_by_telegram_id, str(update.effective_user.id))
         if not user['invite_code']:
-            invite_code = generate_invite_code(user['id'])
+            invite_code = await run_db(generate_invite_code, user['id'])
             await update.message.reply_text(f"提现成功！您的专属邀请码是: {invite_code}", reply_markup=create_main_menu())
         else:
             await update.message.reply_text("提现成功！", reply_markup=create_main_menu())
@@ -667,7 +858,7 @@ async def show_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def start_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    user = get_user_by_telegram_id(str(query.from_user.id))
+    user = await run_db(get_user_by_telegram_id, str(query.from_user.id))
     
     if not user:
         await query.edit_message_text("请先注册后再开始游戏。", reply_markup=create_main_menu())
@@ -685,14 +876,17 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # 检查游戏状态
         game_state = context.user_data.get('game_state', 'idle')
         
+        # 等待邀请码的新用户还没有游戏状态，需要先于空闲判断处理
+        if 'awaiting_invite_code' in context.user_data and context.user_data['awaiting_invite_code']:
+            await handle_invite_code(update, context)
+            return
+
         if game_state == 'idle':
             # 如果游戏状态是空闲，只显示主菜单
             await update.message.reply_text("请选择一个操作：", reply_markup=create_main_menu())
             return
         
-        if 'awaiting_invite_code' in context.user_data and context.user_data['awaiting_invite_code']:
-            await handle_invite_code(update, context)
-        elif game_state == 'awaiting_bet':
+        if game_state == 'awaiting_bet':
             await process_bet(update, context)
         else:
             # 如果不是以上任何状态，显示主菜单
@@ -705,7 +899,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         context.user_data['game_state'] = 'idle'
 
 async def process_bet(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = get_user_by_telegram_id(str(update.message.from_user.id))
+    user = await run_db(get_user_by_telegram_id, str(update.message.from_user.id))
     try:
         bet_amount = int(update.message.text)
     except ValueError:
@@ -716,56 +910,108 @@ async def process_bet(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         await update.message.reply_text("下注金额必须是100的倍数，最小100，最大1000。请重新输入：")
         return
 
-    if user['balance'] < bet_amount:
+    if not await create_pending_game(update, context, user, bet_amount):
         await update.message.reply_text("余额不足，请重新输入较小的金额：")
-        return
-
-    # 立即扣除下注金额
-    update_user_balance(user['telegram_id'], -bet_amount)
 
+async def create_pending_game(update: Update, context: ContextTypes.DEFAULT_TYPE, user, bet_amount) -> bool:
+    # 立即扣除下注金额，余额不足时不会扣款，返回 False
     game_id = str(uuid.uuid4())
+    new_balance = await run_db(debit_user_balance, user['telegram_id'], bet_amount, kind='bet', ref=game_id)
+    if new_balance is None:
+        return False
+
     context.user_data['game_id'] = game_id
     context.user_data['bet_amount'] = bet_amount
     context.user_data['dice_count'] = 0
     context.user_data['total_score'] = 0
     context.user_data['game_state'] = 'rolling_dice'
     
-    # 添加游戏历史记录，状态为 'pending'
-    add_game_history(game_id, user['id'], None, bet_amount, 0, 0, None, 0, 'pending')
-
-    if 'pending_games' not in context.bot_data:
-        context.bot_data['pending_games'] = {}
-    context.bot_data['pending_games'][game_id] = {
-        'game_id': game_id,
-        'bet_amount': bet_amount,
-        'creator_id': user['id'],
-        'creator_score': 0
-    }
-    
-    await update.message.reply_text("请发送骰子表情来进行游戏。您需要发送3次骰子。")
+    # 添加游戏历史记录，状态为 'pending'，同时写入待对战索引
+    try:
+        await run_db(pending_store.create, game_id, user['id'], bet_amount)
+    except psycopg2.Error:
+        # 创建失败时退还已扣除的下注金额
+        await run_db(update_user_balance, user['telegram_id'], bet_amount, kind='refund', ref=game_id)
+        raise
+
+    await update.effective_message.reply_text("请发送骰子表情来进行游戏。您需要发送3次骰子。")
+    return True
+
+async def show_quick_match(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    depth = order_book.depth()
+    keyboard = [
+        [InlineKeyboardButton(f"{bet} ({depth[bet]})", callback_data=f'quick_match_{bet}') for bet in BET_TIERS[i:i + 5]]
+        for i in range(0, len(BET_TIERS), 5)
+    ]
+    keyboard.append([InlineKeyboardButton("返回主菜单", callback_data='main_menu')])
+    await update.callback_query.edit_message_text(
+        "请选择下注金额，系统会为您匹配该金额下最早发起的挑战（括号内为等待中的挑战数）。\n"
+        "没有可匹配的挑战时，将以该金额为您发起新的挑战。",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def quick_match(update: Update, context: ContextTypes.DEFAULT_TYPE, bet_amount: int) -> None:
+    query = update.callback_query
+    user = await run_db(get_user_by_telegram_id, str(query.from_user.id))
+    if not user:
+        await query.edit_message_text("请先注册后再开始游戏。", reply_markup=create_main_menu())
+        return
+    if bet_amount not in BET_TIERS:
+        await query.edit_message_text("未知的操作。", reply_markup=create_main_menu())
+        return
+    if context.user_data.get('game_state') == 'rolling_dice':
+        await query.edit_message_text("您有一局对战尚未完成，请先发送骰子表情。")
+        return
+    if user['balance'] < bet_amount:
+        await query.edit_message_text("余额不足，请选择较小的金额。", reply_markup=create_main_menu())
+        return
+
+    while True:
+        matched = order_book.match(bet_amount, user['id'])
+        if matched is None:
+            break
+        game_id, creator_id = matched
+        if game_id not in pending_store:
+            # 已结束但尚未移出队列的挑战，继续匹配下一个
+            continue
+        await query.edit_message_text(f"已为您匹配到 {bet_amount} 游戏币的挑战。")
+        if not await join_game(update, context, game_id) and game_id in pending_store:
+            # 加入失败（例如余额在此期间不足），挑战放回队首
+            order_book.add(game_id, bet_amount, creator_id, front=True)
+        return
+
+    # 没有可匹配的挑战：以该金额发起新挑战，创建者掷完骰子后进入匹配队列
+    await query.edit_message_text(f"暂时没有 {bet_amount} 游戏币的挑战，已为您发起新的挑战。")
+    if not await create_pending_game(update, context, user, bet_amount):
+        await query.edit_message_text("余额不足，请选择较小的金额。", reply_markup=create_main_menu())
 
 async def cancel_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
 
-    user = get_user_by_telegram_id(str(query.from_user.id))
     game_id = context.user_data.get('game_id')
-    
-    if game_id and game_id in context.bot_data.get('pending_games', {}):
-        game = context.bot_data['pending_games'][game_id]
-        bet_amount = game['bet_amount']
-        
-        # 退还下注金额
-        update_user_balance(user['telegram_id'], bet_amount)
-        
-        # 清理游戏数据
-        del context.bot_data['pending_games'][game_id]
+    refunded = 0
+
+    if game_id and context.user_data.get('joined'):
+        # 挑战者放弃对战：只退还自己加入时扣除的下注，创建者的挑战保持不变，并重新进入匹配队列
+        refunded = context.user_data.get('bet_amount', 0)
+        await run_db(update_user_balance, str(query.from_user.id), refunded, kind='refund', ref=game_id)
+        game = pending_store.get(game_id)
+        if game and game['creator_score']:
+            order_book.add(game_id, game['bet_amount'], game['creator_id'], front=True)
+    elif game_id:
+        # 只有创建者可以取消挑战，取消时退还创建者的下注金额
+        game = pending_store.get(game_id)
+        user = await run_db(get_user_by_telegram_id, str(query.from_user.id))
+        if game and user and game['creator_id'] == user['id']:
+            refunded = await run_db(pending_store.cancel, game_id)
 
     # 重置用户数据
     context.user_data.clear()
     context.user_data['game_state'] = 'idle'
 
-    await query.edit_message_text("游戏已取消，下注金额已退还。", reply_markup=create_main_menu())
+    message = "游戏已取消，下注金额已退还。" if refunded else "游戏已取消。"
+    await query.edit_message_text(message, reply_markup=create_main_menu())
 
 
 async def handle_dice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -786,26 +1032,22 @@ async def handle_dice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             game_id = context.user_data['game_id']
             total_score = context.user_data['total_score']
             bet_amount = context.user_data['bet_amount']
-            game = context.bot_data['pending_games'].get(game_id)
+            game = pending_store.get(game_id)
             
-            user = get_user_by_telegram_id(str(update.effective_user.id))
+            user = await run_db(get_user_by_telegram_id, str(update.effective_user.id))
             
-            if game and game['creator_id'] != user['id']:
+            if context.user_data.get('joined') or (game and game['creator_id'] != user['id']):
                 # 这是挑战者
                 await finish_game(update, context, game_id, total_score)
             else:
-                # 这是游戏创建者，生成邀请链接
-                context.bot_data['pending_games'][game_id] = {
-                    'bet_amount': bet_amount,
-                    'creator_id': user['id'],
-                    'creator_score': total_score
-                }
+                # 这是游戏创建者，保存得分并生成邀请链接
+                await run_db(pending_store.set_creator_score, game_id, total_score)
                 
                 invite_link = f"https://t.me/{context.bot.username}?start={game_id}"
                 
                 await update.message.reply_text(
-                    f"您已下注 {bet_amount} 游戏币，您的总得分是 {total_score}。\n\n"
-                    f"分享以下消息邀请对手："
+                    f"您已下注 {bet_amount} 游戏币，您的总得分是 {total_score}。\n"
+                    f"挑战已进入快速匹配队列，也可以分享以下消息邀请对手："
                 )
 
                 invite_message = (
@@ -828,53 +1070,50 @@ async def handle_dice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         # 重置游戏状态
         context.user_data.clear()
         context.user_data['game_state'] = 'idle'
-        if 'game_id' in context.user_data:
-            game_id = context.user_data['game_id']
-            if game_id in context.bot_data.get('pending_games', {}):
-                del context.bot_data['pending_games'][game_id]
-                
+
 async def finish_game(update: Update, context: ContextTypes.DEFAULT_TYPE, game_id: str, challenger_score: int):
-    game = context.bot_data['pending_games'].get(game_id)
+    game = pending_store.get(game_id)
     if not game:
-        await update.message.reply_text("游戏已结束或不存在。", reply_markup=create_main_menu())
+        # 挑战者加入时已扣款，挑战在此期间过期或被取消，退还下注金额
+        await run_db(update_user_balance, str(update.effective_user.id), context.user_data['bet_amount'],
+                     kind='refund', ref=game_id)
+        await update.message.reply_text("游戏已结束或已过期，您的下注金额已退还。", reply_markup=create_main_menu())
+        context.user_data.clear()
         return
 
-    creator = get_user_by_id(game['creator_id'])
-    challenger = get_user_by_telegram_id(str(update.effective_user.id))
+    creator = await run_db(get_user_by_id, game['creator_id'])
+    challenger = await run_db(get_user_by_telegram_id, str(update.effective_user.id))
     
     creator_score = game['creator_score']
     bet_amount = game['bet_amount']
 
-    if challenger_score > creator_score:
-        winner = challenger
-        loser = creator
-    elif challenger_score < creator_score:
-        winner = creator
-        loser = challenger
-    else:
-        # 平局，退还下注金额
-        update_user_balance(creator['telegram_id'], bet_amount)
-        update_user_balance(challenger['telegram_id'], bet_amount)
+    # 在同一个事务中完成赢家、上级邀约者、项目方入账以及对战记录更新
+    result = await run_db(settle_game, game_id, creator['id'], challenger['id'], bet_amount, creator_score, challenger_score)
+    if not result:
+        await run_db(update_user_balance, challenger['telegram_id'], bet_amount, kind='refund', ref=game_id)
+        await update.message.reply_text("游戏已结束或已过期，您的下注金额已退还。", reply_markup=create_main_menu())
+        pending_store.remove(game_id)
+        context.user_data.clear()
+        return
+
+    if result['winner_id'] is None:
         tie_message = f"游戏结束！双方平局，各自的分数是 {challenger_score}。下注金额已退还。"
-        await update.message.reply_text(tie_message, reply_markup=create_main_menu())
-        await context.bot.send_message(
-            chat_id=creator['telegram_id'],
-            text=tie_message,
-            reply_markup=create_main_menu()
-        )
+        dispatcher.send_message(update.effective_chat.id, tie_message, priority=PRIORITY_RESULT, reply_markup=create_main_menu())
+        dispatcher.send_message(creator['telegram_id'], tie_message, priority=PRIORITY_RESULT, reply_markup=create_main_menu())
         # 清理游戏数据
-        del context.bot_data['pending_games'][game_id]
+        pending_store.remove(game_id)
         context.user_data.clear()
         return
 
-    # 计算赢家获得的奖金（下注金额的90%）
-    win_amount = bet_amount * 0.9
-
-    # 计算上级邀约者的7%收益
-    inviter_amount = bet_amount * 0.07
+    if result['winner_id'] == challenger['id']:
+        winner = challenger
+        loser = creator
+    else:
+        winner = creator
+        loser = challenger
 
-    # 计算项目方的3%收益
-    project_amount = bet_amount * 0.03
+    # 赢家获得的奖金（下注金额的90%）
+    win_amount = result['win_amount']
 
     # 发送结果通知
     winner_message = (
@@ -888,35 +1127,24 @@ async def finish_game(update: Update, context: ContextTypes.DEFAULT_TYPE, game_i
         f"很遗憾，您输掉了 {bet_amount} 游戏币。"
     )
 
-    # 发送消息给挑战者
-    await update.message.reply_text(
+    # 发送消息给挑战者（由出站调度器限速发送，处理函数不等待发送完成）
+    dispatcher.send_message(
+        update.effective_chat.id,
         winner['id'] == challenger['id'] and winner_message or loser_message,
+        priority=PRIORITY_RESULT,
         reply_markup=create_main_menu()
     )
     
     # 发送消息给创建者
-    await context.bot.send_message(
-        chat_id=creator['telegram_id'],
-        text=winner['id'] == creator['id'] and winner_message or loser_message,
+    dispatcher.send_message(
+        creator['telegram_id'],
+        winner['id'] == creator['id'] and winner_message or loser_message,
+        priority=PRIORITY_RESULT,
         reply_markup=create_main_menu()
     )
 
-    # 更新赢家余额（下注金额的190%）
-    update_balance_amount = bet_amount * 1.9
-    update_user_balance(winner['telegram_id'], update_balance_amount)
-
-    # 处理上级邀约者的7%收益
-    inviter = get_user_by_id(winner.get('inviter_id'))
-    if inviter:
-        update_user_balance(inviter['telegram_id'], inviter_amount, is_invite_earning=True)
-
-    # 处理项目方的3%收益
-    project_account = get_user_by_id(1)  # 假设项目方账户的ID为1
-    if project_account:
-        update_user_balance(project_account['telegram_id'], project_amount)
-
     # 清理游戏数据
-    del context.bot_data['pending_games'][game_id]
+    pending_store.remove(game_id)
     
     # 清理挑战者的用户数据
     context.user_data.clear()
@@ -927,9 +1155,6 @@ async def finish_game(update: Update, context: ContextTypes.DEFAULT_TYPE, game_i
         if user_data:
             user_data.clear()
 
-    # 添加游戏历史记录
-    add_game_history(game_id, creator['id'], challenger['id'], bet_amount, creator_score, challenger_score, winner['id'], win_amount, 'completed')
-
     # 重置游戏状态
     context.user_data['game_state'] = 'idle'
 async def show_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -939,7 +1164,7 @@ async def show_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.callback_query.answer()
         await update.callback_query.edit_message_text("请选择以下操作：", reply_markup=create_main_menu())
 
-def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.error(f"Exception while handling an update: {context.error}", exc_info=True)
     
     if isinstance(context.error, telegram.error.BadRequest) and "Message is not modified" in str(context.error):
@@ -949,28 +1174,148 @@ def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     if update and isinstance(update, Update) and update.effective_message:
         error_message = "处理您的请求时发生错误。请稍后再试。"
         try:
-            update.effective_message.reply_text(error_message)
+            await update.effective_message.reply_text(error_message)
         except Exception as e:
             logger.error(f"Failed to send error message: {e}")
 
-def main() -> None:
+async def expire_pending_games(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # 分批过期超时的挑战并退还下注，每批一条语句；按创建者合并通知
+    refunds = {}
+    expired = 0
+    while True:
+        rows = await run_db(pending_store.expire, PENDING_GAME_TTL, EXPIRY_SWEEP_BATCH)
+        expired += len(rows)
+        for row in rows:
+            if row['telegram_id']:
+                games, amount = refunds.get(row['telegram_id'], (0, 0))
+                refunds[row['telegram_id']] = (games + 1, amount + row['bet_amount'])
+        if len(rows) < EXPIRY_SWEEP_BATCH:
+            break
+
+    if not expired:
+        return
+    for telegram_id, (games, amount) in refunds.items():
+        dispatcher.send_message(
+            telegram_id,
+            f"您发起的 {games} 个挑战超时无人加入，已自动取消并退还 {amount} 游戏币。",
+            priority=PRIORITY_NORMAL,
+            reply_markup=create_main_menu()
+        )
+    logger.info(f"Expired {expired} pending games, refunded {len(refunds)} creators")
+
+async def rollup_fees(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # 把结算时追加的项目方、邀约者手续费汇总进账户余额
+    while await run_db(rollup_fee_accruals, FEE_ROLLUP_BATCH) == FEE_ROLLUP_BATCH:
+        pass
+
+async def take_balance_snapshots(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # 为余额有变动的用户写入快照，查询历史余额时只需读取快照之后的少量流水
+    await run_db(snapshot_balances)
+
+async def sample_metrics(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # user_data 只在事件循环中修改，在这里遍历；指标线程只读取采样结果
+    metrics.rolling_dice_sessions.set(sum(
+        1 for data in context.application.user_data.values() if data.get('game_state') == 'rolling_dice'))
+    processor = context.application.update_processor
+    if isinstance(processor, PerUserUpdateProcessor):
+        metrics.updates_max_user_depth.set(processor.max_user_depth())
+
+async def post_init(application: Application) -> None:
+    # 一次性启动阶段：检查结构版本、官方账户，再从数据库预热待对战索引，重启后未完成的挑战仍可加入
+    await run_db(bootstrap)
+    await run_db(pending_store.load)
+    dispatcher.start(application.bot)
+
+    metrics.pending_games.set_function(lambda: len(pending_store))
+    metrics.open_challenges.set_function(lambda: len(order_book))
+    metrics.db_pool_in_use.set_function(lambda: get_pool().metrics()['in_use'])
+    metrics.outbound_queue.set_function(lambda: len(dispatcher))
+    processor = application.update_processor
+    if isinstance(processor, PerUserUpdateProcessor):
+        # 计数只在事件循环中增减，指标线程只读取整数
+        metrics.updates_in_flight.set_function(lambda: processor.active)
+        metrics.updates_waiting.set_function(lambda: processor.queued)
+        metrics.updates_backlogged_users.set_function(lambda: processor.backlogged_users)
+    metrics.start_server()
+    logger.info(f"Cold start finished in {time.monotonic() - STARTED_AT:.2f}s")
+
+async def post_stop(application: Application) -> None:
+    # 更新处理停止后、Bot 连接关闭前，发完排队中的消息，并把剩余的手续费入账
+    await dispatcher.stop()
     try:
-        application = Application.builder().token(BOT_TOKEN).build()
+        await rollup_fees(None)
+    except psycopg2.Error:
+        # 未汇总的记录保留在 fee_accruals 中，下次启动后继续入账
+        pass
+
+async def post_shutdown(application: Application) -> None:
+    # 应用停止后先等待进行中的数据库操作完成，再释放连接池中的所有连接
+    metrics.stop_server()
+    shutdown_executor()
+    close_pool()
+    logger.info(f"User cache stats: {user_cache.stats()}")
+
+def run_webhook(application: Application) -> None:
+    if not WEBHOOK_URL:
+        raise ValueError("webhook 模式需要在 .env 文件中配置 WEBHOOK_URL")
+    if not WEBHOOK_SECRET_TOKEN:
+        logger.warning("WEBHOOK_SECRET_TOKEN is not set, webhook requests will not be verified")
+
+    # 内置 HTTP 服务器接收更新；收到停止信号后 Application.stop() 会先处理完已入队的更新再退出。
+    # 停机时不删除 webhook，重新部署期间 Telegram 会暂存更新，新进程启动后继续投递。
+    logger.info(f"Starting webhook on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+    application.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET_TOKEN,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=Update.ALL_TYPES,
+    )
 
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-        application.add_handler(CallbackQueryHandler(button_callback))
-        application.add_handler(MessageHandler(filters.Dice.ALL, handle_dice))
-        
-        application.add_handler(MessageHandler(filters.ALL, show_menu))
+def build_application(token=BOT_TOKEN, request=None) -> Application:
+    builder = Application.builder().token(token).post_init(post_init).post_stop(post_stop).post_shutdown(post_shutdown)
+    if request is not None:
+        # 压测时注入模拟的 Telegram API
+        builder = builder.request(request).get_updates_request(request)
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES, MAX_PENDING_UPDATES))
+    application = builder.build()
+
+    # 注册时包装处理函数记录耗时；处理函数之间的内部调用不重复计时
+    application.add_handler(CommandHandler("start", metrics.instrument_handler('start')(start)))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, metrics.instrument_handler('handle_message')(handle_message)))
+    application.add_handler(CallbackQueryHandler(metrics.instrument_handler('button_callback', callback_action)(button_callback)))
+    application.add_handler(MessageHandler(filters.Dice.ALL, metrics.instrument_handler('handle_dice')(handle_dice)))
+    
+    application.add_handler(MessageHandler(filters.ALL, metrics.instrument_handler('show_menu')(show_menu)))
+
+    application.add_error_handler(error_handler)
 
-        application.add_error_handler(error_handler)
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(expire_pending_games, interval=EXPIRY_SWEEP_INTERVAL, first=EXPIRY_SWEEP_INTERVAL)
+        application.job_queue.run_repeating(rollup_fees, interval=FEE_ROLLUP_INTERVAL, first=FEE_ROLLUP_INTERVAL)
+        application.job_queue.run_repeating(take_balance_snapshots, interval=BALANCE_SNAPSHOT_INTERVAL,
+                                            first=BALANCE_SNAPSHOT_INTERVAL)
+        application.job_queue.run_repeating(sample_metrics, interval=METRICS_SAMPLE_INTERVAL, first=0)
+    else:
+        logger.warning("JobQueue is unavailable (install python-telegram-bot[job-queue]), pending games will not expire, "
+                       "fees will only be credited at shutdown, balances will not be snapshotted "
+                       "and rolling dice sessions will not be sampled")
+    return application
+
+def main() -> None:
+    try:
+        application = build_application()
+        if BOT_MODE == 'webhook':
+            run_webhook(application)
+        else:
+            application.run_polling(allowed_updates=Update.ALL_TYPES)
     except Exception as e:
         logger.error(f"Error in main: {e}")
 
 if __name__ == '__main__':
-    create_tables()
     main()
 
 
@@ -15,3 +15,89 @@ DB_PASSWORD = os.getenv('DB_PASSWORD')
 DB_NAME = os.getenv('DB_NAME')
 DB_PORT = os.getenv('DB_PORT')
 DB_SSL = os.getenv('DB_SSL')
+DB_URL = os.getenv('DB_URL')
+# 本地开发或压测使用不带 SSL 的 PostgreSQL 时可设为 disable
+DB_SSLMODE = os.getenv('DB_SSLMODE', 'require')
+
+# 只读副本：历史记录、邀约页面等只读查询优先发往副本；复制延迟超过上限（秒）或副本不可用时回退到主库，
+# 每隔 DB_REPLICA_CHECK_INTERVAL 秒检查一次延迟
+DB_REPLICA_URL = os.getenv('DB_REPLICA_URL')
+DB_REPLICA_MAX_LAG = float(os.getenv('DB_REPLICA_MAX_LAG', '5'))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv('DB_REPLICA_CHECK_INTERVAL', '5'))
+
+# 数据库连接池配置
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '1'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+# 空闲超过该秒数的连接会被回收（保留最小连接数）
+DB_POOL_MAX_IDLE = float(os.getenv('DB_POOL_MAX_IDLE', '300'))
+# 空闲超过该秒数的连接在取出前先做一次 SELECT 1 健康检查
+DB_POOL_HEALTH_CHECK_INTERVAL = float(os.getenv('DB_POOL_HEALTH_CHECK_INTERVAL', '30'))
+# 连接池耗尽时的最长等待秒数
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+
+# 语句级剖析（默认关闭）：按语句指纹统计耗时，超过阈值（毫秒）的记为慢查询；
+# 慢查询按采样比例额外执行 EXPLAIN 记录执行计划（0 表示不抓取）
+DB_QUERY_PROFILING = os.getenv('DB_QUERY_PROFILING', '0') == '1'
+DB_SLOW_QUERY_MS = float(os.getenv('DB_SLOW_QUERY_MS', '200'))
+DB_EXPLAIN_SAMPLE_RATE = float(os.getenv('DB_EXPLAIN_SAMPLE_RATE', '0'))
+
+# 执行数据库操作的线程数，默认与连接池上限一致
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', str(DB_POOL_MAX_SIZE)))
+
+# 项目方账户在 users 表中的 id，用于收取每局 3% 的手续费
+PROJECT_ACCOUNT_ID = int(os.getenv('PROJECT_ACCOUNT_ID', '1'))
+
+# 用户行缓存：最大条目数与存活秒数
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '30'))
+
+# 邀约收益页面：近期收益统计的天数、每页显示的下线人数
+INVITE_EARNINGS_WINDOW_DAYS = int(os.getenv('INVITE_EARNINGS_WINDOW_DAYS', '7'))
+INVITED_USERS_PAGE_SIZE = int(os.getenv('INVITED_USERS_PAGE_SIZE', '20'))
+
+# 运行模式：polling（默认）或 webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# webhook 模式配置：对外地址（如 https://example.com）、本地监听地址与端口、回调路径
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+# Telegram 会在 X-Telegram-Bot-Api-Secret-Token 请求头中带上该值，不匹配的请求被拒绝
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')
+# Telegram 向 webhook 同时发起的最大连接数（1-100）
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+
+# 同时处理的更新数上限；大于 1 时不同用户的更新并发处理，同一用户仍按顺序处理
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '1'))
+# 已接收（排队与处理中）的更新数上限，超出后新的更新等待，不再继续堆积
+MAX_PENDING_UPDATES = int(os.getenv('MAX_PENDING_UPDATES', str(CONCURRENT_UPDATES * 10)))
+
+# 出站消息调度：全局每秒条数、单个聊天每秒条数与突发上限、队列上限、并发发送数、网络错误重试次数
+DISPATCH_GLOBAL_RATE = float(os.getenv('DISPATCH_GLOBAL_RATE', '30'))
+DISPATCH_CHAT_RATE = float(os.getenv('DISPATCH_CHAT_RATE', '1'))
+DISPATCH_CHAT_BURST = float(os.getenv('DISPATCH_CHAT_BURST', '3'))
+DISPATCH_QUEUE_SIZE = int(os.getenv('DISPATCH_QUEUE_SIZE', '10000'))
+DISPATCH_CONCURRENCY = int(os.getenv('DISPATCH_CONCURRENCY', '8'))
+DISPATCH_MAX_RETRIES = int(os.getenv('DISPATCH_MAX_RETRIES', '3'))
+
+# Prometheus 格式指标的 HTTP 端点（/metrics），端口设为 0 时不启动
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9464'))
+# 需要遍历内存状态的指标（例如掷骰中的会话数）由定时任务在事件循环中采样，采样间隔秒数
+METRICS_SAMPLE_INTERVAL = float(os.getenv('METRICS_SAMPLE_INTERVAL', '15'))
+
+# 待对战挑战的存活秒数，超时无人加入则标记为 expired 并退还下注；清理任务的执行间隔与每批处理行数
+PENDING_GAME_TTL = int(os.getenv('PENDING_GAME_TTL', '86400'))
+EXPIRY_SWEEP_INTERVAL = float(os.getenv('EXPIRY_SWEEP_INTERVAL', '300'))
+EXPIRY_SWEEP_BATCH = int(os.getenv('EXPIRY_SWEEP_BATCH', '5000'))
+
+# 项目方与邀约者的手续费先记入 fee_accruals，按该间隔（秒）汇总入账，每批最多处理的记录数
+FEE_ROLLUP_INTERVAL = float(os.getenv('FEE_ROLLUP_INTERVAL', '10'))
+FEE_ROLLUP_BATCH = int(os.getenv('FEE_ROLLUP_BATCH', '10000'))
+
+# 邀请码由用户 id 经该密钥置换后编码生成（见 invite_codes.py）。生产环境务必设置，且一经使用不能更改，
+# 否则已发出的邀请码将无法解码
+INVITE_CODE_KEY = os.getenv('INVITE_CODE_KEY', 'mahjong-invite-code')
+
+# 余额快照的间隔（秒）
+BALANCE_SNAPSHOT_INTERVAL = float(os.getenv('BALANCE_SNAPSHOT_INTERVAL', '3600'))
@@ -1,68 +1,32 @@
 import os
 import psycopg2
-from psycopg2.extras import RealDictCursor
 from dotenv import load_dotenv
-import random
-import string
+import logging
+from db_pool import get_db_connection, put_db_connection
+from migrations import ensure_schema
+from config import PROJECT_ACCOUNT_ID
+import invite_codes
 
 load_dotenv()
 
 DB_URL = os.getenv('DB_URL')
 
-def get_db_connection():
-    return psycopg2.connect(DB_URL, sslmode='require', cursor_factory=RealDictCursor)
+logger = logging.getLogger(__name__)
 
-def create_tables():
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                telegram_id TEXT UNIQUE,
-                username TEXT,
-                invite_code TEXT UNIQUE,
-                balance INTEGER DEFAULT 1000,
-                inviter_id INTEGER REFERENCES users(id),
-                created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        
-        # 创建游戏历史表
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS game_histories (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER REFERENCES users(id),
-                bet_amount INTEGER,
-                result TEXT,
-                profit INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')    
+OFFICIAL_ACCOUNT_TELEGRAM_ID = "project_account_id"
 
-        # 创建游戏待对战表
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS game_history (
-                id SERIAL PRIMARY KEY,
-                creator_id INTEGER REFERENCES users(id),
-                joiner_id INTEGER REFERENCES users(id),
-                bet_amount INTEGER,
-                creator_score INTEGER,
-                joiner_score INTEGER,
-                winner_id INTEGER REFERENCES users(id),
-                status TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-    conn.commit()
-    conn.close()
+def create_tables():
+    # 表结构由 migrations.py 中的版本化迁移统一管理，版本已是最新时不执行 DDL
+    ensure_schema()
 
 def get_user_by_telegram_id(telegram_id):
     conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute("SELECT * FROM users WHERE telegram_id = %s", (telegram_id,))
-        user = cur.fetchone()
-    conn.close()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT * FROM users WHERE telegram_id = %s", (telegram_id,))
+            user = cur.fetchone()
+    finally:
+        put_db_connection(conn)
     return user
 def get_invited_users(user_id):
        # 实现获取邀请用户的逻辑
@@ -75,14 +39,21 @@ def get_user_by_invite_code(invite_code):
     conn = get_db_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT * FROM users WHERE invite_code = %s", (invite_code,))
+            user_id = invite_codes.decode(invite_code)
+            # 旧邀请码优先，与 bot.get_user_by_invite_code 一致
+            cur.execute("""
+                (SELECT * FROM users WHERE legacy_invite_code = %s LIMIT 1)
+                UNION ALL
+                SELECT * FROM users WHERE id = %s AND invite_code = %s
+                LIMIT 1
+            """, (invite_code.strip().upper(), user_id, invite_codes.encode(user_id) if user_id else None))
             user = cur.fetchone()
         return user
     except psycopg2.Error as e:
         print(f"Error fetching user by invite code: {e}")
         return None
     finally:
-        conn.close()
+        put_db_connection(conn)
 def get_user_game_history(user_id):
     conn = get_db_connection()
     try:
@@ -95,89 +66,91 @@ def get_user_game_history(user_id):
             history = cur.fetchall()
         return history
     finally:
-        conn.close()
-def create_user(telegram_id, username, inviter_id=None):
-    conn = get_db_connection()
-    invite_code = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-    try:
-        with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO users (telegram_id, username, invite_code, inviter_id, balance) VALUES (%s, %s, %s, %s, 1000) RETURNING *",
-                (telegram_id, username, invite_code, inviter_id)
-            )
-            new_user = cur.fetchone()
-        conn.commit()
-        return new_user
-    except psycopg2.Error as e:
-        print(f"Error creating user: {e}")
-        conn.rollback()
-        return None
-    finally:
-        conn.close()
-def create_tables():
-    conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                telegram_id TEXT UNIQUE,
-                username TEXT,
-                invite_code TEXT UNIQUE,
-                balance INTEGER DEFAULT 1000,
-                inviter_id INTEGER REFERENCES users(id),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
-        conn.commit()
-    conn.close()
-
+        put_db_connection(conn)
 # 在主函数中调用这个函数
 if __name__ == '__main__':
     create_tables()
 
-def update_user_balance(telegram_id, amount):
+def update_user_balance(telegram_id, amount, kind='adjustment', ref=None):
     conn = get_db_connection()
-    with conn.cursor() as cur:
-        cur.execute("UPDATE users SET balance = balance + %s WHERE telegram_id = %s", (amount, telegram_id))
-    conn.commit()
-    conn.close()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                WITH updated AS (
+                    UPDATE users SET balance = balance + %s WHERE telegram_id = %s RETURNING id
+                )
+                INSERT INTO balance_ledger (user_id, amount, kind, ref)
+                SELECT id, %s, %s, %s FROM updated
+            """, (amount, telegram_id, amount, kind, ref))
+        conn.commit()
+    finally:
+        put_db_connection(conn)
 
 def add_game_history(game_id, player_a_id, player_a_score, player_b_id, player_b_score, winner_id, bet_amount, win_amount):
     conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO game_history (game_id, player_a_id, player_a_score, player_b_id, player_b_score, winner_id, bet_amount, win_amount)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-    """, (game_id, player_a_id, player_a_score, player_b_id, player_b_score, winner_id, bet_amount, win_amount))
-    conn.commit()
-    cur.close()
-    conn.close()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO game_history (game_id, player_a_id, player_a_score, player_b_id, player_b_score, winner_id, bet_amount, win_amount)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        """, (game_id, player_a_id, player_a_score, player_b_id, player_b_score, winner_id, bet_amount, win_amount))
+        conn.commit()
+        cur.close()
+    finally:
+        put_db_connection(conn)
 
 def get_user_game_history(user_id):
     conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-    cur.execute("""
-        SELECT * FROM game_history 
-        WHERE player_a_id = %s OR player_b_id = %s
-        ORDER BY created_at DESC
-        LIMIT 10
-    """, (user_id, user_id))
-    history = cur.fetchall()
-    cur.close()
-    conn.close()
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        cur.execute("""
+            SELECT * FROM game_history 
+            WHERE player_a_id = %s OR player_b_id = %s
+            ORDER BY created_at DESC
+            LIMIT 10
+        """, (user_id, user_id))
+        history = cur.fetchall()
+        cur.close()
+    finally:
+        put_db_connection(conn)
     return history
 
-# 初始化数据库
-create_tables()
-
-# 创建官方账户（如果不存在）
+# 创建官方账户（如果不存在），在启动阶段显式调用，导入本模块不会访问数据库
 def ensure_official_account():
-    official_user = get_user_by_telegram_id("project_account_id")
-    if not official_user:
-        create_user("project_account_id", "OfficialAccount")
-        print("Official account created")
-    else:
-        print("Official account already exists")
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                WITH inserted AS (
+                    INSERT INTO users (telegram_id, username, balance)
+                    VALUES (%s, 'OfficialAccount', 1000)
+                    ON CONFLICT DO NOTHING
+                    RETURNING id, balance
+                ),
+                ledger AS (
+                    INSERT INTO balance_ledger (user_id, amount, kind)
+                    SELECT id, balance, 'signup' FROM inserted
+                )
+                SELECT id, TRUE AS created FROM inserted
+                UNION ALL
+                SELECT id, FALSE AS created FROM users WHERE telegram_id = %s
+                LIMIT 1
+            """, (OFFICIAL_ACCOUNT_TELEGRAM_ID, OFFICIAL_ACCOUNT_TELEGRAM_ID))
+            account = cur.fetchone()
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        logger.error(f"Error ensuring official account: {e}")
+        raise
+    finally:
+        put_db_connection(conn)
 
-ensure_official_account()
\ No newline at end of file
+    if account is None:
+        # 插入与查询之间官方账户被并发删除，下次启动时重试
+        logger.error("Official account could not be created")
+        return None
+    if account['created']:
+        logger.info(f"Official account created with id {account['id']}")
+    if account['id'] != PROJECT_ACCOUNT_ID:
+        logger.warning(f"Official account id {account['id']} does not match PROJECT_ACCOUNT_ID={PROJECT_ACCOUNT_ID}")
+    return account['id']
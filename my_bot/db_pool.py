@@ -0,0 +1,353 @@
+import time
+import logging
+import threading
+import psycopg2
+import psycopg2.pool
+from psycopg2 import extensions
+from psycopg2.extras import RealDictCursor
+from config import (
+    DB_URL,
+    DB_POOL_MIN_SIZE,
+    DB_POOL_MAX_SIZE,
+    DB_POOL_MAX_IDLE,
+    DB_POOL_HEALTH_CHECK_INTERVAL,
+    DB_POOL_TIMEOUT,
+    DB_SSLMODE,
+    DB_QUERY_PROFILING,
+    DB_REPLICA_URL,
+    DB_REPLICA_MAX_LAG,
+    DB_REPLICA_CHECK_INTERVAL,
+)
+from query_profiler import ProfilingCursor, profiler
+
+logger = logging.getLogger(__name__)
+
+
+class PoolExhaustedError(psycopg2.pool.PoolError):
+    pass
+
+
+class ConnectionPool:
+    def __init__(self, dsn, min_size=1, max_size=10, max_idle=300, health_check_interval=30, timeout=10, **connect_kwargs):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(f"Invalid pool size: min={min_size}, max={max_size}")
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+        self.timeout = timeout
+        self.connect_kwargs = connect_kwargs
+
+        self._cond = threading.Condition()
+        # 空闲连接栈：(conn, 归还时间)，后进先出，让冷连接自然老化被回收
+        self._idle = []
+        self._in_use = set()
+        # 正在建立中的连接数，建连在锁外进行，但要占住名额
+        self._connecting = 0
+        self._closed = False
+
+        self.stats = {
+            'created': 0,
+            'closed': 0,
+            'checkouts': 0,
+            'health_check_failures': 0,
+            'idle_evictions': 0,
+            'exhausted': 0,
+            'timeouts': 0,
+            'wait_time_total': 0.0,
+        }
+
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, **self.connect_kwargs)
+        self.stats['created'] += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        self.stats['closed'] += 1
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error as e:
+            logger.warning(f"Pooled connection failed health check: {e}")
+            self.stats['health_check_failures'] += 1
+            return False
+
+    def _evict_idle(self):
+        # 超过 max_idle 的空闲连接在保留 min_size 的前提下移出空闲栈，栈底是最久未使用的；
+        # 返回需要关闭的连接，由调用方在锁外关闭
+        now = time.monotonic()
+        evicted = []
+        while len(self._idle) + len(self._in_use) + self._connecting > self.min_size and self._idle:
+            conn, idle_since = self._idle[0]
+            if now - idle_since < self.max_idle:
+                break
+            self._idle.pop(0)
+            evicted.append(conn)
+            self.stats['idle_evictions'] += 1
+        return evicted
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        waited = False
+        wait_start = None
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise psycopg2.InterfaceError("connection pool is closed")
+                    evicted = self._evict_idle()
+                    if evicted:
+                        break
+                    if self._idle:
+                        # 取出后立即计入使用中，健康检查在锁外进行，慢连接不会阻塞其他线程
+                        conn, idle_since = self._idle.pop()
+                        self._in_use.add(conn)
+                        break
+                    if len(self._in_use) + self._connecting < self.max_size:
+                        conn = None
+                        self._connecting += 1
+                        break
+                    if not waited:
+                        waited = True
+                        self.stats['exhausted'] += 1
+                    if wait_start is None:
+                        wait_start = time.monotonic()
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stats['timeouts'] += 1
+                        self.stats['wait_time_total'] += time.monotonic() - wait_start
+                        raise PoolExhaustedError(
+                            f"connection pool exhausted ({self.max_size} in use) after waiting {self.timeout}s"
+                        )
+                    self._cond.wait(remaining)
+                if wait_start is not None:
+                    self.stats['wait_time_total'] += time.monotonic() - wait_start
+                    wait_start = None
+
+            if evicted:
+                for old in evicted:
+                    self._discard(old)
+                continue
+
+            if conn is None:
+                break
+
+            if self._is_healthy(conn, idle_since):
+                with self._cond:
+                    self.stats['checkouts'] += 1
+                return conn
+            self._discard(conn)
+            with self._cond:
+                self._in_use.discard(conn)
+                self._cond.notify()
+
+        # TLS 握手较慢，放在锁外执行，避免阻塞其他线程取空闲连接
+        try:
+            conn = self._connect()
+        except psycopg2.Error:
+            with self._cond:
+                self._connecting -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._connecting -= 1
+            self._in_use.add(conn)
+            self.stats['checkouts'] += 1
+        return conn
+
+    def putconn(self, conn, close=False):
+        with self._cond:
+            if conn not in self._in_use:
+                raise psycopg2.InterfaceError("trying to put unkeyed connection")
+            close = close or conn.closed or self._closed
+
+        # 回滚与关闭都是网络往返，在锁外进行；期间连接仍计入使用中，不会超出 max_size
+        if not close:
+            # 归还前回滚未提交的事务，避免脏状态泄漏给下一个使用者
+            status = conn.get_transaction_status()
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    close = True
+        if close:
+            self._discard(conn)
+
+        with self._cond:
+            self._in_use.discard(conn)
+            if not close and not self._closed:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._discard(conn)
+            for conn in self._in_use:
+                self._discard(conn)
+            self._idle.clear()
+            self._in_use.clear()
+            self._cond.notify_all()
+
+    def owns(self, conn):
+        with self._cond:
+            return conn in self._in_use
+
+    def metrics(self):
+        with self._cond:
+            return dict(self.stats, in_use=len(self._in_use), idle=len(self._idle), max_size=self.max_size)
+
+
+_pool = None
+_replica_pool = None
+_pool_lock = threading.Lock()
+
+# 只读副本的状态：上次检查时间与是否可用（延迟在上限内且可连接）
+_replica_state = {'checked_at': 0.0, 'healthy': True}
+_replica_state_lock = threading.Lock()
+
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END AS lag
+"""
+
+
+def _create_pool(dsn):
+    return ConnectionPool(
+        dsn,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        max_idle=DB_POOL_MAX_IDLE,
+        health_check_interval=DB_POOL_HEALTH_CHECK_INTERVAL,
+        timeout=DB_POOL_TIMEOUT,
+        sslmode=DB_SSLMODE,
+        cursor_factory=ProfilingCursor if DB_QUERY_PROFILING else RealDictCursor,
+    )
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = _create_pool(DB_URL)
+                logger.info(f"Database pool created: min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE}")
+    return _pool
+
+
+def get_replica_pool():
+    # 未配置 DB_REPLICA_URL 时返回 None，只读查询也走主库
+    global _replica_pool
+    if _replica_pool is None and DB_REPLICA_URL:
+        with _pool_lock:
+            if _replica_pool is None:
+                _replica_pool = _create_pool(DB_REPLICA_URL)
+                logger.info(f"Replica pool created: min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE}")
+    return _replica_pool
+
+
+def _set_replica_healthy(healthy, reason=None):
+    with _replica_state_lock:
+        if _replica_state['healthy'] != healthy:
+            if healthy:
+                logger.info("Replica is healthy again, routing read-only queries to it")
+            else:
+                logger.warning(f"Routing read-only queries to the primary: {reason}")
+        _replica_state['healthy'] = healthy
+        _replica_state['checked_at'] = time.monotonic()
+
+
+def _get_replica_connection():
+    pool = get_replica_pool()
+    if pool is None:
+        return None
+    with _replica_state_lock:
+        due = time.monotonic() - _replica_state['checked_at'] >= DB_REPLICA_CHECK_INTERVAL
+        healthy = _replica_state['healthy']
+    if not healthy and not due:
+        return None
+
+    try:
+        conn = pool.getconn()
+    except (psycopg2.Error, psycopg2.pool.PoolError) as e:
+        _set_replica_healthy(False, f"replica unavailable: {e}")
+        return None
+    if not due:
+        return conn
+
+    # 每隔 DB_REPLICA_CHECK_INTERVAL 秒检查一次复制延迟，超过上限时回退到主库
+    try:
+        with conn.cursor() as cur:
+            cur.execute(REPLICA_LAG_SQL)
+            lag = float(cur.fetchone()['lag'])
+        conn.rollback()
+    except psycopg2.Error as e:
+        pool.putconn(conn, close=True)
+        _set_replica_healthy(False, f"replica lag check failed: {e}")
+        return None
+    if lag > DB_REPLICA_MAX_LAG:
+        pool.putconn(conn)
+        _set_replica_healthy(False, f"replica lag {lag:.1f}s exceeds {DB_REPLICA_MAX_LAG}s")
+        return None
+    _set_replica_healthy(True)
+    return conn
+
+
+def get_db_connection(readonly=False):
+    """从连接池取连接。readonly=True 时优先使用只读副本，副本未配置、不可用或延迟超限时使用主库。
+
+    余额等写入前需要读取的最新数据不要使用 readonly。
+    """
+    if readonly:
+        conn = _get_replica_connection()
+        if conn is not None:
+            return conn
+    return get_pool().getconn()
+
+
+def put_db_connection(conn):
+    if _replica_pool is not None and _replica_pool.owns(conn):
+        _replica_pool.putconn(conn)
+        return
+    if _pool is None:
+        # 连接池已关闭（例如停机过程中仍有查询返回），直接关闭连接
+        conn.close()
+        return
+    _pool.putconn(conn)
+
+
+def close_pool():
+    global _pool, _replica_pool
+    with _pool_lock:
+        if _replica_pool is not None:
+            logger.info(f"Closing replica pool: {_replica_pool.metrics()}")
+            _replica_pool.closeall()
+            _replica_pool = None
+        if _pool is not None:
+            logger.info(f"Closing database pool: {_pool.metrics()}")
+            if DB_QUERY_PROFILING:
+                logger.info(f"Top statements by total time:\n{profiler.report()}")
+            _pool.closeall()
+            _pool = None
@@ -0,0 +1,301 @@
+import sys
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from collections import deque
+from telegram.error import RetryAfter, TimedOut, NetworkError
+from config import (
+    DISPATCH_GLOBAL_RATE,
+    DISPATCH_CHAT_RATE,
+    DISPATCH_CHAT_BURST,
+    DISPATCH_QUEUE_SIZE,
+    DISPATCH_CONCURRENCY,
+    DISPATCH_MAX_RETRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+# 数字越小越先发送：对战结果优先于普通回复，普通回复优先于菜单
+PRIORITY_RESULT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_MENU = 2
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def delay(self, now):
+        # 返回还需等待的秒数，0 表示现在就有令牌（不消耗）
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class MessageDispatcher:
+    """带全局与单聊天令牌桶、优先级和有界队列的出站消息调度器。
+
+    处理函数调用 send_message() 只是入队并立即返回，由后台任务按限速发送。
+    每个聊天一个先进先出队列，只有队首消息参与调度（按队首的优先级与入队序号排序），
+    同一聊天同时最多只有一条消息在发送，限速或重试时整个聊天一起等待，保证同一聊天内的消息顺序。
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, max_queue=10000, concurrency=8, max_retries=3):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_queue = max_queue
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+
+        self.bot = None
+        self._chat_buckets = {}
+        # chat_id -> 待发送消息的 deque；聊天在 _ready、_delayed、_sending_chats 中至多出现一处
+        self._chats = {}
+        self._queued = 0
+        self._ready = []      # (priority, seq, chat_id)，队首消息可以发送的聊天
+        self._delayed = []    # (ready_at, priority, seq, chat_id)，因限速或重试等待中的聊天
+        self._sending_chats = set()
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._slots = None
+        self._worker = None
+        self._inflight = set()
+        # 因 RetryAfter 全局暂停发送直到该时间点
+        self._paused_until = 0.0
+
+        self.stats = {
+            'enqueued': 0,
+            'sent': 0,
+            'dropped': 0,
+            'failed': 0,
+            'retry_after': 0,
+        }
+
+    def __len__(self):
+        return self._queued
+
+    def start(self, bot):
+        self.bot = bot
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._worker = asyncio.create_task(self._run())
+        logger.info("Message dispatcher started")
+
+    async def stop(self, timeout=10):
+        # 停机时在超时内尽量发完队列中的消息
+        deadline = time.monotonic() + timeout
+        while (len(self) or self._inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._worker:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        if len(self):
+            logger.warning(f"Message dispatcher stopped with {len(self)} unsent messages")
+        logger.info(f"Message dispatcher stats: {self.stats}")
+
+    def send_message(self, chat_id, text, priority=PRIORITY_NORMAL, **kwargs):
+        if len(self) >= self.max_queue:
+            self.stats['dropped'] += 1
+            logger.warning(f"Outbound queue full, dropping message to chat {chat_id}")
+            return False
+        message = {'chat_id': chat_id, 'text': text, 'kwargs': kwargs, 'priority': priority,
+                   'seq': next(self._seq), 'attempts': 0}
+        queue = self._chats.get(chat_id)
+        if queue is None:
+            queue = self._chats[chat_id] = deque()
+        queue.append(message)
+        self._queued += 1
+        if len(queue) == 1 and chat_id not in self._sending_chats:
+            # 聊天此前没有待发送的消息，新消息即为队首
+            heapq.heappush(self._ready, (priority, message['seq'], chat_id))
+        self.stats['enqueued'] += 1
+        if self._wakeup:
+            self._wakeup.set()
+        return True
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.max_queue:
+                # 清理早已回满的聊天令牌桶，避免字典随聊天数无限增长
+                now = time.monotonic()
+                idle = [key for key, b in self._chat_buckets.items() if now - b.updated_at > self.chat_burst / self.chat_rate]
+                for key in idle:
+                    del self._chat_buckets[key]
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _schedule(self, chat_id, ready_at=None):
+        # 按队首消息原有的 (优先级, 序号) 重新排入调度；队列已空时删除该聊天
+        queue = self._chats.get(chat_id)
+        if not queue:
+            self._chats.pop(chat_id, None)
+            return
+        head = queue[0]
+        if ready_at is None:
+            heapq.heappush(self._ready, (head['priority'], head['seq'], chat_id))
+        else:
+            heapq.heappush(self._delayed, (ready_at, head['priority'], head['seq'], chat_id))
+
+    def _promote_due(self, now):
+        while self._delayed and self._delayed[0][0] <= now:
+            _, priority, seq, chat_id = heapq.heappop(self._delayed)
+            heapq.heappush(self._ready, (priority, seq, chat_id))
+
+    def _next_wait(self, now):
+        waits = []
+        if self._paused_until > now:
+            waits.append(self._paused_until - now)
+        if self._delayed:
+            waits.append(self._delayed[0][0] - now)
+        return max(min(waits), 0.01) if waits else None
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            self._promote_due(now)
+            if now < self._paused_until or not self._ready:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self._next_wait(now))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            global_delay = self.global_bucket.delay(now)
+            if global_delay > 0:
+                await asyncio.sleep(global_delay)
+                continue
+
+            _, _, chat_id = heapq.heappop(self._ready)
+            chat_bucket = self._chat_bucket(chat_id)
+            chat_delay = chat_bucket.delay(now)
+            if chat_delay > 0:
+                self._schedule(chat_id, now + chat_delay)
+                continue
+
+            message = self._chats[chat_id].popleft()
+            self._queued -= 1
+            self.global_bucket.consume(now)
+            chat_bucket.consume(now)
+            await self._slots.acquire()
+            self._sending_chats.add(chat_id)
+            task = asyncio.create_task(self._send(message))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _send(self, message):
+        chat_id = message['chat_id']
+        retry_at = None
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=message['text'], **message['kwargs'])
+            self.stats['sent'] += 1
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            retry_after = retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+            self.stats['retry_after'] += 1
+            logger.warning(f"Flood limit hit, pausing outbound messages for {retry_after}s")
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            retry_at = self._retry(message, self._paused_until)
+        except (TimedOut, NetworkError) as e:
+            logger.warning(f"Failed to send message to chat {chat_id}: {e}")
+            retry_at = self._retry(message, time.monotonic() + 2 ** message['attempts'])
+        except Exception as e:
+            self.stats['failed'] += 1
+            logger.error(f"Failed to send message to chat {chat_id}: {e}")
+        finally:
+            self._sending_chats.discard(chat_id)
+            self._schedule(chat_id, retry_at)
+            self._slots.release()
+            self._wakeup.set()
+
+    def _retry(self, message, ready_at):
+        # 需要重试的消息放回所在聊天的队首，返回重试时间；超过重试次数时放弃并返回 None
+        message['attempts'] += 1
+        if message['attempts'] > self.max_retries:
+            self.stats['failed'] += 1
+            logger.error(f"Giving up on message to chat {message['chat_id']} after {self.max_retries} retries")
+            return None
+        queue = self._chats.get(message['chat_id'])
+        if queue is None:
+            queue = self._chats[message['chat_id']] = deque()
+        queue.appendleft(message)
+        self._queued += 1
+        return ready_at
+
+    def metrics(self):
+        return dict(self.stats, queued=len(self), sending=len(self._inflight))
+
+
+dispatcher = MessageDispatcher(
+    global_rate=DISPATCH_GLOBAL_RATE,
+    chat_rate=DISPATCH_CHAT_RATE,
+    chat_burst=DISPATCH_CHAT_BURST,
+    max_queue=DISPATCH_QUEUE_SIZE,
+    concurrency=DISPATCH_CONCURRENCY,
+    max_retries=DISPATCH_MAX_RETRIES,
+)
+
+
+class _SimulatedBot:
+    # 模拟 Telegram API：固定网络延迟，超过全局速率时返回 RetryAfter
+    def __init__(self, latency=0.05, limit=30):
+        self.latency = latency
+        self.limit = limit
+        self.window_start = time.monotonic()
+        self.window_count = 0
+        self.sent = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        if now - self.window_start >= 1:
+            self.window_start, self.window_count = now, 0
+        self.window_count += 1
+        if self.window_count > self.limit:
+            raise RetryAfter(1)
+        self.sent += 1
+
+
+async def benchmark(duration=10, chats=500, offered_rate=200):
+    """以 offered_rate 条/秒向 chats 个聊天投递消息，统计模拟 API 下的持续发送速率。"""
+    bot = _SimulatedBot(limit=DISPATCH_GLOBAL_RATE)
+    bench = MessageDispatcher(
+        global_rate=DISPATCH_GLOBAL_RATE,
+        chat_rate=DISPATCH_CHAT_RATE,
+        chat_burst=DISPATCH_CHAT_BURST,
+        max_queue=DISPATCH_QUEUE_SIZE,
+        concurrency=DISPATCH_CONCURRENCY,
+    )
+    bench.start(bot)
+    started = time.monotonic()
+    i = 0
+    while time.monotonic() - started < duration:
+        for _ in range(max(offered_rate // 20, 1)):
+            bench.send_message(i % chats, f"message {i}", priority=i % 3)
+            i += 1
+        await asyncio.sleep(0.05)
+    elapsed = time.monotonic() - started
+    await bench.stop(timeout=0)
+    print(f"offered {i / elapsed:.1f} msg/s, sent {bot.sent / elapsed:.1f} msg/s, stats={bench.metrics()}")
+
+
+if __name__ == '__main__':
+    asyncio.run(benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 10))
@@ -2,10 +2,11 @@ import random
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 from database import get_user_by_telegram_id, update_user_balance
+from async_db import run_db
 
 async def start_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
-    user = get_user_by_telegram_id(str(query.from_user.id))
+    user = await run_db(get_user_by_telegram_id, str(query.from_user.id))
     
     if not user:
         await query.edit_message_text("请先注册后再开始游戏。")
@@ -18,7 +19,7 @@ async def start_game(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     )
 
 async def process_bet(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = get_user_by_telegram_id(str(update.message.from_user.id))
+    user = await run_db(get_user_by_telegram_id, str(update.message.from_user.id))
     bet_amount = int(update.message.text)
 
     if bet_amount % 100 != 0 or bet_amount < 100 or bet_amount > 1000:
@@ -37,10 +38,10 @@ async def process_bet(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
 
     if player_score > opponent_score:
         winnings = calculate_winnings(bet_amount)
-        update_user_balance(str(user['telegram_id']), winnings)
+        await run_db(update_user_balance, str(user['telegram_id']), winnings, kind='win')
         result_message += f"恭喜！您赢得了 {winnings} 游戏币！"
     elif player_score < opponent_score:
-        update_user_balance(str(user['telegram_id']), -bet_amount)
+        await run_db(update_user_balance, str(user['telegram_id']), -bet_amount, kind='bet')
         result_message += f"很遗憾，您输掉了 {bet_amount} 游戏币。"
     else:
         result_message += "平局！您的下注金额已退回。"
@@ -0,0 +1,84 @@
+"""由用户 id 确定性生成邀请码。
+
+用户 id（30 位以内）先经过以 INVITE_CODE_KEY 为密钥的 Feistel 置换，再按 Crockford Base32
+编码为 6 个字符。置换是一一映射，不同 id 的邀请码必然不同，生成时无需查库；
+相邻 id 的邀请码看不出先后顺序。邀请码可以解码回用户 id，查询直接走主键。
+
+迁移前的随机邀请码保存在 legacy_invite_code 中并优先匹配。与旧邀请码相同的新邀请码
+在迁移时不分配、注册时跳过对应的 id，因此任何邀请码都只对应一个用户。
+
+INVITE_CODE_KEY 一经使用不能更改，否则已发出的邀请码将无法解码。
+"""
+import hashlib
+from config import INVITE_CODE_KEY
+
+# Crockford Base32：去掉易混淆的 I、L、O、U
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+CODE_LENGTH = 6
+HALF_BITS = CODE_LENGTH * 5 // 2
+HALF_MASK = (1 << HALF_BITS) - 1
+MAX_USER_ID = (1 << (HALF_BITS * 2)) - 1
+ROUNDS = 4
+
+_DECODE = {char: value for value, char in enumerate(ALPHABET)}
+# 用户手输时常见的混淆字符
+_DECODE.update({'I': 1, 'L': 1, 'O': 0})
+
+_KEY = INVITE_CODE_KEY.encode('utf-8')
+
+
+def _round(i, half):
+    digest = hashlib.blake2b(bytes((i,)) + half.to_bytes(2, 'big'), digest_size=4, key=_KEY).digest()
+    return int.from_bytes(digest, 'big') & HALF_MASK
+
+
+def _permute(value):
+    left, right = value >> HALF_BITS, value & HALF_MASK
+    for i in range(ROUNDS):
+        left, right = right, left ^ _round(i, right)
+    return (left << HALF_BITS) | right
+
+
+def _unpermute(value):
+    left, right = value >> HALF_BITS, value & HALF_MASK
+    for i in reversed(range(ROUNDS)):
+        left, right = right ^ _round(i, left), left
+    return (left << HALF_BITS) | right
+
+
+def encode(user_id):
+    """返回用户 id 对应的 6 位邀请码。"""
+    if not 0 < user_id <= MAX_USER_ID:
+        raise ValueError(f"user id {user_id} is out of range for invite codes")
+    value = _permute(user_id)
+    chars = []
+    for _ in range(CODE_LENGTH):
+        chars.append(ALPHABET[value & 31])
+        value >>= 5
+    return ''.join(reversed(chars))
+
+
+def decode(invite_code):
+    """把邀请码解码为用户 id，格式不合法时返回 None。不区分大小写。"""
+    code = invite_code.strip().upper().replace('-', '')
+    if len(code) != CODE_LENGTH:
+        return None
+    value = 0
+    for char in code:
+        digit = _DECODE.get(char)
+        if digit is None:
+            return None
+        value = (value << 5) | digit
+    user_id = _unpermute(value)
+    return user_id or None
+
+
+if __name__ == '__main__':
+    # 自检：置换可逆且前 10 万个 id 的邀请码互不相同
+    codes = set()
+    for user_id in range(1, 100_001):
+        code = encode(user_id)
+        assert decode(code) == user_id and decode(code.lower()) == user_id
+        codes.add(code)
+    assert len(codes) == 100_000
+    print('\n'.join(f"{user_id}: {encode(user_id)}" for user_id in range(1, 6)))
@@ -0,0 +1,185 @@
+"""余额流水与快照。
+
+所有余额变动都在同一事务中向 balance_ledger 追加一行（kind 标明来源，ref 为对战的 game_id 或批次号）：
+    signup       注册赠送            bet / join   创建者、挑战者下注
+    refund       取消、过期、未能结算时退还下注
+    win / tie    结算：赢家拿回本金和奖金，平局双方退回本金
+    inviter_fee / project_fee   手续费汇总入账（每次汇总每个账户一行）
+    adjustment   批量余额调整（airdrop.py）     opening   引入流水时的期初余额
+
+snapshot_balances 定期为有变动的用户写入快照，任意时刻的余额 = 该时刻之前的最近一次快照
++ 快照之后的少量流水，无需扫描全部流水。
+
+快照的水位是事务号而不是流水 id 或创建时间：流水 id 与 created_at 在事务中分配，长事务提交时
+可能已经落在水位之后。每条流水记录写入它的事务号（txid），快照只处理事务号低于当前 xmin 的流水，
+这些事务都已结束，之后不会再出现新的行；仍在进行中的长事务会推迟快照，但不会被跳过。
+
+用法示例：
+    python ledger.py --snapshot
+    python ledger.py --user 42 --at "2024-06-01 00:00"
+    python ledger.py --check
+"""
+import sys
+import logging
+import argparse
+import datetime
+import psycopg2
+from db_pool import get_db_connection, put_db_connection, close_pool
+
+logger = logging.getLogger(__name__)
+
+# 快照任务的 advisory lock，避免多个进程同时写入同一批快照
+SNAPSHOT_LOCK_KEY = 724002
+
+# 为上次快照之后有流水的用户各写一条快照：上一条快照的余额加上这段流水的合计。
+# 本次处理事务号在 [上次水位, 当前 xmin) 之间的流水；xmin 之前的事务都已提交或回滚，这一区间不会再变化
+SNAPSHOT_SQL = """
+    WITH bounds AS (
+        SELECT (SELECT COALESCE(MAX(txid_upto), 0) FROM balance_snapshot_runs) AS after,
+               txid_snapshot_xmin(txid_current_snapshot()) AS upto
+    ),
+    changed AS (
+        SELECT l.user_id, MAX(l.id) AS ledger_id, SUM(l.amount) AS amount, MAX(l.created_at) AS as_of
+        FROM balance_ledger l, bounds b
+        WHERE l.txid >= b.after AND l.txid < b.upto
+        GROUP BY l.user_id
+    ),
+    snapshots AS (
+        INSERT INTO balance_snapshots (user_id, txid_upto, ledger_id, balance, as_of)
+        SELECT c.user_id, b.upto, c.ledger_id, COALESCE(prev.balance, 0) + c.amount, c.as_of
+        FROM changed c
+        CROSS JOIN bounds b
+        LEFT JOIN LATERAL (
+            SELECT s.balance FROM balance_snapshots s
+            WHERE s.user_id = c.user_id
+            ORDER BY s.txid_upto DESC
+            LIMIT 1
+        ) prev ON TRUE
+        RETURNING 1
+    ),
+    run AS (
+        INSERT INTO balance_snapshot_runs (txid_upto, snapshots)
+        SELECT upto, (SELECT COUNT(*) FROM snapshots) FROM bounds WHERE upto > after
+    )
+    SELECT (SELECT COUNT(*) FROM snapshots) AS snapshots, upto FROM bounds
+"""
+
+BALANCE_AT_SQL = """
+    WITH snap AS (
+        SELECT txid_upto, balance FROM balance_snapshots
+        WHERE user_id = %(user_id)s AND (%(at)s::timestamp IS NULL OR as_of <= %(at)s::timestamp)
+        ORDER BY txid_upto DESC
+        LIMIT 1
+    )
+    SELECT COALESCE((SELECT balance FROM snap), 0) + COALESCE(SUM(l.amount), 0) AS balance,
+           COUNT(l.id) AS tail,
+           EXISTS (SELECT 1 FROM snap) AS has_snapshot
+    FROM balance_ledger l
+    WHERE l.user_id = %(user_id)s
+      AND l.txid >= COALESCE((SELECT txid_upto FROM snap), 0)
+      AND (%(at)s::timestamp IS NULL OR l.created_at <= %(at)s::timestamp)
+"""
+
+# 流水推算的余额与 users.balance 不一致的账户
+MISMATCH_SQL = """
+    WITH latest AS (
+        SELECT DISTINCT ON (user_id) user_id, txid_upto, balance
+        FROM balance_snapshots
+        ORDER BY user_id, txid_upto DESC
+    ),
+    tail AS (
+        SELECT l.user_id, SUM(l.amount) AS amount
+        FROM balance_ledger l
+        LEFT JOIN latest s ON s.user_id = l.user_id
+        WHERE l.txid >= COALESCE(s.txid_upto, 0)
+        GROUP BY l.user_id
+    )
+    SELECT u.id, u.telegram_id, u.balance,
+           COALESCE(s.balance, 0) + COALESCE(t.amount, 0) AS ledger_balance
+    FROM users u
+    LEFT JOIN latest s ON s.user_id = u.id
+    LEFT JOIN tail t ON t.user_id = u.id
+    WHERE u.balance <> COALESCE(s.balance, 0) + COALESCE(t.amount, 0)
+    ORDER BY u.id
+    LIMIT %(limit)s
+"""
+
+
+def snapshot_balances():
+    """为上次快照之后余额有变动的用户写入快照，返回写入的快照数；其他进程正在写快照时返回 0。"""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_xact_lock(%s) AS locked", (SNAPSHOT_LOCK_KEY,))
+            if not cur.fetchone()['locked']:
+                conn.rollback()
+                return 0
+            cur.execute(SNAPSHOT_SQL)
+            row = cur.fetchone()
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        logger.error(f"Error snapshotting balances: {e}")
+        raise
+    finally:
+        put_db_connection(conn)
+
+    if row['snapshots']:
+        logger.info(f"Wrote {row['snapshots']} balance snapshots up to transaction {row['upto']}")
+    return row['snapshots']
+
+
+def get_balance_at(user_id, at=None):
+    """返回用户在 at 时刻（默认为当前）的余额，由最近一次快照加之后的流水计算；该时刻之前没有任何流水时返回 None。"""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(BALANCE_AT_SQL, {'user_id': user_id, 'at': at})
+            row = cur.fetchone()
+        conn.rollback()
+    finally:
+        put_db_connection(conn)
+    if not row['has_snapshot'] and not row['tail']:
+        return None
+    return row['balance']
+
+
+def find_balance_mismatches(limit=100):
+    """对账：返回流水推算的余额与 users.balance 不一致的账户。会扫描全部用户，只用于离线核对。"""
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(MISMATCH_SQL, {'limit': limit})
+            rows = cur.fetchall()
+        conn.rollback()
+    finally:
+        put_db_connection(conn)
+    return rows
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--snapshot', action='store_true', help='立即写入一次快照')
+    parser.add_argument('--user', type=int, help='查询该用户 id 的余额')
+    parser.add_argument('--at', type=datetime.datetime.fromisoformat, help='查询的时刻，默认为当前')
+    parser.add_argument('--check', action='store_true', help='列出流水与 users.balance 不一致的账户')
+    args = parser.parse_args()
+
+    try:
+        if args.snapshot:
+            snapshot_balances()
+        if args.user is not None:
+            print(get_balance_at(args.user, args.at))
+        if args.check:
+            mismatches = find_balance_mismatches()
+            for row in mismatches:
+                print(f"user {row['id']} ({row['telegram_id']}): balance {row['balance']}, ledger {row['ledger_balance']}")
+            if mismatches:
+                sys.exit(1)
+    finally:
+        close_pool()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,492 @@
+"""端到端压测：用模拟的 Telegram API 和本地 PostgreSQL 驱动 bot.py 中真实的处理函数。
+
+每对玩家连续对战 --rounds 局（默认 6 局，超过一页），之后按回复中的按钮逐页翻看对战历史。
+处理函数抛出的异常由 Application 转交给错误处理函数，不会从 process_update 抛出，
+压测额外注册一个错误处理函数统计异常次数。
+
+--transport 选择更新的投递方式：
+    direct    直接调用 Application.process_update，只测处理函数本身（默认）
+    polling   更新放入模拟 API 的 getUpdates 长轮询，由 Updater 拉取后经更新队列处理
+    webhook   更新以 HTTP POST 发到 Updater 内置的本地 webhook 服务器（带 secret token）
+polling 与 webhook 模式下的延迟从更新交给 Telegram 侧（放入 getUpdates 队列或发出 POST）
+算起，到该更新的处理函数执行完为止，可用同样的参数分别运行两种模式比较端到端延迟。
+
+用法示例（DB_URL 指向本地测试库，不要指向生产库）：
+    DB_SSLMODE=disable python loadtest.py --games 500 --concurrency 50 --max-p99-ms 500
+    DB_SSLMODE=disable python loadtest.py --games 500 --concurrency 50 --transport polling
+    DB_SSLMODE=disable python loadtest.py --games 500 --concurrency 50 --transport webhook
+    DB_SSLMODE=disable python loadtest.py --debit-stress 500 --concurrency 50
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import itertools
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('BOT_TOKEN', '123456:loadtest')
+
+import httpx
+from telegram import Update
+from telegram.error import BadRequest
+from telegram.ext import TypeHandler
+from telegram.request import BaseRequest
+
+import bot
+import invite_codes
+from async_db import run_db
+from db_pool import get_db_connection, put_db_connection
+from dispatcher import dispatcher, TokenBucket
+from pending_games import pending_store
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'loadtest_bot'}
+# 对战历史每页条数，与 show_game_history 一致
+HISTORY_PAGE_SIZE = 5
+# polling / webhook 模式下单个更新的最长等待秒数，超时记为错误
+STEP_TIMEOUT = 30
+WEBHOOK_SECRET = 'loadtest-secret'
+
+
+class FakeTelegramRequest(BaseRequest):
+    """在 HTTP 层模拟 Telegram Bot API，可配置每次调用的延迟。"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = defaultdict(int)
+        # chat_id -> 最近一条带按钮的消息中的 callback_data 列表
+        self.keyboards = {}
+        # polling 模式下等待 getUpdates 拉取的更新
+        self.updates = asyncio.Queue()
+        self._message_ids = itertools.count(1)
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] += 1
+        params = request_data.parameters if request_data else {}
+        markup = params.get('reply_markup')
+        if isinstance(markup, dict) and 'inline_keyboard' in markup:
+            self.keyboards[int(params.get('chat_id', 0))] = [
+                button['callback_data'] for row in markup['inline_keyboard'] for button in row if 'callback_data' in button
+            ]
+        if endpoint == 'getMe':
+            result = BOT_USER
+        elif endpoint == 'getUpdates':
+            result = await self._get_updates(float(params.get('timeout') or 0))
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            result = {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'},
+                'from': BOT_USER,
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+    async def _get_updates(self, timeout):
+        # 长轮询：没有待投递的更新时最多等待 timeout 秒，有更新时一次返回全部
+        updates = []
+        if self.updates.empty() and timeout > 0:
+            try:
+                updates.append(await asyncio.wait_for(self.updates.get(), timeout))
+            except asyncio.TimeoutError:
+                pass
+        while not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+
+class PollingTransport:
+    """把更新放入模拟 API 的 getUpdates 队列，由 Updater 长轮询拉取。"""
+    name = 'polling'
+
+    def __init__(self, application, request):
+        self.application = application
+        self.request = request
+
+    async def start(self):
+        await self.application.updater.start_polling(poll_interval=0, timeout=10, allowed_updates=Update.ALL_TYPES)
+
+    async def deliver(self, update):
+        self.request.updates.put_nowait(update.to_dict())
+
+    async def stop(self):
+        await self.application.updater.stop()
+
+
+class WebhookTransport:
+    """把更新 POST 到 Updater 内置的本地 webhook 服务器，与 BOT_MODE=webhook 的接收路径相同。"""
+    name = 'webhook'
+
+    def __init__(self, application, request):
+        self.application = application
+        self.client = None
+
+    async def start(self):
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        await self.application.updater.start_webhook(
+            listen='127.0.0.1',
+            port=port,
+            url_path='loadtest',
+            webhook_url='https://loadtest.invalid/loadtest',
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES,
+        )
+        self.client = httpx.AsyncClient(
+            base_url=f'http://127.0.0.1:{port}',
+            headers={'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET},
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=None),
+        )
+
+    async def deliver(self, update):
+        response = await self.client.post('/loadtest', json=update.to_dict())
+        response.raise_for_status()
+
+    async def stop(self):
+        await self.client.aclose()
+        await self.application.updater.stop()
+
+
+TRANSPORTS = {'polling': PollingTransport, 'webhook': WebhookTransport}
+
+
+class UpdateFactory:
+    def __init__(self, application):
+        self.application = application
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f'p{user_id}', 'username': f'p{user_id}'}
+
+    def _message(self, user_id, **fields):
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': self._user(user_id),
+        }
+        message.update(fields)
+        return message
+
+    def _update(self, **fields):
+        return Update.de_json(dict(update_id=next(self._update_ids), **fields), self.application.bot)
+
+    def command(self, user_id, command, *args):
+        text = ' '.join((f'/{command}',) + args)
+        entity = {'type': 'bot_command', 'offset': 0, 'length': len(command) + 1}
+        return self._update(message=self._message(user_id, text=text, entities=[entity]))
+
+    def text(self, user_id, text):
+        return self._update(message=self._message(user_id, text=text))
+
+    def dice(self, user_id, value=None):
+        dice = {'emoji': '🎲', 'value': value or random.randint(1, 6)}
+        return self._update(message=self._message(user_id, dice=dice))
+
+    def callback(self, user_id, data):
+        return self._update(callback_query={
+            'id': str(next(self._update_ids)),
+            'from': self._user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': self._message(user_id, text='menu', **{'from': BOT_USER}),
+        })
+
+
+class LoadTest:
+    def __init__(self, application, factory, request, invite_code, transport=None):
+        self.application = application
+        self.factory = factory
+        self.request = request
+        self.invite_code = invite_code
+        self.transport = transport
+        # update_id -> 处理完成时设置结果的 future，只在 polling / webhook 模式下使用
+        self._pending = {}
+        self.latencies = defaultdict(list)
+        self.errors = 0
+        self.error_types = Counter()
+        self.completed_games = 0
+        self.history_pages = 0
+        application.add_error_handler(self.count_error)
+        if transport is not None:
+            # 处理函数都在 0 组，之后的组在其执行完（包括抛出异常）后才运行，用来标记更新处理完成
+            application.add_handler(TypeHandler(Update, self.mark_done), group=1)
+
+    async def mark_done(self, update, context):
+        future = self._pending.pop(update.update_id, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def count_error(self, update, context):
+        # 与 bot.error_handler 一样忽略内容未变化的编辑
+        if isinstance(context.error, BadRequest) and "Message is not modified" in str(context.error):
+            return
+        self.errors += 1
+        self.error_types[type(context.error).__name__] += 1
+
+    async def step(self, kind, update):
+        started = time.perf_counter()
+        if self.transport is None:
+            try:
+                await self.application.process_update(update)
+            except Exception:
+                self.errors += 1
+        else:
+            done = self._pending[update.update_id] = asyncio.get_running_loop().create_future()
+            try:
+                await self.transport.deliver(update)
+                await asyncio.wait_for(done, STEP_TIMEOUT)
+            except (asyncio.TimeoutError, httpx.HTTPError):
+                self._pending.pop(update.update_id, None)
+                self.errors += 1
+        self.latencies[kind].append(time.perf_counter() - started)
+
+    async def history_buttons(self, chat_id, previous, timeout=5.0):
+        # 对战历史经出站队列异步发送，等待模拟 API 收到新的一条带翻页按钮的消息
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            buttons = self.request.keyboards.get(chat_id)
+            if buttons is not previous and buttons and any(data.startswith('history_') for data in buttons):
+                return buttons
+            await asyncio.sleep(0.001)
+        self.errors += 1
+        return None
+
+    async def browse_history(self, user_id, games):
+        # 从第一页按“下一页”翻到最后一页，再按“上一页”翻回第一页，游标取自回复中的按钮
+        f = self.factory
+        previous = self.request.keyboards.get(user_id)
+        await self.step('callback:game_history', f.callback(user_id, 'game_history'))
+        buttons = await self.history_buttons(user_id, previous)
+        pages = 1
+        for action in ('next', 'prev'):
+            while buttons:
+                data = next((data for data in buttons if data.startswith(f'history_{action}_')), None)
+                if data is None:
+                    break
+                await self.step(f'callback:history_{action}', f.callback(user_id, data))
+                buttons = await self.history_buttons(user_id, buttons)
+                if action == 'next':
+                    pages += 1
+        self.history_pages += pages
+        expected = max(1, -(-games // HISTORY_PAGE_SIZE))
+        if pages != expected:
+            self.errors += 1
+
+    async def register(self, user_id):
+        await self.step('start', self.factory.command(user_id, 'start'))
+        await self.step('invite_code', self.factory.text(user_id, self.invite_code))
+
+    async def play_game(self, creator_id, joiner_id, bet_amount):
+        f = self.factory
+        await self.step('callback:start_game', f.callback(creator_id, 'start_game'))
+        await self.step('bet', f.text(creator_id, str(bet_amount)))
+        game_id = self.application.user_data[creator_id].get('game_id')
+        for _ in range(3):
+            await self.step('dice', f.dice(creator_id))
+        if not game_id:
+            self.errors += 1
+            return False
+
+        await self.step('join', f.command(joiner_id, 'start', game_id))
+        await self.step('dice', f.dice(joiner_id))
+        await self.step('dice', f.dice(joiner_id))
+        await self.step('dice:finish_game', f.dice(joiner_id))
+        if game_id in pending_store:
+            return False
+        self.completed_games += 1
+        return True
+
+    async def play_pair(self, creator_id, joiner_id, rounds, bet_amount):
+        await asyncio.gather(self.register(creator_id), self.register(joiner_id))
+        completed = 0
+        for _ in range(rounds):
+            completed += await self.play_game(creator_id, joiner_id, bet_amount)
+        await self.browse_history(creator_id, completed)
+        await self.step('callback:invite_earnings', self.factory.callback(joiner_id, 'invite_earnings'))
+
+
+def seed_inviter():
+    # 所有压测玩家都通过同一个邀请码注册，返回该邀请码
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO users (telegram_id, username, balance)
+                VALUES ('loadtest_inviter', 'loadtest_inviter', 0)
+                ON CONFLICT (telegram_id) DO UPDATE SET username = EXCLUDED.username
+                RETURNING id
+            """)
+            inviter_id = cur.fetchone()['id']
+            invite_code = invite_codes.encode(inviter_id)
+            cur.execute("UPDATE users SET invite_code = %s WHERE id = %s", (invite_code, inviter_id))
+        conn.commit()
+    finally:
+        put_db_connection(conn)
+    return invite_code
+
+
+def debit_stress(attempts=500, workers=50, bet_amount=100, starting_balance=1000):
+    """同一用户并发发起 attempts 次下注扣款，验证条件扣款不会透支。返回 (是否通过, 成功次数, 最终余额)。"""
+    telegram_id = 'loadtest_debit_stress'
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            # 把测试用户的余额重置为 starting_balance，差额照常记入流水
+            cur.execute("""
+                WITH target AS (
+                    INSERT INTO users (telegram_id, username, balance)
+                    VALUES (%(telegram_id)s, %(telegram_id)s, 0)
+                    ON CONFLICT (telegram_id) DO UPDATE SET username = EXCLUDED.username
+                    RETURNING id, balance
+                ),
+                reset AS (
+                    UPDATE users u SET balance = %(balance)s FROM target WHERE u.id = target.id
+                ),
+                ledger AS (
+                    INSERT INTO balance_ledger (user_id, amount, kind, ref)
+                    SELECT id, %(balance)s - balance, 'adjustment', 'loadtest' FROM target WHERE balance <> %(balance)s
+                )
+                SELECT id FROM target
+            """, {'telegram_id': telegram_id, 'balance': starting_balance})
+        conn.commit()
+    finally:
+        put_db_connection(conn)
+    bot.user_cache.invalidate(telegram_id=telegram_id)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            lambda _: bot.debit_user_balance(telegram_id, bet_amount, kind='bet', ref='loadtest'), range(attempts)))
+    succeeded = [balance for balance in results if balance is not None]
+
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT balance FROM users WHERE telegram_id = %s", (telegram_id,))
+            final_balance = cur.fetchone()['balance']
+        conn.rollback()
+    finally:
+        put_db_connection(conn)
+
+    expected = min(attempts, starting_balance // bet_amount)
+    ok = (final_balance >= 0
+          and len(succeeded) == expected
+          and len(succeeded) * bet_amount + final_balance == starting_balance
+          and sorted(succeeded) == sorted(set(succeeded))
+          and min(succeeded, default=0) >= 0)
+    print(f"debit stress: {len(succeeded)}/{attempts} debits of {bet_amount} succeeded (expected {expected}), "
+          f"final balance {final_balance}: {'OK' if ok else 'FAIL'}")
+    return ok, len(succeeded), final_balance
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def run(games, concurrency, bet_amount, api_latency, rounds=6, transport=None):
+    request = FakeTelegramRequest(latency=api_latency)
+    application = bot.build_application(request=request)
+    await application.initialize()
+    await bot.post_init(application)
+    invite_code = await run_db(seed_inviter)
+    # 压测关注处理函数本身，出站消息不限速
+    dispatcher.global_bucket = TokenBucket(1e9, 1e9)
+    dispatcher.chat_rate = dispatcher.chat_burst = 1e9
+
+    factory = UpdateFactory(application)
+    if transport is not None:
+        transport = TRANSPORTS[transport](application, request)
+    test = LoadTest(application, factory, request, invite_code, transport)
+    if transport is not None:
+        # 与正式运行相同：Updater 把更新放入更新队列，Application 取出后交给更新处理器
+        await application.start()
+        await transport.start()
+    # 每次运行使用新的用户 id，避免与上次留下的数据冲突
+    base_id = random.randint(10 ** 9, 2 * 10 ** 9)
+    slots = asyncio.Semaphore(concurrency)
+
+    async def play(i):
+        async with slots:
+            await test.play_pair(base_id + 2 * i, base_id + 2 * i + 1, min(rounds, games - i * rounds), bet_amount)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(play(i) for i in range(-(-games // rounds))))
+    elapsed = time.perf_counter() - started
+
+    if transport is not None:
+        await transport.stop()
+        await application.stop()
+    await bot.post_stop(application)
+    await application.shutdown()
+    await bot.post_shutdown(application)
+    return test, elapsed, request
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--games', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--bet', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=6, help='每对玩家连续对战的局数，超过 5 局时对战历史会翻页')
+    parser.add_argument('--transport', choices=('direct',) + tuple(TRANSPORTS), default='direct',
+                        help='更新的投递方式，polling / webhook 测量端到端延迟')
+    parser.add_argument('--api-latency-ms', type=float, default=0.0, help='模拟 Telegram API 每次调用的延迟')
+    parser.add_argument('--max-p99-ms', type=float, help='任一处理函数 p99 超过该值时以非零状态退出')
+    parser.add_argument('--debit-stress', type=int, metavar='ATTEMPTS',
+                        help='只运行并发扣款测试：同一用户以 --concurrency 个线程发起指定次数的下注扣款')
+    args = parser.parse_args()
+
+    if args.debit_stress:
+        ok, _, _ = debit_stress(args.debit_stress, args.concurrency, args.bet)
+        sys.exit(0 if ok else 1)
+
+    test, elapsed, request = asyncio.run(run(
+        args.games, args.concurrency, args.bet, args.api_latency_ms / 1000, args.rounds,
+        None if args.transport == 'direct' else args.transport,
+    ))
+
+    print(f"transport: {args.transport}")
+    print(f"{'handler':<28}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}")
+    worst_p99 = 0.0
+    for kind, values in sorted(test.latencies.items()):
+        p50, p99 = percentile(values, 0.50) * 1000, percentile(values, 0.99) * 1000
+        worst_p99 = max(worst_p99, p99)
+        print(f"{kind:<28}{len(values):>8}{p50:>10.1f}{p99:>10.1f}")
+    print(f"completed games: {test.completed_games}/{args.games} in {elapsed:.2f}s "
+          f"({test.completed_games / elapsed:.1f} games/s), history pages: {test.history_pages}, errors: {test.errors}")
+    if test.error_types:
+        print(f"handler exceptions: {dict(test.error_types)}")
+    print(f"api calls: {dict(request.calls)}")
+
+    if args.max_p99_ms is not None and worst_p99 > args.max_p99_ms:
+        print(f"FAIL: worst p99 {worst_p99:.1f}ms exceeds {args.max_p99_ms}ms")
+        sys.exit(1)
+    if test.completed_games < args.games or test.errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# 与 process_bet 的限制一致：100 ~ 1000，100 的倍数
+BET_TIERS = tuple(range(100, 1001, 100))
+
+
+class OrderBook:
+    """按下注档位分组的待匹配挑战，每个档位内按创建者掷完骰子的先后顺序排队。
+
+    只有创建者已经掷完三次骰子的挑战才会进入队列；挑战被加入、取消或过期时，
+    由 PendingGameStore 同步移除，队列中不会残留已结束的挑战。
+    """
+
+    def __init__(self, tiers=BET_TIERS):
+        self._lock = threading.Lock()
+        # 下注金额 -> OrderedDict(game_id -> creator_id)，越早的挑战越靠前
+        self._queues = {bet_amount: OrderedDict() for bet_amount in tiers}
+        # game_id -> 下注金额，用于 O(1) 移除
+        self._index = {}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._index)
+
+    def __contains__(self, game_id):
+        with self._lock:
+            return game_id in self._index
+
+    def add(self, game_id, bet_amount, creator_id, front=False):
+        with self._lock:
+            queue = self._queues.get(bet_amount)
+            if queue is None or game_id in self._index:
+                return False
+            queue[game_id] = creator_id
+            if front:
+                # 匹配后加入失败的挑战放回队首，保持原有的先后顺序
+                queue.move_to_end(game_id, last=False)
+            self._index[game_id] = bet_amount
+            return True
+
+    def remove(self, game_id):
+        with self._lock:
+            bet_amount = self._index.pop(game_id, None)
+            if bet_amount is not None:
+                self._queues[bet_amount].pop(game_id, None)
+            return bet_amount is not None
+
+    def match(self, bet_amount, player_id):
+        """取出该档位最早的、不是 player_id 自己发起的挑战，返回 (game_id, creator_id)；没有时返回 None。"""
+        with self._lock:
+            queue = self._queues.get(bet_amount)
+            if not queue:
+                return None
+            for game_id, creator_id in queue.items():
+                # 通常队首就不是自己的挑战，只有自己在同一档位挂了多个挑战时才需要往后找
+                if creator_id != player_id:
+                    del queue[game_id]
+                    del self._index[game_id]
+                    return game_id, creator_id
+            return None
+
+    def depth(self):
+        with self._lock:
+            return {bet_amount: len(queue) for bet_amount, queue in self._queues.items()}
+
+
+order_book = OrderBook()
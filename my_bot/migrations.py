@@ -0,0 +1,469 @@
+import sys
+import json
+import logging
+import threading
+import psycopg2
+from psycopg2.extras import execute_values
+from db_pool import get_db_connection, put_db_connection
+import invite_codes
+
+logger = logging.getLogger(__name__)
+
+# 迁移期间持有的会话级 advisory lock，避免多个进程同时执行迁移
+MIGRATION_LOCK_KEY = 724001
+
+# (版本号, 名称, 语句列表)。语句为 SQL 字符串，或接收游标的函数（用于无法用 SQL 表达的数据迁移）。
+# 已发布的迁移不要修改，新的变更追加新版本。
+MIGRATIONS = [
+    (1, 'baseline tables', [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            telegram_id TEXT UNIQUE,
+            username TEXT,
+            invite_code TEXT UNIQUE,
+            balance INTEGER DEFAULT 1000,
+            inviter_id INTEGER REFERENCES users(id),
+            invite_earnings INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS game_history (
+            id SERIAL PRIMARY KEY,
+            game_id TEXT,
+            player_a_id INTEGER REFERENCES users(id),
+            player_b_id INTEGER REFERENCES users(id),
+            bet_amount INTEGER,
+            player_a_score INTEGER,
+            player_b_score INTEGER,
+            winner_id INTEGER REFERENCES users(id),
+            win_amount INTEGER,
+            status TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    # 替代原先基于 information_schema 的列检查，兼容早期创建的 users 表
+    (2, 'users columns added after launch', [
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS invite_earnings INTEGER NOT NULL DEFAULT 0",
+    ]),
+    (3, 'indexes for hot queries', [
+        # 对战历史：按玩家 + 状态过滤，按 (created_at, id) 倒序分页
+        "CREATE INDEX IF NOT EXISTS idx_game_history_player_a_status_created ON game_history (player_a_id, status, created_at DESC, id DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_game_history_player_b_status_created ON game_history (player_b_id, status, created_at DESC, id DESC)",
+        # 待分享的对战：只索引尚未有对手的 pending 记录
+        "CREATE INDEX IF NOT EXISTS idx_game_history_pending_creator ON game_history (player_a_id, created_at DESC) WHERE status = 'pending' AND player_b_id IS NULL",
+        # 结算与取消按 game_id 定位记录
+        "CREATE INDEX IF NOT EXISTS idx_game_history_game_id ON game_history (game_id)",
+        # 邀约收益按赢家关联
+        "CREATE INDEX IF NOT EXISTS idx_game_history_winner_id ON game_history (winner_id)",
+        "CREATE INDEX IF NOT EXISTS idx_users_inviter_id ON users (inviter_id)",
+        # 邀请码查询使用 UPPER(invite_code)，普通唯一索引无法命中
+        "CREATE INDEX IF NOT EXISTS idx_users_upper_invite_code ON users (UPPER(invite_code))",
+    ]),
+    (4, 'invite earnings aggregates', [
+        # 每个邀约者一行的汇总：邀请人数与累计收益，结算与注册时增量维护
+        '''
+        CREATE TABLE IF NOT EXISTS invite_stats (
+            inviter_id INTEGER PRIMARY KEY REFERENCES users(id),
+            invited_count INTEGER NOT NULL DEFAULT 0,
+            total_earnings BIGINT NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # 按天汇总的邀约收益，最近 N 天的收益只需读取 N 行
+        '''
+        CREATE TABLE IF NOT EXISTS invite_earnings_daily (
+            inviter_id INTEGER NOT NULL REFERENCES users(id),
+            day DATE NOT NULL,
+            earnings BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (inviter_id, day)
+        )
+        ''',
+        '''
+        INSERT INTO invite_stats (inviter_id, invited_count, total_earnings)
+        SELECT inviter.id, COUNT(invited.id), inviter.invite_earnings
+        FROM users inviter
+        JOIN users invited ON invited.inviter_id = inviter.id
+        GROUP BY inviter.id, inviter.invite_earnings
+        ON CONFLICT (inviter_id) DO NOTHING
+        ''',
+        '''
+        INSERT INTO invite_earnings_daily (inviter_id, day, earnings)
+        SELECT winner.inviter_id, gh.created_at::date, SUM(gh.bet_amount * 7 / 100)
+        FROM game_history gh
+        JOIN users winner ON winner.id = gh.winner_id
+        WHERE gh.status = 'completed' AND winner.inviter_id IS NOT NULL
+        GROUP BY winner.inviter_id, gh.created_at::date
+        ON CONFLICT (inviter_id, day) DO NOTHING
+        ''',
+        # 下线列表按 id 键集分页
+        "CREATE INDEX IF NOT EXISTS idx_users_inviter_id_id ON users (inviter_id, id)",
+        "DROP INDEX IF EXISTS idx_users_inviter_id",
+    ]),
+    (5, 'pending game expiry index', [
+        # 过期清理按创建时间扫描无人加入的挑战
+        "CREATE INDEX IF NOT EXISTS idx_game_history_pending_created ON game_history (created_at) WHERE status = 'pending' AND player_b_id IS NULL",
+    ]),
+    (6, 'fee accruals', [
+        # 结算只追加手续费记录，不更新项目方与邀约者所在的 users 行；定期汇总入账后删除
+        '''
+        CREATE TABLE IF NOT EXISTS fee_accruals (
+            id BIGSERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            kind TEXT NOT NULL CHECK (kind IN ('project', 'inviter')),
+            amount INTEGER NOT NULL,
+            game_history_id INTEGER REFERENCES game_history(id),
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (7, 'game history created_at range index', [
+        # 按日期范围导出对战记录；created_at 随插入顺序递增，BRIN 索引很小且适合范围扫描
+        "CREATE INDEX IF NOT EXISTS idx_game_history_created_brin ON game_history USING BRIN (created_at)",
+    ]),
+    (8, 'invite codes derived from user id', [
+        # 旧的随机邀请码保存到 legacy_invite_code，已分享出去的旧邀请码仍可注册
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS legacy_invite_code TEXT",
+        "UPDATE users SET legacy_invite_code = UPPER(invite_code), invite_code = NULL WHERE invite_code IS NOT NULL",
+        lambda cur: _assign_invite_codes(cur),
+        "UPDATE users SET invite_code = legacy_invite_code WHERE invite_code IS NULL AND legacy_invite_code IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_users_legacy_invite_code ON users (legacy_invite_code) WHERE legacy_invite_code IS NOT NULL",
+        "DROP INDEX IF EXISTS idx_users_upper_invite_code",
+    ]),
+    (9, 'balance ledger and adjustment batches', [
+        # 余额流水：每笔入账或扣款一行，只追加不修改
+        '''
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id BIGSERIAL PRIMARY KEY,
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            amount INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            ref TEXT,
+            reason TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_balance_ledger_user_id ON balance_ledger (user_id, id)",
+        # 批量余额调整的批次与进度，批次号保证同一批次只入账一次，中断后按 applied_seq 继续
+        '''
+        CREATE TABLE IF NOT EXISTS balance_adjustment_batches (
+            batch_id TEXT PRIMARY KEY,
+            total_rows INTEGER NOT NULL,
+            total_amount BIGINT NOT NULL,
+            applied_seq BIGINT NOT NULL DEFAULT 0,
+            credited_rows INTEGER NOT NULL DEFAULT 0,
+            skipped_rows INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'applying',
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            completed_at TIMESTAMP
+        )
+        ''',
+    ]),
+    (10, 'balance snapshots', [
+        # 每个用户截至某条流水（ledger_id）的余额；as_of 为该条流水之前最后一笔变动的时间
+        '''
+        CREATE TABLE IF NOT EXISTS balance_snapshots (
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            ledger_id BIGINT NOT NULL,
+            balance BIGINT NOT NULL,
+            as_of TIMESTAMP NOT NULL,
+            PRIMARY KEY (user_id, ledger_id)
+        )
+        ''',
+        # 每次快照处理到的流水 id，下一次从这里继续
+        '''
+        CREATE TABLE IF NOT EXISTS balance_snapshot_runs (
+            ledger_id BIGINT PRIMARY KEY,
+            snapshots INTEGER NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # 期初余额：此前的余额变动没有流水，补一条使每个用户的流水合计等于当前余额
+        '''
+        INSERT INTO balance_ledger (user_id, amount, kind)
+        SELECT u.id, u.balance - COALESCE(l.amount, 0), 'opening'
+        FROM users u
+        LEFT JOIN (SELECT user_id, SUM(amount) AS amount FROM balance_ledger GROUP BY user_id) l ON l.user_id = u.id
+        WHERE u.balance <> COALESCE(l.amount, 0)
+        ''',
+    ]),
+    (11, 'supersede legacy pending games', [
+        lambda cur: _supersede_legacy_pending_games(cur),
+    ]),
+    (12, 'balance snapshots by transaction id', [
+        # 流水 id 与 created_at 都按事务开始的先后分配，长事务提交时可能已落在快照水位之后而被永久跳过。
+        # 每行记录写入它的事务号，快照只处理事务号低于当前快照 xmin（之前的事务都已结束）的流水
+        "ALTER TABLE balance_ledger ADD COLUMN IF NOT EXISTS txid BIGINT NOT NULL DEFAULT txid_current()",
+        "CREATE INDEX IF NOT EXISTS idx_balance_ledger_txid ON balance_ledger (txid)",
+        # 快照只是流水的汇总，按新的水位重建：删除旧快照，下一次快照从全部流水开始
+        "DROP TABLE IF EXISTS balance_snapshots",
+        "DROP TABLE IF EXISTS balance_snapshot_runs",
+        '''
+        CREATE TABLE balance_snapshots (
+            user_id INTEGER NOT NULL REFERENCES users(id),
+            txid_upto BIGINT NOT NULL,
+            ledger_id BIGINT NOT NULL,
+            balance BIGINT NOT NULL,
+            as_of TIMESTAMP NOT NULL,
+            PRIMARY KEY (user_id, txid_upto)
+        )
+        ''',
+        '''
+        CREATE TABLE balance_snapshot_runs (
+            txid_upto BIGINT PRIMARY KEY,
+            snapshots INTEGER NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _assign_invite_codes(cur, page_size=10000):
+    # 为所有用户写入由 id 生成的邀请码；旧邀请码已先行清空，新旧编码之间不会触发唯一约束。
+    # 新邀请码恰好等于某个旧邀请码时以旧邀请码的持有者为准：该用户不分配新邀请码，记录冲突，
+    # 之后继续使用自己的旧邀请码（如有）
+    cur.execute("SELECT legacy_invite_code FROM users WHERE legacy_invite_code IS NOT NULL")
+    legacy_codes = {row['legacy_invite_code'] for row in cur.fetchall()}
+    cur.execute("SELECT id FROM users WHERE invite_code IS NULL ORDER BY id")
+    rows = []
+    for row in cur.fetchall():
+        code = invite_codes.encode(row['id'])
+        if code in legacy_codes:
+            logger.warning(f"Derived invite code {code} of user {row['id']} equals a legacy invite code, not assigned")
+            continue
+        rows.append((row['id'], code))
+    execute_values(
+        cur,
+        "UPDATE users u SET invite_code = v.code FROM (VALUES %s) AS v (id, code) WHERE u.id = v.id",
+        rows,
+        page_size=page_size,
+    )
+    logger.info(f"Assigned invite codes to {len(rows)} users")
+
+
+def _supersede_legacy_pending_games(cur):
+    # 旧流程下注时插入 pending 行，结算另插一行 completed，取消只退款，都不更新 pending 行，
+    # 这些行的 pending 状态不可信：按 pending 过期会再退一次款，预热后旧链接还能再次加入、结算。
+    # 本迁移与新的待对战流程同时发布，执行时所有 pending 行都来自旧流程，一律标记为 superseded，不退款
+    cur.execute("""
+        UPDATE game_history gh
+        SET status = 'superseded', updated_at = CURRENT_TIMESTAMP
+        WHERE gh.status = 'pending'
+          AND EXISTS (SELECT 1 FROM game_history c WHERE c.game_id = gh.game_id AND c.status = 'completed')
+    """)
+    settled = cur.rowcount
+    cur.execute("UPDATE game_history SET status = 'superseded', updated_at = CURRENT_TIMESTAMP WHERE status = 'pending'")
+    logger.warning(f"Superseded {settled + cur.rowcount} legacy pending games without refund ({settled} had a completed row)")
+
+
+def get_schema_version(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('schema_migrations') AS tbl")
+        if cur.fetchone()['tbl'] is None:
+            return 0
+        cur.execute("SELECT COALESCE(MAX(version), 0) AS version FROM schema_migrations")
+        return cur.fetchone()['version']
+
+
+def run_migrations():
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cur.execute("SELECT version FROM schema_migrations")
+            applied = {row['version'] for row in cur.fetchall()}
+        conn.commit()
+
+        for version, name, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            try:
+                with conn.cursor() as cur:
+                    for statement in statements:
+                        if callable(statement):
+                            statement(cur)
+                        else:
+                            cur.execute(statement)
+                    cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+                conn.commit()
+                logger.info(f"Applied migration {version}: {name}")
+            except psycopg2.Error as e:
+                conn.rollback()
+                logger.error(f"Migration {version} ({name}) failed: {e}")
+                raise
+    finally:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+            conn.commit()
+        finally:
+            put_db_connection(conn)
+
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def ensure_schema():
+    """确保数据库结构为最新版本，同一进程内只检查一次。
+
+    版本号已是最新时只执行一条查询，不获取迁移锁、不执行任何 DDL。
+    """
+    global _schema_ready
+    if _schema_ready:
+        return False
+    with _schema_lock:
+        if _schema_ready:
+            return False
+        conn = get_db_connection()
+        try:
+            version = get_schema_version(conn)
+            conn.rollback()
+        finally:
+            put_db_connection(conn)
+        migrated = version < LATEST_VERSION
+        if migrated:
+            logger.info(f"Schema version {version} is behind {LATEST_VERSION}, running migrations")
+            run_migrations()
+        _schema_ready = True
+        return migrated
+
+
+# 热点查询及其应当命中的索引。SQL 与 bot.py 中对应的数据访问函数保持一致。
+HOT_QUERIES = [
+    ('get_user_game_history_page', """
+        SELECT gh.*, ua.username as player_a_username, ub.username as player_b_username
+        FROM (
+            (SELECT * FROM game_history
+             WHERE player_a_id = %(user_id)s AND status = %(status)s
+               AND (created_at, id) < (%(created_at)s, %(id)s)
+             ORDER BY created_at DESC, id DESC LIMIT 6)
+            UNION ALL
+            (SELECT * FROM game_history
+             WHERE player_b_id = %(user_id)s AND status = %(status)s
+               AND (created_at, id) < (%(created_at)s, %(id)s)
+             ORDER BY created_at DESC, id DESC LIMIT 6)
+        ) gh
+        LEFT JOIN users ua ON gh.player_a_id = ua.id
+        LEFT JOIN users ub ON gh.player_b_id = ub.id
+        ORDER BY gh.created_at DESC, gh.id DESC
+        LIMIT 6
+    """, {'user_id': 1, 'status': 'completed', 'created_at': '2100-01-01', 'id': 0},
+        {'idx_game_history_player_a_status_created', 'idx_game_history_player_b_status_created'}),
+    ('get_user_pending_games', """
+        SELECT * FROM game_history
+        WHERE player_a_id = %s AND player_b_id IS NULL AND status = 'pending'
+        ORDER BY created_at DESC
+    """, (1,), {'idx_game_history_pending_creator'}),
+    ('get_user_completed_games', """
+        SELECT gh.*, ua.username as player_a_username, ub.username as player_b_username
+        FROM game_history gh
+        LEFT JOIN users ua ON gh.player_a_id = ua.id
+        LEFT JOIN users ub ON gh.player_b_id = ub.id
+        WHERE (gh.player_a_id = %s OR gh.player_b_id = %s) AND gh.status = 'completed'
+        ORDER BY gh.created_at DESC
+        LIMIT 10
+    """, (1, 1), {'idx_game_history_player_a_status_created', 'idx_game_history_player_b_status_created'}),
+    ('get_invited_users', """
+        SELECT id, username, created_at FROM users
+        WHERE inviter_id = %s AND id > %s
+        ORDER BY id
+        LIMIT 21
+    """, (1, 0), {'idx_users_inviter_id_id'}),
+    ('get_invite_summary', """
+        SELECT s.invited_count, s.total_earnings,
+               (SELECT COALESCE(SUM(d.earnings), 0) FROM invite_earnings_daily d
+                WHERE d.inviter_id = s.inviter_id AND d.day > CURRENT_DATE - %s) AS recent_earnings
+        FROM invite_stats s
+        WHERE s.inviter_id = %s
+    """, (7, 1), {'invite_stats_pkey', 'invite_earnings_daily_pkey'}),
+    ('get_user_by_invite_code', """
+        (SELECT * FROM users WHERE legacy_invite_code = %(legacy_code)s LIMIT 1)
+        UNION ALL
+        SELECT * FROM users WHERE id = %(user_id)s AND invite_code = %(invite_code)s
+        LIMIT 1
+    """, {'user_id': 1, 'invite_code': 'ABC123', 'legacy_code': 'ABC123'},
+        {'users_pkey', 'idx_users_legacy_invite_code'}),
+    ('expire_pending_games', """
+        SELECT id FROM game_history
+        WHERE status = 'pending' AND player_b_id IS NULL
+          AND created_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 second'
+        ORDER BY created_at
+        LIMIT 5000
+    """, (86400,), {'idx_game_history_pending_created'}),
+    ('get_balance_at', """
+        WITH snap AS (
+            SELECT txid_upto, balance FROM balance_snapshots
+            WHERE user_id = %(user_id)s AND as_of <= %(at)s
+            ORDER BY txid_upto DESC
+            LIMIT 1
+        )
+        SELECT COALESCE((SELECT balance FROM snap), 0) + COALESCE(SUM(l.amount), 0) AS balance
+        FROM balance_ledger l
+        WHERE l.user_id = %(user_id)s
+          AND l.txid >= COALESCE((SELECT txid_upto FROM snap), 0)
+          AND l.created_at <= %(at)s
+    """, {'user_id': 1, 'at': '2100-01-01'}, {'balance_snapshots_pkey', 'idx_balance_ledger_user_id'}),
+    ('settle_game', """
+        SELECT id FROM game_history WHERE game_id = %s AND status = 'pending'
+    """, ('00000000-0000-0000-0000-000000000000',), {'idx_game_history_game_id'}),
+]
+
+
+def _used_indexes(plan):
+    indexes = set()
+    if 'Index Name' in plan:
+        indexes.add(plan['Index Name'])
+    for child in plan.get('Plans', []):
+        indexes |= _used_indexes(child)
+    return indexes
+
+
+def check_query_plans():
+    """对每个热点查询执行 EXPLAIN，确认计划中使用了预期的索引，返回 {查询名: (是否通过, 使用的索引)}。
+
+    测试库数据量小时规划器倾向于顺序扫描，因此检查期间关闭 enable_seqscan，
+    用来证明索引对该查询可用，而不是比较真实负载下的代价。
+    """
+    results = {}
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SET LOCAL enable_seqscan = off")
+            for name, sql, params, expected in HOT_QUERIES:
+                cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+                plan = cur.fetchone()['QUERY PLAN']
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                used = _used_indexes(plan[0]['Plan'])
+                results[name] = (expected <= used, used)
+        conn.rollback()
+    finally:
+        put_db_connection(conn)
+    return results
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    run_migrations()
+    if '--check' in sys.argv:
+        failed = False
+        for name, (ok, used) in check_query_plans().items():
+            print(f"{'OK  ' if ok else 'FAIL'} {name}: {', '.join(sorted(used)) or 'no index'}")
+            failed = failed or not ok
+        sys.exit(1 if failed else 0)
@@ -0,0 +1,240 @@
+import logging
+import threading
+import psycopg2
+from db_pool import get_db_connection, put_db_connection
+from user_cache import user_cache
+from matchmaking import order_book
+
+logger = logging.getLogger(__name__)
+
+
+class PendingGameStore:
+    """以 game_history 表为准、内存索引加速的待对战游戏存储。
+
+    写操作先落库再更新索引；读操作只查内存索引，重启后通过 load() 从数据库预热。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # game_id -> {'game_id', 'creator_id', 'bet_amount', 'creator_score', 'created_at'}
+        self._games = {}
+
+    @staticmethod
+    def _from_row(row):
+        return {
+            'game_id': row['game_id'],
+            'creator_id': row['player_a_id'],
+            'bet_amount': row['bet_amount'],
+            'creator_score': row['player_a_score'] or 0,
+            'created_at': row['created_at'],
+        }
+
+    def load(self):
+        # 旧流程遗留的 pending 行不可信，由迁移 11 标记为 superseded，必须在迁移之后调用（见 startup.bootstrap）；
+        # 同一 game_id 已有 completed 记录的行即使仍是 pending 也不加载，避免旧链接被再次加入、结算
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT gh.game_id, gh.player_a_id, gh.bet_amount, gh.player_a_score, gh.created_at
+                    FROM game_history gh
+                    WHERE gh.status = 'pending' AND gh.player_b_id IS NULL
+                      AND NOT EXISTS (
+                          SELECT 1 FROM game_history c
+                          WHERE c.game_id = gh.game_id AND c.status = 'completed'
+                      )
+                """)
+                rows = cur.fetchall()
+        finally:
+            put_db_connection(conn)
+        games = {row['game_id']: self._from_row(row) for row in rows}
+        with self._lock:
+            self._games = games
+        # 创建者已掷完骰子（得分非 0）的挑战按创建时间重新进入匹配队列
+        for game in sorted(games.values(), key=lambda g: g['created_at']):
+            if game['creator_score']:
+                order_book.add(game['game_id'], game['bet_amount'], game['creator_id'])
+        logger.info(f"Loaded {len(games)} pending games")
+        return len(games)
+
+    def get(self, game_id):
+        with self._lock:
+            game = self._games.get(game_id)
+            return dict(game) if game else None
+
+    def __contains__(self, game_id):
+        with self._lock:
+            return game_id in self._games
+
+    def __len__(self):
+        with self._lock:
+            return len(self._games)
+
+    def create(self, game_id, creator_id, bet_amount):
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO game_history (game_id, player_a_id, player_b_id, bet_amount, player_a_score, player_b_score, winner_id, win_amount, status, created_at, updated_at)
+                    VALUES (%s, %s, NULL, %s, 0, 0, NULL, 0, 'pending', CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+                    RETURNING game_id, player_a_id, bet_amount, player_a_score, created_at
+                """, (game_id, creator_id, bet_amount))
+                row = cur.fetchone()
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            logger.error(f"Error creating pending game: {e}")
+            raise
+        finally:
+            put_db_connection(conn)
+        game = self._from_row(row)
+        with self._lock:
+            self._games[game_id] = game
+        logger.info(f"Created pending game: game_id={game_id}, creator_id={creator_id}, bet_amount={bet_amount}")
+        return dict(game)
+
+    def set_creator_score(self, game_id, creator_score):
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE game_history
+                    SET player_a_score = %s, updated_at = CURRENT_TIMESTAMP
+                    WHERE game_id = %s AND status = 'pending'
+                """, (creator_score, game_id))
+                updated = cur.rowcount
+            conn.commit()
+        finally:
+            put_db_connection(conn)
+        with self._lock:
+            game = self._games.get(game_id)
+            if game and updated:
+                game['creator_score'] = creator_score
+            game = dict(game) if game and updated else None
+        if game:
+            # 创建者得分确定后挑战才可以被快速匹配
+            order_book.add(game_id, game['bet_amount'], game['creator_id'])
+        return game
+
+    def cancel(self, game_id):
+        # 取消待对战游戏并在同一条语句中退还创建者的下注金额、写入流水，返回退还金额；游戏不存在时返回 0
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    WITH cancelled AS (
+                        UPDATE game_history
+                        SET status = 'cancelled', updated_at = CURRENT_TIMESTAMP
+                        WHERE game_id = %s AND status = 'pending'
+                        RETURNING game_id, player_a_id, bet_amount
+                    ),
+                    refunded AS (
+                        UPDATE users u
+                        SET balance = u.balance + c.bet_amount,
+                            updated_at = CURRENT_TIMESTAMP
+                        FROM cancelled c
+                        WHERE u.id = c.player_a_id
+                        RETURNING u.id, u.telegram_id, c.bet_amount, c.game_id
+                    ),
+                    ledger AS (
+                        INSERT INTO balance_ledger (user_id, amount, kind, ref)
+                        SELECT id, bet_amount, 'refund', game_id FROM refunded
+                    )
+                    SELECT telegram_id, bet_amount FROM refunded
+                """, (game_id,))
+                row = cur.fetchone()
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            logger.error(f"Error cancelling pending game {game_id}: {e}")
+            raise
+        finally:
+            put_db_connection(conn)
+        self.remove(game_id)
+        if not row:
+            return 0
+        user_cache.invalidate(telegram_id=row['telegram_id'])
+        logger.info(f"Cancelled pending game {game_id}, refunded {row['bet_amount']}")
+        return row['bet_amount']
+
+    def expire(self, ttl_seconds, batch_size):
+        """把超过 ttl_seconds 仍无人加入的挑战标记为 expired，并在同一条语句中退还创建者的下注金额、写入流水。
+
+        旧流程遗留的 pending 行由迁移 11 标记为 superseded，不会在这里退款；
+        同一 game_id 已有 completed 记录的行同样跳过。
+
+        每次最多处理 batch_size 行，返回 [{'game_id', 'bet_amount', 'telegram_id'}]；
+        调用方循环调用直到返回的行数少于 batch_size。
+        """
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    WITH expired AS (
+                        UPDATE game_history gh
+                        SET status = 'expired', updated_at = CURRENT_TIMESTAMP
+                        WHERE gh.id IN (
+                            SELECT id FROM game_history
+                            WHERE status = 'pending' AND player_b_id IS NULL
+                              AND created_at < CURRENT_TIMESTAMP - %(ttl)s * INTERVAL '1 second'
+                              AND NOT EXISTS (
+                                  SELECT 1 FROM game_history c
+                                  WHERE c.game_id = game_history.game_id AND c.status = 'completed'
+                              )
+                            ORDER BY created_at
+                            LIMIT %(limit)s
+                            FOR UPDATE SKIP LOCKED
+                        ) AND gh.status = 'pending'
+                        RETURNING gh.game_id, gh.player_a_id, gh.bet_amount
+                    ),
+                    refunded AS (
+                        UPDATE users u
+                        SET balance = u.balance + r.amount,
+                            updated_at = CURRENT_TIMESTAMP
+                        FROM (
+                            SELECT player_a_id, SUM(bet_amount) AS amount
+                            FROM expired
+                            GROUP BY player_a_id
+                        ) r
+                        WHERE u.id = r.player_a_id
+                        RETURNING u.id, u.telegram_id
+                    ),
+                    ledger AS (
+                        INSERT INTO balance_ledger (user_id, amount, kind, ref)
+                        SELECT e.player_a_id, e.bet_amount, 'refund', e.game_id
+                        FROM expired e
+                        JOIN refunded r ON r.id = e.player_a_id
+                    )
+                    SELECT e.game_id, e.bet_amount, r.telegram_id
+                    FROM expired e
+                    LEFT JOIN refunded r ON r.id = e.player_a_id
+                """, {'ttl': ttl_seconds, 'limit': batch_size})
+                rows = cur.fetchall()
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            logger.error(f"Error expiring pending games: {e}")
+            raise
+        finally:
+            put_db_connection(conn)
+
+        self.remove_many(row['game_id'] for row in rows)
+        user_cache.invalidate_many({row['telegram_id'] for row in rows if row['telegram_id']})
+        return rows
+
+    def remove_many(self, game_ids):
+        game_ids = list(game_ids)
+        for game_id in game_ids:
+            order_book.remove(game_id)
+        with self._lock:
+            for game_id in game_ids:
+                self._games.pop(game_id, None)
+
+    def remove(self, game_id):
+        # 仅移除内存索引与匹配队列，数据库状态由结算/取消语句负责
+        order_book.remove(game_id)
+        with self._lock:
+            return self._games.pop(game_id, None)
+
+
+pending_store = PendingGameStore()
@@ -0,0 +1,137 @@
+import re
+import sys
+import time
+import random
+import logging
+import functools
+import threading
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.extras import RealDictCursor
+from config import DB_SLOW_QUERY_MS, DB_EXPLAIN_SAMPLE_RATE
+from metrics import db_slow_queries
+
+logger = logging.getLogger(__name__)
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_WHITESPACE = re.compile(r"\s+")
+# 只有这些语句能被 EXPLAIN
+_EXPLAINABLE = re.compile(r"^\s*(SELECT|WITH|VALUES|INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(query):
+    # 语句模板中的参数是 %s，这里再把内联的字面量替换掉，使同一类语句归为一组
+    query = _STRING_LITERAL.sub('?', query)
+    query = _NUMBER_LITERAL.sub('?', query)
+    return _WHITESPACE.sub(' ', query).strip()
+
+
+class QueryProfiler:
+    """按语句指纹汇总耗时与行数，记录超过阈值的慢查询，并对部分慢查询抓取 EXPLAIN 执行计划。"""
+
+    def __init__(self, slow_ms=200, explain_sample_rate=0.0):
+        self.slow_seconds = slow_ms / 1000
+        self.explain_sample_rate = explain_sample_rate
+        self._lock = threading.Lock()
+        # 指纹 -> {'calls', 'total', 'max', 'rows', 'slow', 'callers'}
+        self._stats = {}
+
+    def record(self, cursor, query, vars, elapsed, frame, failed, explainable=True):
+        text = query if isinstance(query, str) else query.decode() if isinstance(query, bytes) else str(query)
+        key = fingerprint(text)
+        caller = f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_name}"
+        rows = cursor.rowcount if not failed else -1
+        slow = elapsed >= self.slow_seconds
+
+        with self._lock:
+            entry = self._stats.get(key)
+            if entry is None:
+                entry = self._stats[key] = {'calls': 0, 'total': 0.0, 'max': 0.0, 'rows': 0, 'slow': 0, 'callers': set()}
+            entry['calls'] += 1
+            entry['total'] += elapsed
+            entry['max'] = max(entry['max'], elapsed)
+            entry['rows'] += max(rows, 0)
+            entry['slow'] += slow
+            entry['callers'].add(caller)
+
+        if not slow:
+            return
+        db_slow_queries.inc((caller,))
+        logger.warning(f"Slow query ({elapsed * 1000:.1f}ms, {rows} rows) in {caller}: {key[:500]}")
+        if explainable and not failed and self.explain_sample_rate and random.random() < self.explain_sample_rate:
+            self._explain(cursor.connection, text, vars, caller)
+
+    def _explain(self, conn, query, vars, caller):
+        # 只做不带 ANALYZE 的 EXPLAIN：ANALYZE 会把语句真正再执行一次，
+        # 即使是 SELECT 也可能有副作用（advisory lock、nextval、调用会写库的函数），重复执行不安全
+        if not _EXPLAINABLE.match(query):
+            return
+        # 用保存点隔离，EXPLAIN 失败时不影响调用方所在的事务
+        in_transaction = conn.get_transaction_status() == extensions.TRANSACTION_STATUS_INTRANS
+        try:
+            with conn.cursor(cursor_factory=extensions.cursor) as cur:
+                if in_transaction:
+                    cur.execute("SAVEPOINT query_profiler_explain")
+                try:
+                    cur.execute("EXPLAIN " + query, vars)
+                    plan = '\n'.join(row[0] for row in cur.fetchall())
+                except psycopg2.Error as e:
+                    if in_transaction:
+                        cur.execute("ROLLBACK TO SAVEPOINT query_profiler_explain")
+                    logger.warning(f"EXPLAIN failed for slow query in {caller}: {e}")
+                    return
+                if in_transaction:
+                    cur.execute("RELEASE SAVEPOINT query_profiler_explain")
+        except psycopg2.Error as e:
+            logger.warning(f"Could not capture plan for slow query in {caller}: {e}")
+            return
+        logger.warning(f"Plan for slow query in {caller}:\n{plan}")
+
+    def top(self, n=10, order_by='total'):
+        with self._lock:
+            items = [(key, dict(entry, callers=sorted(entry['callers']))) for key, entry in self._stats.items()]
+        items.sort(key=lambda item: item[1][order_by], reverse=True)
+        return items[:n]
+
+    def report(self, n=10):
+        lines = [f"{'calls':>8}{'total ms':>12}{'avg ms':>10}{'max ms':>10}{'rows':>10}{'slow':>6}  callers / statement"]
+        for key, entry in self.top(n):
+            lines.append(
+                f"{entry['calls']:>8}{entry['total'] * 1000:>12.1f}{entry['total'] / entry['calls'] * 1000:>10.2f}"
+                f"{entry['max'] * 1000:>10.1f}{entry['rows']:>10}{entry['slow']:>6}  "
+                f"{', '.join(entry['callers'])}\n{'':>58}{key[:200]}"
+            )
+        return '\n'.join(lines)
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+profiler = QueryProfiler(slow_ms=DB_SLOW_QUERY_MS, explain_sample_rate=DB_EXPLAIN_SAMPLE_RATE)
+
+
+class ProfilingCursor(RealDictCursor):
+    """RealDictCursor 的子类，连接池开启剖析时作为默认 cursor_factory，对调用方透明。"""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = super().execute(query, vars)
+            failed = False
+            return result
+        finally:
+            profiler.record(self, query, vars, time.perf_counter() - started, sys._getframe(1), failed)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = super().executemany(query, vars_list)
+            failed = False
+            return result
+        finally:
+            profiler.record(self, query, None, time.perf_counter() - started, sys._getframe(1), failed, explainable=False)
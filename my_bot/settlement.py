@@ -0,0 +1,341 @@
+import sys
+import time
+import uuid
+import logging
+import psycopg2
+from concurrent.futures import ThreadPoolExecutor
+from db_pool import get_db_connection, put_db_connection
+from user_cache import user_cache
+from config import PROJECT_ACCOUNT_ID, FEE_ROLLUP_BATCH
+
+logger = logging.getLogger(__name__)
+
+# 奖池分配比例（以下注金额为基数）：赢家拿回本金并获得 90%，上级邀约者 7%，项目方 3%
+WINNER_SHARE_PERCENT = 90
+INVITER_SHARE_PERCENT = 7
+PROJECT_SHARE_PERCENT = 3
+
+
+def split_pot(bet_amount):
+    win_amount = bet_amount * WINNER_SHARE_PERCENT // 100
+    inviter_amount = bet_amount * INVITER_SHARE_PERCENT // 100
+    project_amount = bet_amount * PROJECT_SHARE_PERCENT // 100
+    return win_amount, inviter_amount, project_amount
+
+
+# 一条语句完成一局对战的全部结算：
+#   1. 把 pending 的对战记录改为 completed（条件更新，重复结算时不会命中任何行）
+#   2. 依据这一行是否更新成功，给赢家入账
+#   3. 上级邀约者与项目方的手续费追加写入 fee_accruals，由 rollup_fee_accruals 定期汇总入账
+#   4. 入账同时写入余额流水 balance_ledger
+# 所有对局都要给项目方入账，直接更新项目方所在的 users 行会让所有结算排队等同一把行锁；
+# 追加写入不锁任何已有行，结算吞吐随并发数增长。所有修改位于同一事务中，任何一步失败都会整体回滚。
+SETTLE_WIN_SQL = """
+    WITH settled AS (
+        UPDATE game_history
+        SET player_b_id = %(challenger_id)s,
+            player_a_score = %(creator_score)s,
+            player_b_score = %(challenger_score)s,
+            winner_id = %(winner_id)s,
+            win_amount = %(win_amount)s,
+            status = 'completed',
+            updated_at = CURRENT_TIMESTAMP
+        WHERE game_id = %(game_id)s AND status = 'pending'
+        RETURNING id
+    ),
+    winner AS (
+        SELECT u.id, u.inviter_id
+        FROM users u, settled
+        WHERE u.id = %(winner_id)s
+    ),
+    accruals AS (
+        INSERT INTO fee_accruals (user_id, kind, amount, game_history_id)
+        SELECT winner.inviter_id, 'inviter', %(inviter_amount)s, settled.id
+        FROM winner, settled
+        WHERE winner.inviter_id IS NOT NULL
+        UNION ALL
+        SELECT %(project_id)s, 'project', %(project_amount)s, id FROM settled
+    ),
+    credited AS (
+        UPDATE users u
+        SET balance = u.balance + %(payout)s,
+            updated_at = CURRENT_TIMESTAMP
+        FROM winner
+        WHERE u.id = winner.id
+        RETURNING u.id, u.telegram_id
+    ),
+    ledger AS (
+        INSERT INTO balance_ledger (user_id, amount, kind, ref)
+        SELECT id, %(payout)s, 'win', %(game_id)s FROM credited
+    )
+    SELECT (SELECT id FROM settled) AS history_id,
+           ARRAY(SELECT telegram_id FROM credited) AS credited_telegram_ids
+"""
+
+# 平局：双方各自退回本金，记录标记为 completed 且没有赢家
+SETTLE_TIE_SQL = """
+    WITH settled AS (
+        UPDATE game_history
+        SET player_b_id = %(challenger_id)s,
+            player_a_score = %(creator_score)s,
+            player_b_score = %(challenger_score)s,
+            winner_id = NULL,
+            win_amount = 0,
+            status = 'completed',
+            updated_at = CURRENT_TIMESTAMP
+        WHERE game_id = %(game_id)s AND status = 'pending'
+        RETURNING id
+    ),
+    credited AS (
+        UPDATE users u
+        SET balance = u.balance + %(bet_amount)s,
+            updated_at = CURRENT_TIMESTAMP
+        FROM settled
+        WHERE u.id IN (%(creator_id)s, %(challenger_id)s)
+        RETURNING u.id, u.telegram_id
+    ),
+    ledger AS (
+        INSERT INTO balance_ledger (user_id, amount, kind, ref)
+        SELECT id, %(bet_amount)s, 'tie', %(game_id)s FROM credited
+    )
+    SELECT (SELECT id FROM settled) AS history_id,
+           ARRAY(SELECT telegram_id FROM credited) AS credited_telegram_ids
+"""
+
+
+def settle_game(game_id, creator_id, challenger_id, bet_amount, creator_score, challenger_score):
+    """在单个事务中结算对战，返回结算结果；对战已结算或不存在时返回 None。"""
+    if challenger_score > creator_score:
+        winner_id = challenger_id
+    elif challenger_score < creator_score:
+        winner_id = creator_id
+    else:
+        winner_id = None
+
+    win_amount, inviter_amount, project_amount = split_pot(bet_amount)
+    params = {
+        'game_id': game_id,
+        'creator_id': creator_id,
+        'challenger_id': challenger_id,
+        'creator_score': creator_score,
+        'challenger_score': challenger_score,
+        'bet_amount': bet_amount,
+        'winner_id': winner_id,
+        'win_amount': win_amount,
+        'payout': bet_amount + win_amount,
+        'inviter_amount': inviter_amount,
+        'project_id': PROJECT_ACCOUNT_ID,
+        'project_amount': project_amount,
+    }
+
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(SETTLE_TIE_SQL if winner_id is None else SETTLE_WIN_SQL, params)
+            row = cur.fetchone()
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        logger.error(f"Error settling game {game_id}: {e}")
+        raise
+    finally:
+        put_db_connection(conn)
+
+    user_cache.invalidate_many(row['credited_telegram_ids'])
+    if row['history_id'] is None:
+        logger.warning(f"Game {game_id} was already settled or does not exist")
+        return None
+
+    logger.info(f"Settled game {game_id}: winner_id={winner_id}, bet_amount={bet_amount}")
+    return {
+        'game_id': game_id,
+        'winner_id': winner_id,
+        'win_amount': win_amount,
+        'inviter_amount': inviter_amount,
+        'project_amount': project_amount,
+        'credited_telegram_ids': row['credited_telegram_ids'],
+    }
+
+
+# 按账户汇总一批手续费后一次性入账，并同步邀约收益汇总；只删除实际入账的记录，
+# 账户不存在时记录保留在 fee_accruals 中，不会删除后丢失。
+# 余额流水按账户与手续费类型各写一行，不为每笔 accrual 单独记录。
+# SKIP LOCKED 使多个进程同时汇总时互不阻塞，也不会重复入账。
+ROLLUP_FEES_SQL = """
+    WITH batch AS (
+        SELECT id, user_id, kind, amount, created_at
+        FROM fee_accruals
+        ORDER BY id
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    ),
+    totals AS (
+        SELECT user_id,
+               SUM(amount) AS amount,
+               SUM(CASE WHEN kind = 'inviter' THEN amount ELSE 0 END) AS invite_amount
+        FROM batch
+        GROUP BY user_id
+    ),
+    credited AS (
+        UPDATE users u
+        SET balance = u.balance + t.amount,
+            invite_earnings = u.invite_earnings + t.invite_amount,
+            updated_at = CURRENT_TIMESTAMP
+        FROM totals t
+        WHERE u.id = t.user_id
+        RETURNING u.id, u.telegram_id
+    ),
+    done AS (
+        DELETE FROM fee_accruals
+        WHERE id IN (SELECT b.id FROM batch b JOIN credited c ON c.id = b.user_id)
+        RETURNING user_id, kind, amount, created_at
+    ),
+    inviter_stats AS (
+        INSERT INTO invite_stats (inviter_id, total_earnings)
+        SELECT user_id, SUM(amount) FROM done WHERE kind = 'inviter' GROUP BY user_id
+        ON CONFLICT (inviter_id) DO UPDATE
+        SET total_earnings = invite_stats.total_earnings + EXCLUDED.total_earnings,
+            updated_at = CURRENT_TIMESTAMP
+    ),
+    inviter_daily AS (
+        INSERT INTO invite_earnings_daily (inviter_id, day, earnings)
+        SELECT user_id, created_at::date, SUM(amount)
+        FROM done
+        WHERE kind = 'inviter'
+        GROUP BY user_id, created_at::date
+        ON CONFLICT (inviter_id, day) DO UPDATE
+        SET earnings = invite_earnings_daily.earnings + EXCLUDED.earnings
+    ),
+    ledger AS (
+        INSERT INTO balance_ledger (user_id, amount, kind)
+        SELECT user_id, SUM(amount), kind || '_fee'
+        FROM done
+        GROUP BY user_id, kind
+    )
+    SELECT (SELECT COUNT(*) FROM batch) AS accruals,
+           (SELECT COUNT(*) FROM done) AS credited_accruals,
+           ARRAY(SELECT telegram_id FROM credited) AS credited_telegram_ids
+"""
+
+
+def rollup_fee_accruals(batch_size=FEE_ROLLUP_BATCH):
+    """把待入账的手续费汇总进账户余额，返回本批入账的记录数；调用方循环调用直到返回值小于 batch_size。
+
+    先入账再删除实际入账的记录，账户不存在的记录保留在 fee_accruals 中并记录告警。
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(ROLLUP_FEES_SQL, {'limit': batch_size})
+            row = cur.fetchone()
+        conn.commit()
+    except psycopg2.Error as e:
+        conn.rollback()
+        logger.error(f"Error rolling up fee accruals: {e}")
+        raise
+    finally:
+        put_db_connection(conn)
+
+    user_cache.invalidate_many(row['credited_telegram_ids'])
+    if row['credited_accruals']:
+        logger.info(f"Rolled up {row['credited_accruals']} fee accruals into {len(row['credited_telegram_ids'])} accounts")
+    if row['credited_accruals'] < row['accruals']:
+        logger.warning(f"{row['accruals'] - row['credited_accruals']} fee accruals reference missing accounts and were kept")
+    return row['credited_accruals']
+
+
+def _legacy_settle(game_id, creator_id, challenger_id, bet_amount, creator_score, challenger_score):
+    # 旧版 finish_game 的结算方式：每一步单独取连接、单独提交，仅用于基准对比
+    def execute(sql, args, fetch=False):
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql, args)
+                result = cur.fetchone() if fetch else None
+            conn.commit()
+            return result
+        finally:
+            put_db_connection(conn)
+
+    winner_id = challenger_id if challenger_score > creator_score else creator_id
+    win_amount, inviter_amount, project_amount = split_pot(bet_amount)
+    winner = execute("SELECT * FROM users WHERE id = %s", (winner_id,), fetch=True)
+    execute("UPDATE users SET balance = balance + %s, updated_at = CURRENT_TIMESTAMP WHERE telegram_id = %s",
+            (bet_amount + win_amount, winner['telegram_id']))
+    inviter = execute("SELECT * FROM users WHERE id = %s", (winner['inviter_id'],), fetch=True)
+    if inviter:
+        execute("""UPDATE users SET balance = balance + %s, invite_earnings = invite_earnings + %s,
+                   updated_at = CURRENT_TIMESTAMP WHERE telegram_id = %s""",
+                (inviter_amount, inviter_amount, inviter['telegram_id']))
+    project = execute("SELECT * FROM users WHERE id = %s", (PROJECT_ACCOUNT_ID,), fetch=True)
+    if project:
+        execute("UPDATE users SET balance = balance + %s, updated_at = CURRENT_TIMESTAMP WHERE telegram_id = %s",
+                (project_amount, project['telegram_id']))
+    execute("""UPDATE game_history SET player_b_id = %s, player_a_score = %s, player_b_score = %s,
+               winner_id = %s, win_amount = %s, status = 'completed' WHERE game_id = %s""",
+            (challenger_id, creator_score, challenger_score, winner_id, win_amount, game_id))
+
+
+def benchmark(rounds=200, concurrency=1):
+    """对比旧版多次往返结算与单事务结算的吞吐（每秒结算局数）。会在当前数据库中写入测试数据。
+
+    concurrency > 1 时每个线程使用各自的一对玩家，所有赢家共用同一个邀约者，
+    用来观察项目方、邀约者等共享账户是否让并发结算互相等待。
+    """
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO users (telegram_id, username, balance)
+                VALUES ('bench_inviter', 'bench_inviter', 0)
+                ON CONFLICT (telegram_id) DO UPDATE SET username = EXCLUDED.username
+                RETURNING id
+            """)
+            inviter_id = cur.fetchone()['id']
+            pairs = []
+            for i in range(concurrency):
+                cur.execute("""
+                    INSERT INTO users (telegram_id, username, balance, inviter_id)
+                    VALUES (%(creator)s, %(creator)s, 0, %(inviter_id)s), (%(challenger)s, %(challenger)s, 0, %(inviter_id)s)
+                    ON CONFLICT (telegram_id) DO UPDATE SET inviter_id = EXCLUDED.inviter_id
+                    RETURNING id
+                """, {'creator': f'bench_creator_{i}', 'challenger': f'bench_challenger_{i}', 'inviter_id': inviter_id})
+                pairs.append(tuple(row['id'] for row in cur.fetchall()))
+        conn.commit()
+    finally:
+        put_db_connection(conn)
+
+    def create_pending_games(n):
+        games = [(str(uuid.uuid4()), pairs[i % concurrency]) for i in range(n)]
+        conn = get_db_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.executemany(
+                    "INSERT INTO game_history (game_id, player_a_id, bet_amount, player_a_score, player_b_score, win_amount, status) "
+                    "VALUES (%s, %s, 100, 10, 0, 0, 'pending')",
+                    [(game_id, creator_id) for game_id, (creator_id, _) in games]
+                )
+            conn.commit()
+        finally:
+            put_db_connection(conn)
+        return games
+
+    results = {}
+    for name, settle in (('legacy', _legacy_settle), ('single_transaction', settle_game)):
+        games = create_pending_games(rounds)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(lambda game: settle(game[0], game[1][0], game[1][1], 100, 10, 12), games))
+        elapsed = time.perf_counter() - started
+        results[name] = rounds / elapsed
+        print(f"{name}: {rounds} settlements with concurrency {concurrency} in {elapsed:.2f}s ({results[name]:.1f}/s)")
+
+    started = time.perf_counter()
+    while rollup_fee_accruals() == FEE_ROLLUP_BATCH:
+        pass
+    print(f"fee rollup: {time.perf_counter() - started:.2f}s")
+    return results
+
+
+if __name__ == '__main__':
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 200, int(sys.argv[2]) if len(sys.argv) > 2 else 1)
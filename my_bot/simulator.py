@@ -0,0 +1,226 @@
+"""对战经济模型的向量化蒙特卡洛模拟。
+
+规则与线上结算一致（settlement.settle_game）：双方各掷 3 颗骰子，点数高者拿回本金并获得下注额的 90%，
+赢家的上级邀约者获得 7%，项目方获得 3%；平局双方退回本金。赢家没有邀约者时，7% 不会入账到任何人。
+
+用法示例：
+    python simulator.py --matches 5000000 --inviter-rate 0.6
+    python simulator.py --players 10000 --rounds 500
+"""
+import argparse
+import numpy as np
+from settlement import WINNER_SHARE_PERCENT, INVITER_SHARE_PERCENT, PROJECT_SHARE_PERCENT
+
+# process_bet 允许的下注档位：100 ~ 1000，100 的倍数
+BET_TIERS = np.arange(100, 1001, 100)
+DICE_PER_PLAYER = 3
+STARTING_BALANCE = 1000
+
+
+def exact_score_distribution(dice=DICE_PER_PLAYER):
+    """通过卷积得到 dice 颗骰子点数和的精确分布，下标为点数和。"""
+    face = np.zeros(7)
+    face[1:] = 1 / 6
+    dist = np.array([1.0])
+    for _ in range(dice):
+        dist = np.convolve(dist, face)
+    return dist
+
+
+def exact_match_probabilities(dice=DICE_PER_PLAYER):
+    """一局对战中创建者胜、挑战者胜、平局的精确概率。"""
+    dist = exact_score_distribution(dice)
+    tie = float(np.dot(dist, dist))
+    # 对称：双方胜率相同
+    win = (1 - tie) / 2
+    return {'creator_win': win, 'challenger_win': win, 'tie': tie}
+
+
+def expected_fees_per_match(bet_amount, inviter_rate, dice=DICE_PER_PLAYER):
+    """单局在给定下注额与“赢家有邀约者”的比例下，项目方与邀约者收益的期望。"""
+    decided = 1 - exact_match_probabilities(dice)['tie']
+    bet_amount = np.asarray(bet_amount)
+    project = decided * (bet_amount * PROJECT_SHARE_PERCENT // 100)
+    inviter = decided * inviter_rate * (bet_amount * INVITER_SHARE_PERCENT // 100)
+    return project, inviter
+
+
+def roll_scores(rng, shape, dice=DICE_PER_PLAYER):
+    # 与 game_logic.roll_dice 相同：每人 dice 颗 1~6 的骰子求和
+    return rng.integers(1, 7, size=shape + (dice,), dtype=np.int8).sum(axis=-1, dtype=np.int16)
+
+
+def simulate_matches(matches, bet_weights=None, inviter_rate=1.0, seed=None, chunk_size=1_000_000):
+    """批量模拟 matches 局相互独立的对战，按块处理以限制内存，返回汇总统计。"""
+    rng = np.random.default_rng(seed)
+    weights = None if bet_weights is None else np.asarray(bet_weights, dtype=float) / np.sum(bet_weights)
+
+    tiers = len(BET_TIERS)
+    per_tier_matches = np.zeros(tiers, dtype=np.int64)
+    per_tier_project = np.zeros(tiers, dtype=np.int64)
+    per_tier_inviter = np.zeros(tiers, dtype=np.int64)
+    ties = 0
+    unclaimed = 0
+    score_counts = np.zeros(DICE_PER_PLAYER * 6 + 1, dtype=np.int64)
+
+    remaining = matches
+    while remaining > 0:
+        n = min(chunk_size, remaining)
+        remaining -= n
+
+        tier = rng.choice(tiers, size=n, p=weights)
+        bet = BET_TIERS[tier]
+        scores = roll_scores(rng, (n, 2))
+        score_counts += np.bincount(scores.ravel(), minlength=score_counts.size)
+
+        decided = scores[:, 0] != scores[:, 1]
+        has_inviter = rng.random(n) < inviter_rate
+        project = np.where(decided, bet * PROJECT_SHARE_PERCENT // 100, 0)
+        inviter_fee = np.where(decided, bet * INVITER_SHARE_PERCENT // 100, 0)
+        inviter = np.where(has_inviter, inviter_fee, 0)
+
+        ties += int(n - decided.sum())
+        unclaimed += int((inviter_fee - inviter).sum())
+        per_tier_matches += np.bincount(tier, minlength=tiers)
+        per_tier_project += np.bincount(tier, weights=project, minlength=tiers).astype(np.int64)
+        per_tier_inviter += np.bincount(tier, weights=inviter, minlength=tiers).astype(np.int64)
+
+    return {
+        'matches': matches,
+        'tie_rate': ties / matches,
+        'project_income': int(per_tier_project.sum()),
+        'inviter_income': int(per_tier_inviter.sum()),
+        'unclaimed_inviter_fee': unclaimed,
+        'score_distribution': score_counts / score_counts.sum(),
+        'per_tier': {
+            int(BET_TIERS[i]): {
+                'matches': int(per_tier_matches[i]),
+                'project_income': int(per_tier_project[i]),
+                'inviter_income': int(per_tier_inviter[i]),
+            }
+            for i in range(tiers)
+        },
+    }
+
+
+def simulate_population(players, rounds, inviter_rate=0.8, bet_weights=None, starting_balance=STARTING_BALANCE,
+                        seed=None, percentiles=(1, 10, 50, 90, 99)):
+    """模拟 players 名玩家每轮随机两两对战 rounds 轮，记录余额分布随时间的变化。
+
+    玩家以 inviter_rate 的概率有一位上级（随机的另一名玩家），邀约收益计入该玩家余额；
+    余额不足下注额的一方会使该局跳过，与 process_bet 的余额检查一致。
+    """
+    rng = np.random.default_rng(seed)
+    weights = None if bet_weights is None else np.asarray(bet_weights, dtype=float) / np.sum(bet_weights)
+    pairs = players // 2
+
+    balance = np.full(players, starting_balance, dtype=np.int64)
+    inviter = np.where(rng.random(players) < inviter_rate, rng.integers(0, players, size=players), -1)
+    inviter[inviter == np.arange(players)] = -1
+
+    project_income = 0
+    inviter_income = 0
+    played = skipped = 0
+    history = np.empty((rounds, len(percentiles)), dtype=np.int64)
+
+    for r in range(rounds):
+        order = rng.permutation(players)[:pairs * 2].reshape(pairs, 2)
+        bet = BET_TIERS[rng.choice(len(BET_TIERS), size=pairs, p=weights)]
+        can_play = (balance[order[:, 0]] >= bet) & (balance[order[:, 1]] >= bet)
+        order, bet = order[can_play], bet[can_play]
+        skipped += pairs - len(order)
+        played += len(order)
+
+        scores = roll_scores(rng, (len(order), 2))
+        decided = scores[:, 0] != scores[:, 1]
+        order, bet, scores = order[decided], bet[decided], scores[decided]
+        winner = np.where(scores[:, 0] > scores[:, 1], order[:, 0], order[:, 1])
+        loser = np.where(scores[:, 0] > scores[:, 1], order[:, 1], order[:, 0])
+
+        win = bet * WINNER_SHARE_PERCENT // 100
+        inviter_fee = bet * INVITER_SHARE_PERCENT // 100
+        # 每个玩家每轮只出现在一局中，可以直接按下标加减
+        balance[winner] += win
+        balance[loser] -= bet
+        winner_inviter = inviter[winner]
+        has_inviter = winner_inviter >= 0
+        # 同一位邀约者可能在一轮中多次获得收益，需要累加
+        balance += np.bincount(winner_inviter[has_inviter], weights=inviter_fee[has_inviter],
+                               minlength=players).astype(np.int64)
+
+        project_income += int((bet * PROJECT_SHARE_PERCENT // 100).sum())
+        inviter_income += int(inviter_fee[has_inviter].sum())
+        history[r] = np.percentile(balance, percentiles)
+
+    return {
+        'players': players,
+        'rounds': rounds,
+        'played': played,
+        'skipped': skipped,
+        'project_income': project_income,
+        'inviter_income': inviter_income,
+        'percentiles': percentiles,
+        'balance_history': history,
+        'final_balance': balance,
+        'broke_players': int((balance < BET_TIERS[0]).sum()),
+    }
+
+
+def _print_match_report(result, inviter_rate, bet_weights):
+    exact = exact_match_probabilities()
+    matches = result['matches']
+    print(f"matches: {matches}")
+    print(f"tie rate: {result['tie_rate']:.5f} (exact {exact['tie']:.5f})")
+
+    dist = exact_score_distribution()
+    max_error = np.abs(result['score_distribution'] - dist).max()
+    print(f"3d6 score distribution max abs error vs exact: {max_error:.5f}")
+
+    weights = np.ones(len(BET_TIERS)) if bet_weights is None else np.asarray(bet_weights, dtype=float)
+    weights = weights / weights.sum()
+    expected_project, expected_inviter = expected_fees_per_match(BET_TIERS, inviter_rate)
+    print(f"project income per match: {result['project_income'] / matches:.3f} "
+          f"(exact {np.dot(weights, expected_project):.3f})")
+    print(f"inviter income per match: {result['inviter_income'] / matches:.3f} "
+          f"(exact {np.dot(weights, expected_inviter):.3f})")
+    print(f"unclaimed inviter fee per match: {result['unclaimed_inviter_fee'] / matches:.3f}")
+    print(f"{'bet':>6}{'matches':>12}{'project/match':>16}{'inviter/match':>16}")
+    for bet, tier in result['per_tier'].items():
+        n = max(tier['matches'], 1)
+        print(f"{bet:>6}{tier['matches']:>12}{tier['project_income'] / n:>16.3f}{tier['inviter_income'] / n:>16.3f}")
+
+
+def _print_population_report(result):
+    print(f"players: {result['players']}, rounds: {result['rounds']}, "
+          f"played: {result['played']}, skipped (insufficient balance): {result['skipped']}")
+    print(f"project income: {result['project_income']}, inviter income: {result['inviter_income']}")
+    print(f"players below minimum bet: {result['broke_players']}")
+    header = ''.join(f"{'p' + str(p):>10}" for p in result['percentiles'])
+    print(f"{'round':>8}{header}")
+    history = result['balance_history']
+    step = max(len(history) // 10, 1)
+    for r in list(range(0, len(history), step)) + [len(history) - 1]:
+        print(f"{r + 1:>8}" + ''.join(f"{v:>10}" for v in history[r]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--matches', type=int, default=1_000_000, help='独立对战的模拟局数')
+    parser.add_argument('--players', type=int, default=0, help='大于 0 时额外模拟玩家群体的余额变化')
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--inviter-rate', type=float, default=0.8, help='赢家有上级邀约者的比例')
+    parser.add_argument('--bet-weights', type=float, nargs=len(BET_TIERS), help='100~1000 各档位的相对权重')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    result = simulate_matches(args.matches, args.bet_weights, args.inviter_rate, args.seed)
+    _print_match_report(result, args.inviter_rate, args.bet_weights)
+
+    if args.players:
+        print()
+        population = simulate_population(args.players, args.rounds, args.inviter_rate, args.bet_weights, seed=args.seed)
+        _print_population_report(population)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+import time
+import logging
+import threading
+from migrations import ensure_schema
+from database import ensure_official_account
+
+logger = logging.getLogger(__name__)
+
+_bootstrapped = False
+_lock = threading.Lock()
+
+
+def bootstrap():
+    """启动阶段的一次性初始化：检查数据库结构版本、确保官方账户存在。
+
+    同一进程内只执行一次，重复调用直接返回；返回各步骤耗时（秒）。
+    """
+    global _bootstrapped
+    if _bootstrapped:
+        return {}
+    with _lock:
+        if _bootstrapped:
+            return {}
+        timings = {}
+        started = time.perf_counter()
+        migrated = ensure_schema()
+        timings['schema'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        ensure_official_account()
+        timings['official_account'] = time.perf_counter() - started
+
+        _bootstrapped = True
+        logger.info(
+            f"Bootstrap finished: schema {'migrated' if migrated else 'up to date'} in {timings['schema'] * 1000:.1f}ms, "
+            f"official account in {timings['official_account'] * 1000:.1f}ms"
+        )
+        return timings
@@ -0,0 +1,105 @@
+import asyncio
+import contextlib
+import logging
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """不同用户的更新并发处理，同一用户的更新按到达顺序串行处理。
+
+    handle_dice 等处理函数依赖 context.user_data 上的状态机，同一用户的骰子、
+    下注文本和按钮回调必须依次执行；不同用户之间没有这种依赖。
+    每个用户一把 asyncio.Lock（先进先出），拿到用户锁之后再占用全局并发名额，
+    这样同一用户排队中的更新不会占住名额、拖慢其他用户。
+
+    基类的 process_update 是 final 方法，先占用基类的信号量再调用 do_process_update，
+    用户锁只能在 do_process_update 中获取。因此传给基类的上限是 max_pending_updates，
+    即已接收（排队加处理中）的更新数上限；同时执行的处理函数数量由 _slots 限制为
+    max_concurrent_updates。若把两者设成同一个值，同一用户排队中的更新会占住基类名额。
+    """
+
+    def __init__(self, max_concurrent_updates, max_pending_updates=None):
+        if max_pending_updates is None:
+            max_pending_updates = max_concurrent_updates * 10
+        if max_pending_updates < max_concurrent_updates:
+            raise ValueError(
+                f"max_pending_updates ({max_pending_updates}) must be at least max_concurrent_updates ({max_concurrent_updates})"
+            )
+        super().__init__(max_pending_updates)
+        self.max_active_updates = max_concurrent_updates
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # 用户 id -> [锁, 排队与处理中的更新数]，计数归零时移除，避免无限增长
+        self._user_locks = {}
+        self.queued = 0
+        self.active = 0
+        self.processed = 0
+        # 有更新在排队（不止一个更新待处理）的用户数，随计数增减维护，指标线程只读取这个整数
+        self.backlogged_users = 0
+        # 启动以来单个用户排队与处理中的更新数峰值，只用于停机时的统计日志
+        self.peak_user_depth = 0
+
+    @staticmethod
+    def _ordering_key(update):
+        user = getattr(update, 'effective_user', None)
+        if user is not None:
+            return user.id
+        chat = getattr(update, 'effective_chat', None)
+        return chat.id if chat is not None else None
+
+    async def do_process_update(self, update, coroutine):
+        key = self._ordering_key(update)
+        entry = None
+        if key is not None:
+            entry = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+            entry[1] += 1
+            if entry[1] == 2:
+                self.backlogged_users += 1
+            self.peak_user_depth = max(self.peak_user_depth, entry[1])
+        self.queued += 1
+        started = False
+        try:
+            async with entry[0] if entry is not None else contextlib.nullcontext():
+                async with self._slots:
+                    self.queued -= 1
+                    self.active += 1
+                    started = True
+                    try:
+                        await coroutine
+                    finally:
+                        self.active -= 1
+                        self.processed += 1
+        finally:
+            if not started:
+                # 排队期间被取消（例如停机），协程未被执行，关闭它避免告警
+                self.queued -= 1
+                coroutine.close()
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] == 1:
+                    self.backlogged_users -= 1
+                elif entry[1] == 0:
+                    del self._user_locks[key]
+
+    def max_user_depth(self):
+        """当前单个用户排队与处理中的最大更新数；会遍历用户表，只在事件循环中调用。"""
+        return max((entry[1] for entry in self._user_locks.values()), default=0)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        logger.info(f"Update processor stats: {self.stats()}")
+
+    def stats(self):
+        return {
+            'max_concurrent_updates': self.max_active_updates,
+            'max_pending_updates': self.max_concurrent_updates,
+            'queued': self.queued,
+            'active': self.active,
+            'processed': self.processed,
+            'users_in_flight': len(self._user_locks),
+            'backlogged_users': self.backlogged_users,
+            'peak_user_depth': self.peak_user_depth,
+        }
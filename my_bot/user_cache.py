@@ -0,0 +1,148 @@
+import time
+import threading
+from collections import OrderedDict
+from config import USER_CACHE_SIZE, USER_CACHE_TTL
+
+
+class UserCache:
+    """按 telegram_id 与 id 双索引的进程内 LRU/TTL 用户缓存。"""
+
+    def __init__(self, max_size=10000, ttl=30):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # telegram_id -> (过期时间, 用户行)，按最近使用顺序排列
+        self._entries = OrderedDict()
+        # id -> telegram_id
+        self._ids = {}
+        # 写入时钟：每次写入失效递增一次，未命中时返回当前值作为回源的版本号
+        self._clock = 0
+        # ('telegram_id' | 'id', 键) -> 该键最近一次写入时的时钟值，按写入先后排列，最多保留 max_size 个
+        self._written = OrderedDict()
+        # 已从 _written 淘汰的最大时钟值，早于它开始的回源无法判断是否过期，一律不放入缓存
+        self._forgotten = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _lookup(self, telegram_id):
+        entry = self._entries.get(telegram_id)
+        if entry is None:
+            return None
+        expires_at, row = entry
+        if expires_at < time.monotonic():
+            self._remove(telegram_id)
+            return None
+        self._entries.move_to_end(telegram_id)
+        return dict(row)
+
+    def _remove(self, telegram_id):
+        entry = self._entries.pop(telegram_id, None)
+        if entry is not None:
+            self._ids.pop(entry[1]['id'], None)
+
+    def _mark_written(self, telegram_ids=(), user_ids=()):
+        self._clock += 1
+        keys = [('telegram_id', telegram_id) for telegram_id in telegram_ids]
+        keys += [('id', user_id) for user_id in user_ids]
+        for key in keys:
+            self._written.pop(key, None)
+            self._written[key] = self._clock
+        while len(self._written) > self.max_size:
+            _, self._forgotten = self._written.popitem(last=False)
+
+    def _is_stale(self, row, version):
+        # 只比较回源结果自身两个键的写入时钟，其他用户的写入不影响这次回填
+        if version < self._forgotten:
+            return True
+        return (self._written.get(('telegram_id', row['telegram_id']), 0) > version
+                or self._written.get(('id', row['id']), 0) > version)
+
+    def get_by_telegram_id(self, telegram_id):
+        # 返回 (用户行, 版本号)；未命中时用户行为 None，回源后把版本号传给 put
+        with self._lock:
+            row = self._lookup(telegram_id)
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return row, self._clock
+
+    def get_by_id(self, user_id):
+        with self._lock:
+            telegram_id = self._ids.get(user_id)
+            row = self._lookup(telegram_id) if telegram_id is not None else None
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return row, self._clock
+
+    def put(self, row, version=None):
+        if not row:
+            return
+        with self._lock:
+            if version is not None and self._is_stale(row, version):
+                # 回源期间该用户发生过写入，结果可能已过期，不放入缓存
+                return
+            telegram_id = row['telegram_id']
+            self._remove(telegram_id)
+            self._entries[telegram_id] = (time.monotonic() + self.ttl, dict(row))
+            self._ids[row['id']] = telegram_id
+            while len(self._entries) > self.max_size:
+                old_telegram_id, (_, old_row) = self._entries.popitem(last=False)
+                self._ids.pop(old_row['id'], None)
+                self.evictions += 1
+
+    def update(self, telegram_id, **fields):
+        # 写操作已知新值时直接更新缓存，避免下一次读取回源
+        with self._lock:
+            self._mark_written(telegram_ids=(telegram_id,))
+            entry = self._entries.get(telegram_id)
+            if entry is not None:
+                entry[1].update(fields)
+
+    def invalidate(self, telegram_id=None, user_id=None):
+        with self._lock:
+            self._mark_written(
+                telegram_ids=() if telegram_id is None else (telegram_id,),
+                user_ids=() if user_id is None else (user_id,),
+            )
+            self.invalidations += 1
+            if telegram_id is None and user_id is not None:
+                telegram_id = self._ids.get(user_id)
+            if telegram_id is not None:
+                self._remove(telegram_id)
+
+    def invalidate_many(self, telegram_ids):
+        telegram_ids = list(telegram_ids)
+        with self._lock:
+            self._mark_written(telegram_ids=telegram_ids)
+            for telegram_id in telegram_ids:
+                self.invalidations += 1
+                self._remove(telegram_id)
+
+    def clear(self):
+        with self._lock:
+            self._clock += 1
+            self._forgotten = self._clock
+            self._written.clear()
+            self._entries.clear()
+            self._ids.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+user_cache = UserCache(max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)